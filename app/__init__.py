@@ -1,21 +1,96 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from app.config import Config
-from flask_bcrypt import Bcrypt
+from app.database import RoutingSession, configure_engines
 
-db = SQLAlchemy()
-bcrypt = Bcrypt()  
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
-def create_app():
+
+def init_migrate(app):
+    """Registers Flask-Migrate on first use. It pulls in Alembic, which only
+    'flask db' and scripts that upgrade the schema need."""
+    if 'migrate' not in app.extensions:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    return app.extensions['migrate']
+
+
+def create_app(config_class=Config, minimal=False):
+    """Builds the app. ``minimal=True`` is for scripts and one-off workers:
+    only the database, cache, password hasher and CLI groups are set up, with
+    no routes, search index, audit writer, metrics or background threads."""
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
 
+    configure_engines(app)
     db.init_app(app)
-    bcrypt.init_app(app) 
-    migrate = Migrate(app, db)
+
+    from app.cache import cache
+    cache.init_app(app)
+
+    from app.hashing import hasher
+    hasher.init_app(app)
+
+    # Also registers the hooks that end sessions on password changes, which
+    # scripts need as much as the web app
+    from app.sessions import sessions
+    sessions.init_app(app)
+
+    from app.cli import (analytics_cli, audit_cli, books_cli, db_cli, holds_cli, loans_cli,
+                         recommendations_cli, sessions_cli, stock_cli)
+    app.cli.add_command(db_cli)
+    app.cli.add_command(books_cli)
+    app.cli.add_command(analytics_cli)
+    app.cli.add_command(loans_cli)
+    app.cli.add_command(audit_cli)
+    app.cli.add_command(holds_cli)
+    app.cli.add_command(recommendations_cli)
+    app.cli.add_command(sessions_cli)
+    app.cli.add_command(stock_cli)
+
+    if minimal:
+        return app
+
+    from app.search import search_index
+    search_index.init_app(app)
+
+    from app import render_cache
+    render_cache.init_app(app)
+
+    from app.audit import audit
+    audit.init_app(app)
+
+    from app import holds
+    holds.init_app(app)
+
+    from app.stock import summary
+    summary.init_app(app)
+
+    from app.analytics import book_counts
+    book_counts.init_app(app)
+
+    from app.ratelimit import limiter
+    limiter.init_app(app)
+
+    from app.instrumentation import (audit_metrics, cache_metrics, db_pool_metrics,
+                                     hasher_metrics, instrumentation, ratelimit_metrics)
+    instrumentation.init_app(app)
+    instrumentation.add_collector(cache_metrics)
+    instrumentation.add_collector(hasher_metrics)
+    instrumentation.add_collector(audit_metrics)
+    instrumentation.add_collector(db_pool_metrics)
+    instrumentation.add_collector(ratelimit_metrics)
 
     from app.routes import main
     app.register_blueprint(main)
 
+    from app.api import api
+    app.register_blueprint(api)
+
+    # Usually run as 'flask loans overdue' from cron instead; the job is
+    # idempotent, so overlapping runs are harmless.
+    if app.config.get('OVERDUE_SCHEDULER_ENABLED'):
+        from app.overdue import OverdueScheduler
+        OverdueScheduler(app, interval=app.config.get('OVERDUE_SCHEDULER_INTERVAL', 3600)).start()
+
     return app
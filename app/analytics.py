@@ -0,0 +1,365 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from datetime import date, timedelta
+from itertools import takewhile
+
+from flask import current_app, has_app_context
+from sqlalchemy import delete, event, extract, func, insert, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import db
+from app.database import RoutingSession
+from app.models import (AnalyticsState, Book, BookLoan, BookLoanStats,
+                        GenreMonthStats, User, UserLoanStats)
+
+# book_loans.id up to which the genre/month rollup has been counted
+GENRE_MONTH_WATERMARK = 'genre_month_loan_id'
+OVERDUE_LOANS = 'overdue_loans'
+# Seconds a loan's transaction may take to commit. Refreshes only count
+# loans older than that, since a younger one may still be followed by a
+# lower id that has not committed yet.
+REFRESH_LAG = 60
+
+logger = logging.getLogger(__name__)
+
+
+# -- counters -----------------------------------------------------------------
+
+def increment(model, keys, connection=None, **deltas):
+    """Adds deltas to one rollup row, creating it if missing, in one statement"""
+    execute = (connection or db.session).execute
+    table = model.__table__
+    values = dict(keys, **deltas)
+    dialect = db.engine.dialect.name
+    if dialect == 'mysql':
+        stmt = mysql_insert(table).values(**values)
+        stmt = stmt.on_duplicate_key_update({name: table.c[name] + stmt.inserted[name] for name in deltas})
+        execute(stmt)
+    elif dialect == 'sqlite':
+        stmt = sqlite_insert(table).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={name: table.c[name] + stmt.excluded[name] for name in deltas}
+        )
+        execute(stmt)
+    else:
+        stmt = update(table).filter_by(**keys).values({name: table.c[name] + delta for name, delta in deltas.items()})
+        if not execute(stmt).rowcount:
+            execute(insert(table).values(**values))
+
+
+def record_borrow(book_id, user_id):
+    """Counts a new loan; call inside the transaction that creates it. The
+    book's counts are added once it commits (see BookCounts)."""
+    _queue_book(book_id, 1, 1)
+    increment(UserLoanStats, {'user_id': user_id}, borrow_count=1, active_count=1)
+
+
+def record_return(book_id, user_id):
+    """Counts a returned loan; call inside the transaction that returns it"""
+    _queue_book(book_id, 0, -1)
+    increment(UserLoanStats, {'user_id': user_id}, active_count=-1)
+
+
+def _queue_book(book_id, borrows, active):
+    queued = db.session.info.setdefault('book_loan_counts', {})
+    borrow_count, active_count = queued.get(book_id, (0, 0))
+    queued[book_id] = (borrow_count + borrows, active_count + active)
+
+
+class BookCounts:
+    """Adds loans and returns to loan_stats_books outside their transactions.
+
+    Every loan of a busy title would otherwise write, and hold the lock on,
+    the same row until its transaction commits. Instead the counts of a
+    committed borrow or return are queued, and a background thread adds
+    the queued counts every ``interval`` seconds, one statement per book.
+    With ``interval`` 0 (scripts, tests) they are added right after the
+    commit. Counts queued when a process dies are put right by
+    'flask analytics rebuild'.
+    """
+
+    def __init__(self, app=None, interval=0):
+        self.app = None
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('BOOK_COUNTS_INTERVAL', 1.0)
+        app.extensions['book_counts'] = self
+        atexit.register(self.flush)
+
+    def add(self, counts):
+        if not self.interval or self.app is None:
+            self._apply(counts)
+            return
+        self._ensure_thread()
+        with self._lock:
+            self._merge(counts)
+
+    def _merge(self, counts):
+        for book_id, (borrows, active) in counts.items():
+            borrow_count, active_count = self._pending.get(book_id, (0, 0))
+            self._pending[book_id] = (borrow_count + borrows, active_count + active)
+
+    def _ensure_thread(self):
+        # Started lazily so each forked server process gets its own thread
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._pending = {}
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='book-counts', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Adds the queued counts now"""
+        with self._lock:
+            counts, self._pending = self._pending, {}
+        if not counts:
+            return
+        try:
+            with self.app.app_context():
+                self._apply(counts)
+        except Exception:
+            logger.exception('Counting loans of %d books failed', len(counts))
+            with self._lock:
+                self._merge(counts)
+
+    def _apply(self, counts):
+        # In book id order, so concurrent flushes lock rows in the same order
+        with db.engine.begin() as connection:
+            for book_id, (borrows, active) in sorted(counts.items()):
+                increment(BookLoanStats, {'book_id': book_id}, connection,
+                          borrow_count=borrows, active_count=active)
+
+
+book_counts = BookCounts()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _count_book_loans(db_session):
+    counts = db_session.info.pop('book_loan_counts', None)
+    if counts and has_app_context():
+        book_counts.add(counts)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_book_loans(db_session):
+    db_session.info.pop('book_loan_counts', None)
+
+
+def get_state(name, default=0):
+    state = db.session.get(AnalyticsState, name)
+    return state.value if state else default
+
+
+def set_state(name, value):
+    db.session.merge(AnalyticsState(name=name, value=value, updated_at=func.current_timestamp()))
+
+
+def settled_before():
+    """The time, on the database's clock, by which every loan created has
+    committed (or rolled back)"""
+    lag = current_app.config.get('ANALYTICS_REFRESH_LAG', REFRESH_LAG)
+    return db.session.scalar(select(func.current_timestamp())) - timedelta(seconds=lag)
+
+
+def settled(loans, before):
+    """The leading loans of an id-ordered batch created by ``before``.
+
+    Ids are handed out before commit, so a loan's id can sit below that of
+    one that committed first. A watermark moved past it would skip it for
+    good; stopping at the first loan that may still have such gaps behind
+    it keeps them for the next run. Loans from before created_at have none.
+    """
+    return list(takewhile(lambda loan: loan.created_at is None or loan.created_at <= before, loans))
+
+
+# -- periodic job -------------------------------------------------------------
+
+def refresh(batch_size=10000):
+    """Folds loans added since the last run into the genre/month rollup.
+
+    Walks book_loans by primary key from the stored watermark, one batch per
+    transaction, so it can be stopped and resumed at any point. Loans newer
+    than ANALYTICS_REFRESH_LAG seconds wait for the next run (see
+    settled()). Also snapshots the overdue loan count. Returns the number
+    of loans counted.
+    """
+    last_id = get_state(GENRE_MONTH_WATERMARK)
+    before = settled_before()
+    counted = 0
+    while True:
+        rows = settled(db.session.execute(
+            select(BookLoan.id, BookLoan.borrow_date, BookLoan.created_at, Book.genre)
+            .join(Book, Book.id == BookLoan.book_id)
+            .where(BookLoan.id > last_id)
+            .order_by(BookLoan.id)
+            .limit(batch_size)
+        ).all(), before)
+        if not rows:
+            break
+        counts = Counter((row.borrow_date.strftime('%Y-%m'), row.genre or '') for row in rows)
+        for (month, genre), count in counts.items():
+            increment(GenreMonthStats, {'month': month, 'genre': genre}, borrow_count=count)
+        last_id = rows[-1].id
+        set_state(GENRE_MONTH_WATERMARK, last_id)
+        db.session.commit()
+        counted += len(rows)
+
+    set_state(OVERDUE_LOANS, count_overdue())
+    db.session.commit()
+    return counted
+
+
+def count_overdue(today=None):
+    return db.session.scalar(
+        select(func.count(BookLoan.id))
+        .where(BookLoan.returned == False, BookLoan.return_date < (today or date.today()))
+    )
+
+
+# -- full recomputation -------------------------------------------------------
+
+def _numpy():
+    # Only rebuild() needs numpy; importing it costs web workers ~70ms
+    try:
+        import numpy
+    except ImportError:  # rebuild() falls back to plain Counters
+        return None
+    return numpy
+
+
+def _count_keys(keys, mask=None):
+    """Returns {key: occurrences} for a column of integer keys"""
+    np = _numpy()
+    if np is None:
+        if mask is not None:
+            keys = [key for key, keep in zip(keys, mask) if keep]
+        return Counter(keys)
+    keys = np.asarray(keys, dtype=np.int64)
+    if mask is not None:
+        keys = keys[np.asarray(mask, dtype=bool)]
+    values, counts = np.unique(keys, return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+
+def rebuild(chunk_size=100000):
+    """Recomputes every rollup from book_loans in one streaming pass.
+
+    Loans are read in chunks of columns (ids, flags, month numbers) and
+    counted with NumPy when it is installed, so memory stays proportional to
+    the chunk and the number of distinct keys, not to the loan count. The
+    rollups are then replaced in one transaction. Run it while borrowing is
+    quiet, since loans recorded during the pass may be counted twice.
+    """
+    month_number = extract('year', BookLoan.borrow_date) * 100 + extract('month', BookLoan.borrow_date)
+    stmt = select(BookLoan.id, BookLoan.book_id, BookLoan.user_id, BookLoan.returned,
+                  month_number.label('month'), Book.genre).join(Book, Book.id == BookLoan.book_id)
+
+    books, users = {}, {}
+    book_active, user_active = Counter(), Counter()
+    genre_months = Counter()
+    genre_codes = {}
+    max_id = 0
+
+    result = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    for chunk in result.partitions():
+        ids, book_ids, user_ids, returned, months, genres = zip(*chunk)
+        active = [not flag for flag in returned]
+        max_id = max(max_id, max(ids))
+        for counter, keys in ((books, book_ids), (users, user_ids)):
+            for key, count in _count_keys(keys).items():
+                counter[key] = counter.get(key, 0) + count
+        book_active.update(_count_keys(book_ids, active))
+        user_active.update(_count_keys(user_ids, active))
+        codes = [genre_codes.setdefault(genre or '', len(genre_codes)) for genre in genres]
+        keys = [code * 1000000 + int(month) for code, month in zip(codes, months)]
+        genre_months.update(_count_keys(keys))
+
+    genre_names = {code: genre for genre, code in genre_codes.items()}
+    for model in (BookLoanStats, UserLoanStats, GenreMonthStats):
+        db.session.execute(delete(model))
+    _insert_all(BookLoanStats, [
+        {'book_id': book_id, 'borrow_count': count, 'active_count': book_active.get(book_id, 0)}
+        for book_id, count in books.items()
+    ])
+    _insert_all(UserLoanStats, [
+        {'user_id': user_id, 'borrow_count': count, 'active_count': user_active.get(user_id, 0)}
+        for user_id, count in users.items()
+    ])
+    _insert_all(GenreMonthStats, [
+        {'genre': genre_names[key // 1000000], 'month': '%04d-%02d' % divmod(key % 1000000, 100),
+         'borrow_count': count}
+        for key, count in genre_months.items()
+    ])
+    set_state(GENRE_MONTH_WATERMARK, max_id)
+    set_state(OVERDUE_LOANS, count_overdue())
+    db.session.commit()
+    return sum(books.values())
+
+
+def _insert_all(model, rows, batch_size=10000):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(insert(model), rows[start:start + batch_size])
+
+
+# -- reports ------------------------------------------------------------------
+
+def reports(limit=20, months=12):
+    """Librarian reports, read straight from the rollup tables"""
+    today = date.today()
+    first_month = _month_offset(today, -(months - 1))
+
+    most_borrowed = db.session.execute(
+        select(Book.id, Book.title, Book.author, BookLoanStats.borrow_count, BookLoanStats.active_count)
+        .join(BookLoanStats, BookLoanStats.book_id == Book.id)
+        .order_by(BookLoanStats.borrow_count.desc())
+        .limit(limit)
+    ).all()
+    active_borrowers = db.session.execute(
+        select(User.id, User.first_name, User.last_name, User.email, UserLoanStats.active_count)
+        .join(UserLoanStats, UserLoanStats.user_id == User.id)
+        .where(UserLoanStats.active_count > 0)
+        .order_by(UserLoanStats.active_count.desc())
+        .limit(limit)
+    ).all()
+    by_genre = db.session.execute(
+        select(GenreMonthStats.month, GenreMonthStats.genre, GenreMonthStats.borrow_count)
+        .where(GenreMonthStats.month >= first_month)
+        .order_by(GenreMonthStats.month.desc(), GenreMonthStats.borrow_count.desc())
+    ).all()
+    overdue = db.session.get(AnalyticsState, OVERDUE_LOANS)
+
+    return {
+        'most_borrowed': [row._asdict() for row in most_borrowed],
+        'most_active_borrowers': [row._asdict() for row in active_borrowers],
+        'borrows_by_genre_month': [row._asdict() for row in by_genre],
+        'overdue_loans': {
+            'count': overdue.value if overdue else None,
+            'as_of': overdue.updated_at.isoformat() if overdue and overdue.updated_at else None
+        }
+    }
+
+
+def _month_offset(day, offset):
+    index = day.year * 12 + day.month - 1 + offset
+    return '%04d-%02d' % (index // 12, index % 12 + 1)
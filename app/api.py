@@ -0,0 +1,274 @@
+import hashlib
+import json
+import zlib
+from functools import wraps
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException
+
+from app import db, holds
+from app.catalog import BOOK_LIST_COLUMNS, get_book_or_404, invalidate_books
+from app.database import read_only
+from app.holds import AlreadyHolding, NoSuchHold
+from app.loans import NoCopiesLeft, NotOnLoan, borrow_copy, return_copy
+from app.models import Book, BookLoan
+from app.pagination import keyset_page
+from app.ratelimit import by_user, limiter
+from app.routes import audit_event
+from app.sessions import current_principal
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+@api.errorhandler(HTTPException)
+def json_error(e):
+    """abort() inside the API answers with {"error": description}"""
+    # Keeps headers such as Allow and Retry-After
+    headers = [header for header in e.get_headers() if header[0] != 'Content-Type']
+    return jsonify(error=e.description), e.code, headers
+
+
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_principal() is None:
+            abort(401, 'Sign in first')
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# -- validators and compression -------------------------------------------------
+
+def book_etag(book):
+    """Strong validator of one book: changes with every edit and loan"""
+    return '%d.%d.%d' % (book['id'], book['version'], book['availability'])
+
+
+def listing_etag(parts):
+    """Strong validator of a listing page from its rows' validators and the
+    request's cursors"""
+    digest = hashlib.sha1(request.full_path.encode())
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b',')
+    return digest.hexdigest()
+
+
+def negotiate_encoding():
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compress(chunks, encoding, level):
+    """Compresses an iterable of byte strings as it is being sent"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        write, finish = compressor.process, compressor.finish
+    else:
+        # wbits=31 writes the gzip container rather than a bare zlib stream
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        write, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = write(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def conditional_json(chunks, etag, rows=0, private=False):
+    """Answers with 304 when the client's If-None-Match already holds
+    ``etag``, otherwise streams the JSON ``chunks``.
+
+    Listings of at least API_COMPRESS_MIN_ROWS rows are compressed on the
+    fly when the client accepts it. Each encoding is a different
+    representation, so it gets its own strong ETag.
+    """
+    encoding = None
+    if rows >= current_app.config.get('API_COMPRESS_MIN_ROWS', 20):
+        encoding = negotiate_encoding()
+    if encoding:
+        etag = '%s-%s' % (etag, encoding)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = (chunk.encode() for chunk in chunks)
+        if encoding:
+            # Read now: the body is generated after the request context is gone
+            level = current_app.config.get('API_BROTLI_QUALITY' if encoding == 'br' else 'API_GZIP_LEVEL',
+                                           5 if encoding == 'br' else 6)
+            body = compress(body, encoding, level)
+        response = Response(body, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    # Stored, but revalidated on every use; the ETag makes that cheap
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    return response
+
+
+def json_listing(name, items, page, etag, private=False):
+    def chunks():
+        yield '{"%s":[' % name
+        for i, item in enumerate(items):
+            yield (',' if i else '') + json.dumps(item, default=str)
+        yield '],"prev":%s,"next":%s}' % (json.dumps(page.prev_cursor), json.dumps(page.next_cursor))
+    return conditional_json(chunks(), etag, rows=len(items), private=private)
+
+
+def per_page(default_key, default):
+    limit = request.args.get('limit', type=int) or current_app.config.get(default_key, default)
+    return max(1, min(limit, current_app.config.get('API_MAX_PER_PAGE', 500)))
+
+
+def hold_dict(hold, position=None):
+    return {
+        'id': hold.id,
+        'book_id': hold.book_id,
+        'status': hold.status,
+        'position': position,
+        'created_at': hold.created_at.isoformat(),
+        'expires_at': hold.expires_at.isoformat() if hold.expires_at else None
+    }
+
+
+def loan_dict(loan):
+    return {
+        'id': loan.id,
+        'book_id': loan.book_id,
+        'title': loan.book.title,
+        'author': loan.book.author,
+        'borrow_date': loan.borrow_date.isoformat(),
+        'return_date': loan.return_date.isoformat() if loan.return_date else None,
+        'returned': bool(loan.returned),
+        'fine': str(loan.fine)
+    }
+
+
+# -- books --------------------------------------------------------------------
+
+@api.route('/books')
+@read_only
+def books():
+    """The catalog in id order, one keyset page at a time"""
+    page = keyset_page(
+        select(*BOOK_LIST_COLUMNS),
+        Book.id,
+        after=request.args.get('after', type=int),
+        before=request.args.get('before', type=int),
+        per_page=per_page('API_PER_PAGE', 100)
+    )
+    items = [row._asdict() for row in page.items]
+    return json_listing('books', items, page, listing_etag(book_etag(book) for book in items))
+
+
+@api.route('/books/<int:book_id>')
+@read_only
+def book(book_id):
+    book = get_book_or_404(book_id)
+    return conditional_json([json.dumps(book)], book_etag(book))
+
+
+@api.route('/books/<int:book_id>/borrow', methods=['POST'])
+@api_login_required
+@limiter.limit('borrow', '30/minute', by_user)
+def borrow(book_id):
+    try:
+        loan = borrow_copy(book_id, current_principal().id, loan_days=current_app.config.get('LOAN_DAYS', 7))
+    except NoCopiesLeft:
+        if db.session.get(Book, book_id) is None:
+            abort(404, 'No such book')
+        abort(409, 'No copies left to borrow; place a hold to join the line')
+    invalidate_books(book_id)
+    audit_event("Borrowed book #%d (loan #%d)" % (book_id, loan.id))
+    return jsonify(loan=loan_dict(loan)), 201
+
+
+# -- loans --------------------------------------------------------------------
+
+@api.route('/loans')
+@api_login_required
+@read_only
+def loans():
+    """The signed-in user's loans, newest first"""
+    page = keyset_page(
+        select(BookLoan)
+        .where(BookLoan.user_id == current_principal().id)
+        .options(joinedload(BookLoan.book).load_only(Book.id, Book.title, Book.author)),
+        BookLoan.id,
+        after=request.args.get('after', type=int),
+        before=request.args.get('before', type=int),
+        per_page=per_page('LOANS_PER_PAGE', 50),
+        descending=True,
+        scalars=True
+    )
+    items = [loan_dict(loan) for loan in page.items]
+    etag = listing_etag('%d.%d.%s' % (loan['id'], loan['returned'], loan['fine']) for loan in items)
+    return json_listing('loans', items, page, etag, private=True)
+
+
+@api.route('/loans/<int:loan_id>/return', methods=['POST'])
+@api_login_required
+def return_loan(loan_id):
+    principal = current_principal()
+    # Librarians can check in any loan, readers only their own
+    try:
+        book_id, _ = return_copy(loan_id, user_id=None if principal.is_admin else principal.id)
+    except NotOnLoan:
+        abort(409, 'That loan is not open')
+    invalidate_books(book_id)
+    audit_event("Returned loan #%d of book #%d" % (loan_id, book_id))
+    return jsonify(loan_id=loan_id, book_id=book_id, returned=True)
+
+
+# -- holds --------------------------------------------------------------------
+
+@api.route('/books/<int:book_id>/holds', methods=['POST'])
+@api_login_required
+@limiter.limit('hold', '30/minute', by_user)
+def place_hold(book_id):
+    """Joins the book's line; the hold is 'ready' at once if a copy is free"""
+    if db.session.get(Book, book_id) is None:
+        abort(404, 'No such book')
+    try:
+        hold = holds.place_hold(book_id, current_principal().id)
+    except AlreadyHolding:
+        abort(409, 'You already have a hold on this book')
+    audit_event("Placed hold #%d on book #%d" % (hold.id, book_id))
+    if hold.status == 'ready':
+        invalidate_books(book_id)
+        return jsonify(hold=hold_dict(hold)), 201
+    return jsonify(hold=hold_dict(hold, holds.queue_position(hold))), 201
+
+
+@api.route('/holds')
+@api_login_required
+def my_holds():
+    """The signed-in user's open holds with their place in line"""
+    items = [dict(hold_dict(hold, position), title=title, author=author)
+             for hold, title, author, position in holds.holds_with_positions(current_principal().id)]
+    etag = listing_etag('%d.%s.%s' % (hold['id'], hold['status'], hold['position']) for hold in items)
+    return conditional_json([json.dumps({'holds': items})], etag, private=True)
+
+
+@api.route('/holds/<int:hold_id>', methods=['DELETE'])
+@api_login_required
+def cancel_hold(hold_id):
+    principal = current_principal()
+    try:
+        book_id = holds.cancel_hold(hold_id, user_id=None if principal.is_admin else principal.id)
+    except NoSuchHold:
+        abort(409, 'That hold is not open')
+    invalidate_books(book_id)
+    audit_event("Cancelled hold #%d on book #%d" % (hold_id, book_id))
+    return jsonify(hold_id=hold_id, cancelled=True)
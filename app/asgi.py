@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from flask import current_app, render_template, request, request_started, session
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from werkzeug.exceptions import HTTPException
+
+from app import create_app
+from app.cache import cache
+from app.catalog import BOOK_LIST_COLUMNS, get_book_or_404_async, newest_books_async
+from app.config import Config
+from app.database import engine_options
+from app.models import Book
+from app.pagination import keyset_query, keyset_result
+from app.recommendations import recommended_books_async
+from app.render_cache import page_cache_key
+from app.routes import render_book_detail
+
+logger = logging.getLogger(__name__)
+
+# The async driver SQLAlchemy gets for each database the app may run on
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'mysql': 'aiomysql', 'postgresql': 'asyncpg'}
+
+
+# -- read paths ---------------------------------------------------------------
+#
+# The same pages as the views in app/routes.py. Queries are awaited on the
+# event loop; templates render in a worker thread, which sees the request
+# context because asyncio.to_thread copies context variables.
+
+async def home(engine):
+    books = await newest_books_async(engine)
+    return await asyncio.to_thread(render_template, 'index.html', books=books)
+
+
+async def books_page(engine):
+    cursors = {
+        'after': request.args.get('after', type=int),
+        'before': request.args.get('before', type=int),
+        'per_page': current_app.config.get('BOOKS_PER_PAGE', 50)
+    }
+    async with engine.connect() as connection:
+        result = await connection.execute(keyset_query(select(*BOOK_LIST_COLUMNS), Book.id, **cursors))
+        rows = result.all()
+    page = keyset_result(rows, Book.id, **cursors)
+    # Rendered whole: a thread per streamed chunk would cost more than it saves
+    return await asyncio.to_thread(render_template, 'books.html', books=page.items, page=page)
+
+
+async def book_detail(engine, book_id):
+    book = await get_book_or_404_async(engine, book_id)
+    # One after the other: a request holding two connections at once can
+    # starve the pool under load
+    newest = await newest_books_async(engine)
+    also_borrowed = await recommended_books_async(engine, book_id)
+    return await asyncio.to_thread(render_book_detail, book, newest, also_borrowed)
+
+
+ASYNC_VIEWS = {'main.home': home, 'main.books_page': books_page, 'main.book_detail': book_detail}
+# The ones whose WSGI views are @cached_page
+PAGE_CACHED = {'main.home', 'main.books_page'}
+# The ones that only read through the shared cache's loaders
+CACHE_LOADED = {'main.home', 'main.book_detail'}
+
+
+def async_url(url):
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None or (url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')):
+        # An in-memory database would be a different one on every connection
+        return None
+    return url.set(drivername='%s+%s' % (url.get_backend_name(), driver))
+
+
+def create_async_engines(config):
+    """Async engines for the primary and each replica, or None when the
+    database has no async driver installed"""
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    urls = [config.get('ASYNC_DATABASE_URI') or config['SQLALCHEMY_DATABASE_URI']]
+    urls += list(config.get('DB_REPLICA_URIS') or ())
+    engines = []
+    for url in urls:
+        options = engine_options(config, url)
+        # The async engine brings its own pool class
+        options.pop('poolclass', None)
+        try:
+            engines.append(create_async_engine(async_url(url), **options))
+        except (ImportError, TypeError) as e:
+            logger.warning('No async driver for %s (%s); every route runs in the thread pool',
+                           make_url(url).render_as_string(hide_password=True), e)
+            return None
+    return engines
+
+
+# -- ASGI -----------------------------------------------------------------------
+
+def build_environ(scope, body):
+    """The WSGI environ of an ASGI HTTP request"""
+    script_name = scope.get('root_path', '')
+    path = scope['path']
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+        environ[name] = value
+    return environ
+
+
+def _encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+class AsgiApp:
+    """Serves a Flask app to an ASGI server such as uvicorn.
+
+    The home, catalog and book pages (ASYNC_VIEWS) run on the event loop:
+    their queries go through an async engine and only the template is
+    rendered in a worker thread. Every other route runs the WSGI app in a
+    pool of ``ASGI_THREADS`` threads, its response streamed back chunk by
+    chunk. Without an async driver for the database, every route takes the
+    thread pool.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.threads = flask_app.config.get('ASGI_THREADS', 32)
+        self.engines = create_async_engines(flask_app.config)
+        self._urls = flask_app.url_map.bind('localhost')
+        self._loop = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            self._start()
+            body = SpooledTemporaryFile(max_size=1024 * 1024)
+            while True:
+                message = await receive()
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            environ = build_environ(scope, body)
+            view = self._async_view(environ)
+            try:
+                if view is None:
+                    await self._call_wsgi(environ, send)
+                else:
+                    await self._call_async(environ, send, *view)
+            finally:
+                body.close()
+
+    def _start(self):
+        # The loop's default executor serves run_in_executor and to_thread
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            loop.set_default_executor(ThreadPoolExecutor(self.threads, thread_name_prefix='asgi'))
+            self._loop = loop
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in self.engines or ():
+                    await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _async_view(self, environ):
+        if self.engines is None or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return None
+        try:
+            endpoint, view_args = self._urls.match(environ['PATH_INFO'], 'GET')
+        except HTTPException:
+            # Redirects and 404s are the WSGI app's to answer
+            return None
+        view = ASYNC_VIEWS.get(endpoint)
+        return None if view is None else (view, view_args)
+
+    def _engine(self, fills_cache):
+        # As read_only does: a random replica, unless this browser wrote
+        # something in the last few seconds. Reads that go into the shared
+        # cache take the primary, as on_primary() makes them in WSGI views.
+        replicas = self.engines[1:]
+        if replicas and not fills_cache and session.get('rw_until', 0) < time.time():
+            return random.choice(replicas)
+        return self.engines[0]
+
+    # -- async views --------------------------------------------------------------
+
+    async def _call_async(self, environ, send, view, view_args):
+        # Flask.wsgi_app and full_dispatch_request, with an awaited view
+        app = self.flask_app
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            try:
+                ctx.push()
+                try:
+                    request_started.send(app)
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = await self._dispatch(view, view_args)
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                response = app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                response = app.handle_exception(e)
+            body = b'' if environ['REQUEST_METHOD'] == 'HEAD' else response.get_data()
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': _encode_headers(response.get_wsgi_headers(environ).items())})
+            await send({'type': 'http.response.body', 'body': body})
+        finally:
+            if error is not None and app.should_ignore_error(error):
+                error = None
+            ctx.pop(error)
+
+    async def _dispatch(self, view, view_args):
+        key = page_cache_key() if request.endpoint in PAGE_CACHED else None
+        engine = self._engine(key is not None or request.endpoint in CACHE_LOADED)
+        if key is None:
+            return await view(engine, **view_args)
+        return await cache.get_or_set_async(key, lambda: view(engine, **view_args),
+                                            ttl=current_app.config.get('PAGE_CACHE_TTL', 60))
+
+    # -- everything else ----------------------------------------------------------
+
+    async def _call_wsgi(self, environ, send):
+        loop = asyncio.get_running_loop()
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            response = []
+
+            def start_response(status, headers, exc_info=None):
+                response[:] = [int(status.split(' ', 1)[0]), headers]
+
+            def start():
+                status, headers = response
+                send_from_thread({'type': 'http.response.start', 'status': status,
+                                  'headers': _encode_headers(headers)})
+
+            chunks = self.flask_app(environ, start_response)
+            try:
+                # One chunk is held back, so it can go out as the last one
+                pending = None
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    if pending is not None:
+                        if response:
+                            start()
+                            response.clear()
+                        send_from_thread({'type': 'http.response.body', 'body': pending, 'more_body': True})
+                    pending = chunk
+                if response:
+                    start()
+                send_from_thread({'type': 'http.response.body', 'body': pending or b''})
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+
+        await loop.run_in_executor(None, run)
+
+
+def create_asgi_app(config_class=Config):
+    return AsgiApp(create_app(config_class))
@@ -0,0 +1,305 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import Log
+
+logger = logging.getLogger(__name__)
+
+# Events the database refused (a foreign key to an account deleted since,
+# say) go to the spill file's name plus this, not back into the spill,
+# where every replay would fail on them again
+DEAD_LETTER_SUFFIX = '.dead'
+
+
+class AuditLog:
+    """Buffers audit events and writes them to ``logs`` in batches.
+
+    Requests only put a dict on a bounded in-process queue. A background
+    thread writes whatever has queued up as one multi-row INSERT once
+    ``batch_size`` events are waiting or ``flush_interval`` seconds have
+    passed. When the queue is full a request waits at most
+    ``block_timeout`` seconds, then the event is appended to the JSONL
+    ``spill_path`` (or dropped and counted if there is none), so a slow
+    database never stalls requests for long. Batches that fail to insert
+    are spilled the same way; 'flask audit replay' loads them later. A
+    batch the database refuses is written again event by event, and the
+    events it still refuses go to the dead-letter file next to the spill.
+    An event that cannot be written anywhere is dropped and counted. The
+    queue is drained when the process exits normally.
+    """
+
+    def __init__(self, app=None, batch_size=500, flush_interval=1.0, max_queue=10000,
+                 block_timeout=0.05, spill_path=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._thread = None
+        self._closes_at_exit = False
+        self.configure(batch_size, flush_interval, max_queue, block_timeout, spill_path)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(
+            batch_size=app.config.get('AUDIT_BATCH_SIZE', 500),
+            flush_interval=app.config.get('AUDIT_FLUSH_INTERVAL', 1.0),
+            max_queue=app.config.get('AUDIT_MAX_QUEUE', 10000),
+            block_timeout=app.config.get('AUDIT_BLOCK_TIMEOUT', 0.05),
+            spill_path=app.config.get('AUDIT_SPILL_PATH')
+        )
+        self.app = app
+        app.extensions['audit'] = self
+        if not self._closes_at_exit:
+            atexit.register(self.close)
+            self._closes_at_exit = True
+
+    def configure(self, batch_size=500, flush_interval=1.0, max_queue=10000, block_timeout=0.05,
+                  spill_path=None):
+        if self._thread is not None:
+            # The running writer drains its queue, through its app, first
+            self.close()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.block_timeout = block_timeout
+        self.spill_path = spill_path
+        self._queue = queue.Queue(max_queue)
+        self._stop = threading.Event()
+        self._pid = None
+        self._counts = {'queued': 0, 'written': 0, 'batches': 0, 'spilled': 0, 'refused': 0, 'dropped': 0}
+
+    # -- producers ----------------------------------------------------------------
+
+    def record(self, action, user_id=None, admin_id=None):
+        """Queues one event; never raises and never blocks for long"""
+        event = {'user_id': user_id, 'admin_id': admin_id, 'action': action, 'timestamp': datetime.now()}
+        self._ensure_writer()
+        try:
+            self._queue.put(event, timeout=self.block_timeout)
+        except queue.Full:
+            self._overflow([event])
+            return
+        with self._lock:
+            self._counts['queued'] += 1
+
+    def _overflow(self, events):
+        if self.spill_path:
+            self._spill(events)
+        else:
+            with self._lock:
+                self._counts['dropped'] += len(events)
+            logger.warning('Audit queue full, dropped %d events', len(events))
+
+    def _spill(self, events):
+        self._append(self.spill_path, events, 'spilled')
+
+    def _dead_letter(self, events):
+        if self.spill_path:
+            self._append(self.spill_path + DEAD_LETTER_SUFFIX, events, 'refused')
+        else:
+            with self._lock:
+                self._counts['dropped'] += len(events)
+            logger.warning('Database refused %d audit events, dropped them', len(events))
+
+    def _append(self, path, events, kind):
+        try:
+            with self._spill_lock:
+                _append_events(path, events)
+        except OSError:
+            logger.exception('Could not write %d audit events to %s, dropped them', len(events), path)
+            kind = 'dropped'
+        with self._lock:
+            self._counts[kind] += len(events)
+
+    # -- writer -------------------------------------------------------------------
+
+    def _ensure_writer(self):
+        # Started lazily so each forked server process gets its own thread
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                if self._pid is not None and self._pid != os.getpid():
+                    # Forked with the parent's queue: start from a clean one
+                    self._queue = queue.Queue(self.max_queue)
+                self._pid = os.getpid()
+                # The thread keeps its own queue, stop flag and app, so a
+                # later configure() cannot hand it someone else's
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._queue, self._stop, self.app),
+                                                name='audit-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self, events, stop, app):
+        while True:
+            batch = self._take_batch(events)
+            if batch:
+                self._write(batch, events, app)
+            elif stop.is_set():
+                return
+
+    def _take_batch(self, events):
+        """Waits up to flush_interval for a first event, then takes the rest
+        of a batch without waiting"""
+        try:
+            batch = [events.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(events.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch, events, app):
+        """Writes a batch taken from ``events``, the queue it is done on"""
+        try:
+            with app.app_context():
+                refused = _insert_events(batch)
+        except Exception:
+            logger.exception('Writing %d audit events failed', len(batch))
+            self._overflow(batch)
+        else:
+            if refused:
+                self._dead_letter(refused)
+            with self._lock:
+                self._counts['written'] += len(batch) - len(refused)
+                self._counts['batches'] += 1
+        finally:
+            for _ in batch:
+                events.task_done()
+
+    def flush(self):
+        """Blocks until everything queued so far has been written (or spilled)"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self, timeout=10):
+        """Stops the writer after it has drained the queue"""
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self._thread = None
+        # Anything left (writer never started or timed out) is written here
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch and self.app is not None:
+            self._write(batch, self._queue, self.app)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._counts, queue_depth=self._queue.qsize(), max_queue=self.max_queue)
+
+
+audit = AuditLog()
+
+
+def _insert_events(events):
+    """Inserts events in one statement and commits. If the database refuses
+    the batch, inserts them one at a time instead and returns the events it
+    refuses on their own."""
+    try:
+        db.session.execute(insert(Log), events)
+        db.session.commit()
+        return []
+    except IntegrityError:
+        db.session.rollback()
+    refused = []
+    for event in events:
+        try:
+            db.session.execute(insert(Log), [event])
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            refused.append(dict(event, error=str(e.orig)))
+    return refused
+
+
+def _append_events(path, events):
+    with open(path, 'a', encoding='utf-8') as f:
+        for event in events:
+            f.write(json.dumps(dict(event, timestamp=event['timestamp'].isoformat())) + '\n')
+
+
+# -- maintenance --------------------------------------------------------------
+
+def replay_spill(path, batch_size=1000):
+    """Inserts the events of a spill file, then removes it. Events the
+    database refuses go to the dead-letter file (``path`` plus
+    DEAD_LETTER_SUFFIX). Returns the count inserted."""
+    replaying = path + '.replaying'
+    if not os.path.exists(replaying):
+        if not os.path.exists(path):
+            return 0
+        # New spills go to a fresh file while this one is loaded
+        os.replace(path, replaying)
+    count = 0
+    batch = []
+    with open(replaying, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            event['timestamp'] = datetime.fromisoformat(event['timestamp'])
+            batch.append(event)
+            if len(batch) == batch_size:
+                count += _replay_batch(batch, path + DEAD_LETTER_SUFFIX)
+                batch = []
+    if batch:
+        count += _replay_batch(batch, path + DEAD_LETTER_SUFFIX)
+    os.remove(replaying)
+    return count
+
+
+def _replay_batch(batch, dead_letter_path):
+    refused = _insert_events(batch)
+    if refused:
+        _append_events(dead_letter_path, refused)
+    return len(batch) - len(refused)
+
+
+def prune(older_than_days, batch_size=5000, archive_path=None, pause=0.0):
+    """Deletes log rows older than the cutoff in short id-ordered batches.
+
+    Each batch finds its ids through the timestamp index and deletes them by
+    primary key in its own transaction, so the job never holds locks for
+    long and can be stopped at any time. Rows can be appended to a JSONL
+    ``archive_path`` before they go. Returns the number of rows deleted.
+    """
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    deleted = 0
+    while True:
+        rows = db.session.execute(
+            select(Log.id, Log.user_id, Log.admin_id, Log.action, Log.timestamp)
+            .where(Log.timestamp < cutoff)
+            .order_by(Log.timestamp, Log.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        if archive_path:
+            with open(archive_path, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row._asdict(), default=str) + '\n')
+        db.session.execute(delete(Log).where(Log.id.in_([row.id for row in rows])))
+        db.session.commit()
+        deleted += len(rows)
+        if pause:
+            time.sleep(pause)
+    return deleted
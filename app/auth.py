@@ -0,0 +1,55 @@
+from flask import current_app
+from sqlalchemy import literal, select, union_all, update
+
+from app import db
+from app.hashing import HasherBusy, hasher
+from app.models import AdminUser, User
+
+
+def find_accounts(email):
+    """Returns the user and/or admin rows for an email in one round trip"""
+    stmt = union_all(
+        select(User.id, User.password_hash, literal(False).label('is_admin')).where(User.email == email),
+        select(AdminUser.id, AdminUser.password_hash, literal(True).label('is_admin')).where(AdminUser.email == email)
+    )
+    # Regular users take precedence, as they always have
+    return sorted(db.session.execute(stmt).all(), key=lambda row: bool(row.is_admin))
+
+
+def authenticate(email, password):
+    """Returns (account_id, is_admin) for valid credentials, otherwise None.
+
+    Runs one hash check per matching account (normally exactly one). Raises
+    HasherBusy when the hashing pool is saturated or too slow to answer
+    within HASHER_TIMEOUT.
+    """
+    if not email or not password:
+        return None
+    for account in find_accounts(email):
+        if hasher.check_password(account.password_hash, password):
+            is_admin = bool(account.is_admin)
+            if hasher.needs_rehash(account.password_hash):
+                _rehash_later(AdminUser if is_admin else User, account.id, password)
+            return account.id, is_admin
+    return None
+
+
+def _rehash_later(model, account_id, password):
+    """Upgrades a hash made with an old work factor without delaying the login"""
+    app = current_app._get_current_object()
+    try:
+        future = hasher.submit_hash(password)
+    except HasherBusy:
+        # Not urgent; the next login will try again
+        return
+
+    def store(done):
+        if done.cancelled() or done.exception() is not None:
+            return
+        with app.app_context():
+            db.session.execute(
+                update(model).where(model.id == account_id).values(password_hash=done.result())
+            )
+            db.session.commit()
+
+    future.add_done_callback(store)
@@ -0,0 +1,131 @@
+import logging
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import Connection, and_, func, insert, select, update
+
+from app.models import AnalyticsState
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+REPORT_EVERY = 5.0
+
+
+def _settings(batch_size, pause):
+    config = current_app.config if has_app_context() else {}
+    return (batch_size or config.get('BACKFILL_BATCH_SIZE', BATCH_SIZE),
+            config.get('BACKFILL_PAUSE', 0.0) if pause is None else pause)
+
+
+def in_range(column, after, upto):
+    """The rows of one batch: ``after < column <= upto``"""
+    if after is None:
+        return column <= upto
+    return and_(column > after, column <= upto)
+
+
+def key_ranges(conn, column, after=None, batch_size=BATCH_SIZE):
+    """Yields ``(after, upto)`` bounds that split a table into batches of
+    ``batch_size`` rows by an integer key column, lowest first.
+
+    Each bound is one seek of ``batch_size`` entries along the key's index,
+    so no rows are read into memory and rows added behind the walk are still
+    reached.
+    """
+    while True:
+        stmt = select(column).order_by(column).offset(batch_size - 1).limit(1)
+        if after is not None:
+            stmt = stmt.where(column > after)
+        upto = conn.scalar(stmt)
+        if upto is None:
+            # Fewer than batch_size rows left
+            stmt = select(func.max(column))
+            if after is not None:
+                stmt = stmt.where(column > after)
+            upto = conn.scalar(stmt)
+            if upto is not None:
+                yield after, upto
+            return
+        yield after, upto
+        after = upto
+
+
+def get_checkpoint(conn, name):
+    return conn.scalar(select(AnalyticsState.value).where(AnalyticsState.name == name))
+
+
+def set_checkpoint(conn, name, value):
+    table = AnalyticsState.__table__
+    if value is None:
+        conn.execute(table.delete().where(table.c.name == name))
+    elif not conn.execute(update(table).where(table.c.name == name).values(value=value)).rowcount:
+        conn.execute(insert(table).values(name=name, value=value))
+
+
+def run(conn, column, apply, name=None, batch_size=None, pause=None, report=None):
+    """Calls ``apply(after, upto)`` for each batch of a table and commits
+    after each one, so no transaction holds locks on more than one batch.
+
+    Walks the integer key ``column`` lowest first (see key_ranges()); use
+    in_range() in ``apply`` to select a batch's rows. ``conn`` is a Session
+    or a Connection with commit-as-you-go transactions (in a migration, one
+    from ``op.get_bind()`` inside ``op.get_context().autocommit_block()``).
+
+    With a ``name``, the last key done is kept in analytics_state with each
+    batch, so a run that stops is resumed from there, and cleared at the
+    end. Without one, make ``apply`` skip rows that are already done so a
+    rerun is cheap. Sleeps ``pause`` seconds (BACKFILL_PAUSE) between
+    batches to leave room for other writers and replicas, and passes a
+    progress line with an ETA to ``report`` (logger.info) every few seconds.
+    Returns the sum of what ``apply`` returned, e.g. rows changed.
+    """
+    batch_size, pause = _settings(batch_size, pause)
+    report = report or logger.info
+    after = get_checkpoint(conn, name) if name else None
+    if after is not None:
+        report('%s: resuming after key %d' % (name, after))
+    first = conn.scalar(select(func.min(column)).where(column > after) if after is not None
+                        else select(func.min(column)))
+    last = conn.scalar(select(func.max(column)))
+    label = name or str(column)
+
+    done = batches = 0
+    started = last_report = time.perf_counter()
+    for after, upto in key_ranges(conn, column, after, batch_size):
+        done += apply(after, upto) or 0
+        if name:
+            set_checkpoint(conn, name, upto)
+        _commit(conn)
+        batches += 1
+
+        now = time.perf_counter()
+        if now - last_report >= REPORT_EVERY:
+            report(_progress(label, first, last, upto, batches * batch_size, now - started))
+            last_report = now
+        if pause:
+            time.sleep(pause)
+
+    if name:
+        set_checkpoint(conn, name, None)
+        _commit(conn)
+    elapsed = time.perf_counter() - started
+    report('%s: %d batches in %.1fs, %d changed' % (label, batches, elapsed, done))
+    return done
+
+
+def _commit(conn):
+    # Under AUTOCOMMIT (a migration's autocommit_block()) every statement
+    # has committed already, and the block owns the transaction
+    if isinstance(conn, Connection) and conn.get_execution_options().get('isolation_level') == 'AUTOCOMMIT':
+        return
+    conn.commit()
+
+
+def _progress(label, first, last, upto, rows, elapsed):
+    # Keys are spread about evenly, so the share of the key range walked
+    # stands in for the share of rows
+    share = (upto - first + 1) / (last - first + 1) if last > first else 1.0
+    eta = elapsed * (1 - share) / share if share else 0
+    return '%s: %.0f%% (key %d of %d), %.0f rows/sec, ETA %dm%02ds' % (
+        label, 100 * min(share, 1.0), upto, last, rows / elapsed if elapsed else 0, eta // 60, eta % 60)
@@ -0,0 +1,167 @@
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class SimpleBackend:
+    """In-process LRU cache with a TTL per entry"""
+
+    name = 'simple'
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def size(self):
+        return len(self._data)
+
+
+class RedisBackend:
+    """Shared cache in Redis or any server speaking its protocol.
+
+    LRU eviction is left to the server (``maxmemory-policy allkeys-lru``);
+    TTLs are set per key.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url, prefix='library:'):
+        import redis  # only needed when this backend is configured
+
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self._client.get(self.prefix + key)
+        return MISSING if raw is None else pickle.loads(raw)
+
+    def set(self, key, value, ttl):
+        self._client.set(self.prefix + key, pickle.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + '*'):
+            self._client.delete(key)
+
+    def size(self):
+        return sum(1 for _ in self._client.scan_iter(self.prefix + '*'))
+
+
+class Cache:
+    """Read-through cache with hit/miss counters per key namespace.
+
+    The namespace is the part of the key before the first ':', so
+    ``book:42`` is counted under ``book``.
+    """
+
+    def __init__(self, app=None):
+        self.backend = SimpleBackend()
+        self.default_ttl = 300
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.get('CACHE_BACKEND', 'simple')
+        if backend == 'redis':
+            self.backend = RedisBackend(app.config['CACHE_REDIS_URL'],
+                                        prefix=app.config.get('CACHE_KEY_PREFIX', 'library:'))
+        else:
+            self.backend = SimpleBackend(app.config.get('CACHE_MAX_ENTRIES', 10000))
+            if not (app.debug or app.testing):
+                # Invalidations only reach the process that made them
+                logger.warning("CACHE_BACKEND 'simple' keeps entries per process: writes made by other "
+                               "workers or flask commands show once they expire. Use 'redis' when "
+                               "running more than one process.")
+        self.default_ttl = app.config.get('CACHE_DEFAULT_TTL', 300)
+        app.extensions['cache'] = self
+
+    def get_or_set(self, key, loader, ttl=None):
+        """Returns the cached value for key, calling loader() to fill a miss"""
+        value = self._get(key)
+        if value is MISSING:
+            value = loader()
+            self.backend.set(key, value, ttl or self.default_ttl)
+        return value
+
+    async def get_or_set_async(self, key, loader, ttl=None):
+        """get_or_set with a coroutine function as the loader. The backend is
+        still called directly: a dict lookup in process, a short blocking
+        round trip with Redis."""
+        value = self._get(key)
+        if value is MISSING:
+            value = await loader()
+            self.backend.set(key, value, ttl or self.default_ttl)
+        return value
+
+    def _get(self, key):
+        stats = self._stats[key.split(':', 1)[0]]
+        value = self.backend.get(key)
+        stats['misses' if value is MISSING else 'hits'] += 1
+        return value
+
+    def peek(self, key, default=None):
+        """Reads a cached value without loading it or touching the counters"""
+        value = self.backend.get(key)
+        return default if value is MISSING else value
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl or self.default_ttl)
+
+    def delete(self, *keys):
+        self.backend.delete(*keys)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        namespaces = {}
+        for namespace, counts in self._stats.items():
+            total = counts['hits'] + counts['misses']
+            namespaces[namespace] = dict(counts, hit_ratio=counts['hits'] / total if total else None)
+        return {
+            'backend': self.backend.name,
+            'entries': self.backend.size(),
+            'namespaces': namespaces
+        }
+
+
+cache = Cache()
@@ -0,0 +1,159 @@
+from flask import abort, current_app
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import db
+from app.cache import cache
+from app.database import on_primary
+from app.models import Book
+from app.render_cache import invalidate_pages
+from app.stock import adjust_copies
+
+# Only the columns the catalog pages actually render, plus the version the
+# API builds its ETags from
+BOOK_LIST_COLUMNS = (Book.id, Book.title, Book.author, Book.genre,
+                     Book.publisher, Book.year, Book.availability, Book.version)
+
+NEWEST_BOOKS_KEY = 'newest:books'
+
+
+def _book_key(book_id):
+    return 'book:%d' % book_id
+
+
+def newest_books_query():
+    return select(*BOOK_LIST_COLUMNS).order_by(Book.id.desc()).limit(current_app.config.get('NEWEST_BOOKS_COUNT', 3))
+
+
+def book_query(book_id):
+    return select(*BOOK_LIST_COLUMNS).where(Book.id == book_id)
+
+
+# Cached reads. Values are plain dicts so they can live in any backend and
+# never hold on to a session. They are loaded from the primary (see
+# on_primary()).
+
+def newest_books():
+    """Latest books for the homepage; the first one doubles as 'Latest Book'"""
+    def load():
+        with on_primary():
+            return [row._asdict() for row in db.session.execute(newest_books_query())]
+    return cache.get_or_set(NEWEST_BOOKS_KEY, load)
+
+
+def get_book_or_404(book_id):
+    def load():
+        with on_primary():
+            row = db.session.execute(book_query(book_id)).first()
+        return row._asdict() if row else None
+    book = cache.get_or_set(_book_key(book_id), load)
+    if book is None:
+        abort(404)
+    return book
+
+
+# The same reads through an async engine, for app/asgi.py, which passes
+# the primary's
+
+async def newest_books_async(engine):
+    async def load():
+        async with engine.connect() as connection:
+            return [row._asdict() for row in await connection.execute(newest_books_query())]
+    return await cache.get_or_set_async(NEWEST_BOOKS_KEY, load)
+
+
+async def get_book_or_404_async(engine, book_id):
+    async def load():
+        async with engine.connect() as connection:
+            row = (await connection.execute(book_query(book_id))).first()
+        return row._asdict() if row else None
+    book = await cache.get_or_set_async(_book_key(book_id), load)
+    if book is None:
+        abort(404)
+    return book
+
+
+# Edits
+
+# What an edit may change, with the labels the conflict view shows
+BOOK_FIELDS = (('title', 'Title'), ('author', 'Author'), ('genre', 'Genre'),
+               ('availability', 'Availability'), ('publisher', 'Publisher'), ('year', 'Year'))
+
+
+class EditConflict(Exception):
+    """Raised when someone else edited a book since the form was loaded;
+    ``book`` is the book as it is now"""
+
+    def __init__(self, book):
+        super().__init__(book.id)
+        self.book = book
+
+
+def _differs(old, new):
+    # An empty form field and NULL are the same thing
+    return old != new and not (old in (None, '') and new in (None, ''))
+
+
+def update_book(book, fields, seen_version, seen_availability):
+    """Saves an edit made to version ``seen_version`` of a book and commits.
+
+    Only the fields that differ are written, in one UPDATE conditional on
+    the version, so an edit saved meanwhile raises EditConflict rather than
+    being overwritten. Availability moves by what the editor changed
+    (``fields['availability'] - seen_availability``) instead of being set,
+    which keeps the loans and returns since the form was loaded: added
+    copies go to the default branch, removed ones come off any shelf. No
+    availability in ``fields`` leaves the copies alone.
+    Raises ValueError if fewer copies than that are on the shelves.
+    Returns the names of the changed fields.
+    """
+    if book.version != seen_version:
+        raise EditConflict(book)
+    changed = [name for name, _ in BOOK_FIELDS
+               if name != 'availability' and name in fields and _differs(getattr(book, name), fields[name])]
+    delta = fields['availability'] - seen_availability if 'availability' in fields else 0
+    if delta:
+        # Before any field is set, so autoflush cannot split the UPDATE
+        moved = adjust_copies(book.id, delta)
+        if moved != delta:
+            db.session.rollback()
+            raise ValueError("Only %d copies are on the shelves now." % -moved)
+    for name in changed:
+        setattr(book, name, fields[name])
+    if delta:
+        book.availability = Book.availability + delta
+        changed.append('availability')
+    if not changed:
+        return changed
+    book_id = book.id
+    try:
+        db.session.flush()
+    except StaleDataError:
+        db.session.rollback()
+        current = db.session.get(Book, book_id)
+        if current is None:
+            abort(404)
+        raise EditConflict(current)
+    db.session.commit()
+    return changed
+
+
+def edit_diff(book, fields):
+    """(label, saved value, submitted value) of each field that differs"""
+    return [(label, getattr(book, name), fields[name]) for name, label in BOOK_FIELDS
+            if name in fields and _differs(getattr(book, name), fields[name])]
+
+
+# Invalidation, called after a write has committed
+
+def invalidate_books(*book_ids, added=False):
+    """Drops cached copies of the given books and the cached pages.
+
+    The newest-books list is only dropped when a book was added or when one
+    of the changed books is actually in it.
+    """
+    cache.delete(*[_book_key(book_id) for book_id in book_ids])
+    invalidate_pages()
+    newest = cache.peek(NEWEST_BOOKS_KEY)
+    if added or (newest and any(book['id'] in book_ids for book in newest)):
+        cache.delete(NEWEST_BOOKS_KEY)
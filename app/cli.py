@@ -0,0 +1,437 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, insert, select, update
+
+from app import analytics, audit, db, init_migrate, recommendations, stock
+from app.catalog import invalidate_books
+from app.forms import BOOK_FIELDS, OPTIONAL_FIELDS, clean_book_fields
+from app.holds import expire_holds
+from app.models import Book, Branch
+from app.search import search_index
+from app.sessions import sessions
+
+
+class LazyGroup(click.Group):
+    """Stands in for the group ``load()`` returns, importing it only when it
+    is actually run, so its dependencies stay off the startup path"""
+
+    def __init__(self, name, load, **kwargs):
+        super().__init__(name, **kwargs)
+        self._load = load
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        # The real group parses its own options and runs its own callback
+        return self._load().make_context(info_name, args, parent=parent, **extra)
+
+
+def _migrate_commands():
+    from flask_migrate.cli import db as migrate_cli
+    init_migrate(current_app)
+    return migrate_cli
+
+
+db_cli = LazyGroup('db', _migrate_commands, help='Database migrations (Flask-Migrate).')
+books_cli = AppGroup('books', help='Bulk catalog import and export.')
+analytics_cli = AppGroup('analytics', help='Loan report rollups.')
+loans_cli = AppGroup('loans', help='Loan maintenance jobs.')
+audit_cli = AppGroup('audit', help='Audit log maintenance.')
+holds_cli = AppGroup('holds', help='Reservation queue maintenance.')
+recommendations_cli = AppGroup('recommendations', help='"Readers also borrowed" lists.')
+sessions_cli = AppGroup('sessions', help='Signed-in sessions.')
+stock_cli = AppGroup('stock', help='Branches and the copies on their shelves.')
+
+books_table = Book.__table__
+
+
+def _format_for(path, fmt):
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def _read_rows(stream, fmt):
+    # JSONL lines are decoded by _parse_row(), inside the per-row error
+    # handling, so one bad line is rejected instead of ending the import
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                yield line
+
+
+def _parse_row(raw):
+    if not isinstance(raw, str):
+        return raw
+    try:
+        row = json.loads(raw)
+    except ValueError as e:
+        raise ValueError("Not valid JSON: %s" % e)
+    if not isinstance(row, dict):
+        raise ValueError("Each line must be a JSON object.")
+    return row
+
+
+class _RowWriter:
+    """Writes dict rows as CSV or JSONL to an open text stream"""
+
+    def __init__(self, stream, fmt, fieldnames):
+        self.stream = stream
+        self.fmt = fmt
+        self.csv = csv.DictWriter(stream, fieldnames=fieldnames, extrasaction='ignore') if fmt == 'csv' else None
+        if self.csv:
+            self.csv.writeheader()
+
+    def write(self, row):
+        if self.csv:
+            self.csv.writerow(row)
+        else:
+            self.stream.write(json.dumps(row, default=str) + '\n')
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def upsert_books(rows):
+    """Inserts or updates a batch of cleaned book dicts in a few statements.
+
+    Books are matched on (title, author). Nothing makes that pair unique, so
+    a row updates every book that has it. Existing rows are updated by
+    primary key through one executemany UPDATE per set of columns the rows
+    carry, so a column the feed leaves out is left alone. New ones are
+    written with one executemany INSERT. A row's availability is the number
+    of copies owned: new books get them on the default branch's shelf and
+    existing ones are brought to it, counting the copies out on loan or held
+    (see app/stock.py). Without one, new books get one copy and existing
+    ones keep theirs. Returns the number of inserted rows and the ids of the
+    updated ones.
+    """
+    # Last occurrence of a key within the batch wins
+    by_key = {(row['title'], row['author']): row for row in rows}
+    existing = _find_books(by_key)
+
+    # books.availability is recounted from branch_stock, so updates leave it out
+    updates = {}
+    for key, row in by_key.items():
+        for book_id in existing.get(key, ()):
+            values = {name: value for name, value in row.items() if name != 'availability'}
+            updates.setdefault(frozenset(values), []).append(dict(values, b_id=book_id))
+    owned = {
+        book_id: row['availability']
+        for key, row in by_key.items() if key in existing and 'availability' in row
+        for book_id in existing[key]
+    }
+    # One INSERT needs the same keys in every row
+    blank = dict.fromkeys(OPTIONAL_FIELDS)
+    inserts = [dict(blank, **row, availability=row.get('availability', 1))
+               for key, row in by_key.items() if key not in existing]
+
+    for group in updates.values():
+        db.session.execute(
+            update(books_table).where(books_table.c.id == bindparam('b_id'))
+            .values(version=books_table.c.version + 1),
+            group
+        )
+    if inserts:
+        db.session.execute(insert(books_table), inserts)
+        inserted = _find_books({(row['title'], row['author']): row for row in inserts})
+        stock.stock_new_books({book_id: by_key[key].get('availability', 1)
+                               for key, book_ids in inserted.items() for book_id in book_ids})
+    if owned:
+        stock.set_owned_copies(owned)
+    return len(inserts), [row['b_id'] for group in updates.values() for row in group]
+
+
+def _find_books(by_key):
+    """{(title, author): [book ids]} of the keys that are in the catalog"""
+    # Seek on title through ix_books_title_author and match the author
+    # here; SQLite answers a (title, author) IN (...) with a full index scan
+    found = {}
+    for book_id, title, author in db.session.execute(
+        select(Book.id, Book.title, Book.author).where(Book.title.in_({title for title, _ in by_key}))
+    ):
+        if (title, author) in by_key:
+            found.setdefault((title, author), []).append(book_id)
+    return found
+
+
+def _import_batch(batch, reject):
+    """Validates and writes one batch; returns (inserted, updated)"""
+    good = []
+    for raw in batch:
+        try:
+            good.append(clean_book_fields(_parse_row(raw)))
+        except ValueError as e:
+            reject(raw if isinstance(raw, dict) else {'line': raw.rstrip('\n')}, str(e))
+    if not good:
+        return 0, 0
+
+    try:
+        inserted, updated_ids = upsert_books(good)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+
+        # Something in the batch broke the statement; isolate the bad rows
+        inserted, updated_ids = 0, []
+        for row in good:
+            try:
+                i, ids = upsert_books([row])
+                db.session.commit()
+                inserted += i
+                updated_ids += ids
+            except Exception as e:
+                db.session.rollback()
+                reject(row, str(getattr(e, 'orig', e)))
+
+    invalidate_books(*updated_ids, added=bool(inserted))
+    # The UPDATEs went around the mapper events; indexes in other processes
+    # see them by books.updated_at
+    search_index.reindex(updated_ids)
+    return inserted, len(updated_ids)
+
+
+@books_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per INSERT/UPDATE batch.')
+@click.option('--rejects', 'rejects_path', type=click.Path(dir_okay=False),
+              help='Where to write rows that fail validation. Defaults to <path>.rejects.')
+def import_books(path, fmt, batch_size, rejects_path):
+    """Streams books from a CSV or JSONL file into the catalog.
+
+    Rows are matched to existing books by (title, author) and updated in
+    place; everything else is inserted. Memory use is bounded by
+    --batch-size, not by the size of the file.
+    """
+    fmt = _format_for(path, fmt)
+    rejects_path = rejects_path or path + '.rejects'
+    total = inserted = updated = rejected = 0
+    started = last_report = time.perf_counter()
+
+    with open(path, newline='', encoding='utf-8') as source, \
+            open(rejects_path, 'w', newline='', encoding='utf-8') as rejects_file:
+        rejects = _RowWriter(rejects_file, fmt, list(BOOK_FIELDS) + ['error'])
+
+        def reject(row, error):
+            nonlocal rejected
+            rejected += 1
+            rejects.write(dict(row, error=error))
+
+        for batch in _chunks(_read_rows(source, fmt), batch_size):
+            i, u = _import_batch(batch, reject)
+            total += len(batch)
+            inserted += i
+            updated += u
+            now = time.perf_counter()
+            if now - last_report >= 5:
+                click.echo('%d rows read, %.0f rows/sec' % (total, total / (now - started)), err=True)
+                last_report = now
+
+    elapsed = time.perf_counter() - started
+    click.echo('Imported %d rows in %.1fs (%.0f rows/sec): %d inserted, %d updated, %d rejected'
+               % (total, elapsed, total / elapsed if elapsed else 0, inserted, updated, rejected))
+    if rejected:
+        click.echo('Rejected rows written to %s' % rejects_path)
+    else:
+        os.remove(rejects_path)
+
+
+@books_cli.command('export')
+@click.argument('path', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched per round trip.')
+def export_books(path, fmt, batch_size):
+    """Streams the whole catalog to a CSV or JSONL file ('-' for stdout)"""
+    fmt = _format_for(path, fmt)
+    columns = [Book.id] + [getattr(Book, name) for name in BOOK_FIELDS]
+    rows = db.session.execute(
+        select(*columns).order_by(Book.id).execution_options(yield_per=batch_size)
+    )
+    count = 0
+    started = time.perf_counter()
+    with click.open_file(path, 'w', encoding='utf-8') as target:
+        writer = _RowWriter(target, fmt, ['id'] + list(BOOK_FIELDS))
+        for row in rows:
+            writer.write(row._asdict())
+            count += 1
+    elapsed = time.perf_counter() - started
+    click.echo('Exported %d rows in %.1fs (%.0f rows/sec)'
+               % (count, elapsed, count / elapsed if elapsed else 0), err=True)
+
+
+@analytics_cli.command('refresh')
+@click.option('--batch-size', default=10000, show_default=True)
+def refresh_analytics(batch_size):
+    """Counts new loans into the rollups; run it periodically (e.g. cron)"""
+    started = time.perf_counter()
+    counted = analytics.refresh(batch_size=batch_size)
+    click.echo('Counted %d new loans in %.1fs' % (counted, time.perf_counter() - started))
+
+
+@analytics_cli.command('rebuild')
+@click.option('--chunk-size', default=100000, show_default=True)
+def rebuild_analytics(chunk_size):
+    """Recomputes all rollups from scratch"""
+    started = time.perf_counter()
+    counted = analytics.rebuild(chunk_size=chunk_size)
+    click.echo('Rebuilt rollups from %d loans in %.1fs' % (counted, time.perf_counter() - started))
+
+
+@recommendations_cli.command('refresh')
+@click.option('--batch-size', default=10000, show_default=True)
+def refresh_recommendations(batch_size):
+    """Counts new loans into the co-borrowing lists; run it periodically"""
+    started = time.perf_counter()
+    counted = recommendations.refresh(batch_size=batch_size)
+    click.echo('Counted %d new loans in %.1fs' % (counted, time.perf_counter() - started))
+
+
+@recommendations_cli.command('rebuild')
+@click.option('--chunk-size', default=100000, show_default=True)
+@click.option('--partitions', default=4, show_default=True,
+              help='Passes over the loans, each counting one range of books; more passes use less memory.')
+@click.option('--pair-budget', default=5000000, show_default=True,
+              help='Pairs expanded at a time.')
+def rebuild_recommendations(chunk_size, partitions, pair_budget):
+    """Recomputes all co-borrowing counts and lists from scratch"""
+    started = time.perf_counter()
+    stored = recommendations.rebuild(chunk_size=chunk_size, partitions=partitions, pair_budget=pair_budget)
+    click.echo('Stored %d book pairs in %.1fs' % (stored, time.perf_counter() - started))
+
+
+@loans_cli.command('overdue')
+@click.option('--loop', is_flag=True, help='Keep running every --interval seconds.')
+@click.option('--interval', default=3600, show_default=True)
+def process_overdue_loans(loop, interval):
+    """Fines overdue loans and sends each borrower one notice"""
+    from app.overdue import OverdueScheduler, run_overdue_job
+    app = current_app._get_current_object()
+    if not loop:
+        seen, sent = run_overdue_job(app)
+        click.echo('%d overdue loans, %d notified' % (seen, sent))
+        return
+    scheduler = OverdueScheduler(app, interval=interval)
+    scheduler.start()
+    try:
+        while scheduler._thread.is_alive():
+            scheduler._thread.join(1)
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+
+@audit_cli.command('prune')
+@click.option('--days', type=int, default=None, help='Keep this many days (AUDIT_RETENTION_DAYS, 365).')
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--archive', type=click.Path(dir_okay=False), help='Append pruned rows to this JSONL file first.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+def prune_logs(days, batch_size, archive, pause):
+    """Deletes audit log rows past the retention window"""
+    if days is None:
+        days = current_app.config.get('AUDIT_RETENTION_DAYS', 365)
+    deleted = audit.prune(days, batch_size=batch_size, archive_path=archive, pause=pause)
+    click.echo('Deleted %d log rows older than %d days' % (deleted, days))
+
+
+@audit_cli.command('replay')
+@click.argument('path', required=False, type=click.Path(dir_okay=False))
+def replay_logs(path):
+    """Loads events spilled to disk (AUDIT_SPILL_PATH) into the logs table"""
+    path = path or current_app.config.get('AUDIT_SPILL_PATH')
+    if not path:
+        raise click.UsageError('No spill file given and AUDIT_SPILL_PATH is not set')
+    click.echo('Replayed %d audit events' % audit.replay_spill(path))
+
+
+@holds_cli.command('expire')
+@click.option('--batch-size', default=500, show_default=True)
+def expire_ready_holds(batch_size):
+    """Expires uncollected ready holds and passes their copies down the line"""
+    expired, book_ids = expire_holds(batch_size=batch_size)
+    invalidate_books(*book_ids)
+    click.echo('Expired %d holds on %d books' % (expired, len(book_ids)))
+
+
+@sessions_cli.command('prune')
+def prune_sessions():
+    """Deletes expired sessions"""
+    click.echo('Deleted %d expired sessions' % sessions.prune())
+
+
+@sessions_cli.command('revoke')
+@click.argument('email')
+def revoke_sessions(email):
+    """Signs the account(s) with this email out everywhere"""
+    from app.auth import find_accounts
+    accounts = find_accounts(email)
+    if not accounts:
+        raise click.UsageError('No account with email %s' % email)
+    for account in accounts:
+        click.echo('Revoked %d %s sessions' % (sessions.revoke_account(account.id, account.is_admin),
+                                               'admin' if account.is_admin else 'user'))
+
+
+def _branch(code):
+    branch = db.session.scalar(select(Branch).where(Branch.code == code))
+    if branch is None:
+        raise click.UsageError('No branch with code %s' % code)
+    return branch
+
+
+@stock_cli.command('add-branch')
+@click.argument('code')
+@click.argument('name')
+def add_branch(code, name):
+    """Opens a branch; move copies to it with 'flask stock move'"""
+    branch = Branch(code=code, name=name)
+    db.session.add(branch)
+    db.session.commit()
+    click.echo('Added branch %s (#%d)' % (code, branch.id))
+
+
+@stock_cli.command('move')
+@click.argument('book_id', type=int)
+@click.argument('from_code')
+@click.argument('to_code')
+@click.option('--copies', default=1, show_default=True)
+def move_stock(book_id, from_code, to_code, copies):
+    """Moves shelved copies of a book from one branch to another"""
+    moved = stock.move_copies(book_id, _branch(from_code).id, _branch(to_code).id, copies)
+    click.echo('Moved %d of %d copies' % (moved, copies))
+
+
+@stock_cli.command('stripe')
+@click.argument('book_id', type=int)
+@click.option('--stripes', default=8, show_default=True, help='Rows per branch; 1 merges them again.')
+def stripe_stock(book_id, stripes):
+    """Splits a busy book's stock so concurrent borrows update different rows"""
+    if stripes < 1:
+        raise click.UsageError('--stripes must be at least 1')
+    copies = stock.restripe(book_id, stripes)
+    click.echo('Spread %d copies over %d stripes per branch' % (copies, stripes))
+
+
+@stock_cli.command('reconcile')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--pause', type=float, help='Seconds to sleep between batches. Defaults to BACKFILL_PAUSE.')
+def reconcile_stock(batch_size, pause):
+    """Recounts every book's availability from the branch shelves.
+
+    An interrupted run picks up from the last batch it finished.
+    """
+    started = time.perf_counter()
+    fixed = stock.reconcile(batch_size=batch_size, pause=pause, report=lambda line: click.echo(line, err=True))
+    click.echo('Corrected %d books in %.1fs' % (fixed, time.perf_counter() - started))
@@ -0,0 +1,207 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+
+REPLICA_PREFIX = 'replica'
+# Upper bounds (seconds) of the checkout wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * len(WAIT_BUCKETS)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_sum += waited
+                self.wait_max = max(self.wait_max, waited)
+                for i, bound in enumerate(WAIT_BUCKETS):
+                    if waited <= bound:
+                        self.wait_buckets[i] += 1
+                        break
+
+    def stats(self):
+        capacity = self.size() + max(0, self._max_overflow)
+        with self._stats_lock:
+            return {
+                'size': self.size(),
+                'max_overflow': self._max_overflow,
+                'checked_out': self.checkedout(),
+                'idle': self.checkedin(),
+                'saturation': self.checkedout() / capacity if capacity else None,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds': {
+                    'sum': self.wait_sum,
+                    'max': self.wait_max,
+                    'buckets': dict(zip(['le_%s' % bound for bound in WAIT_BUCKETS], self.wait_buckets))
+                }
+            }
+
+
+def engine_options(config, url):
+    """Pool settings from DB_POOL_* config for one database URL"""
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # In-memory SQLite lives in a single connection; leave it alone
+        return {}
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': config.get('DB_POOL_SIZE', 10),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 5),
+        # Below MySQL's default wait_timeout so idle connections are never
+        # handed out after the server dropped them
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True)
+    }
+
+
+def configure_engines(app):
+    """Fills in engine options and replica binds before db.init_app(app)"""
+    config = app.config
+    options = engine_options(config, config['SQLALCHEMY_DATABASE_URI'])
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+    for i, url in enumerate(config.get('DB_REPLICA_URIS') or ()):
+        binds['%s%d' % (REPLICA_PREFIX, i)] = dict(engine_options(config, url), url=url)
+    config['SQLALCHEMY_BINDS'] = binds
+
+
+def replica_keys(engines):
+    return sorted(key for key in engines if key and key.startswith(REPLICA_PREFIX))
+
+
+# -- routing ------------------------------------------------------------------
+
+def read_only(f):
+    """Lets a view's SELECTs go to a read replica.
+
+    The replica is picked once per request. Readers who wrote something in
+    the last DB_STICKY_SECONDS stay on the primary so they see their own
+    writes despite replication lag.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        keys = replica_keys(current_app.extensions['sqlalchemy'].engines)
+        if keys and session.get('rw_until', 0) < time.time():
+            g.db_replica = random.choice(keys)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@contextmanager
+def on_primary():
+    """Sends the SELECTs inside to the primary, even in a read_only view.
+
+    For loaders that fill the shared cache: writes invalidate it when the
+    primary commits, so a value read from a lagging replica just after
+    would put the old row back for every reader until it expires.
+    """
+    replica = g.pop('db_replica', None) if has_request_context() else None
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.db_replica = replica
+
+
+class RoutingSession(Session):
+    """Sends SELECTs of read_only views to their replica, everything else to
+    the primary"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and isinstance(clause, Select) and not self._flushing and has_request_context():
+            key = g.get('db_replica')
+            if key is not None:
+                return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _note_write(state):
+    if not state.is_select:
+        state.session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _note_flush(db_session, flush_context):
+    db_session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stick_to_primary(db_session):
+    # Read-your-writes: keep this browser on the primary for a while
+    if db_session.info.pop('wrote', False) and has_request_context():
+        session['rw_until'] = time.time() + current_app.config.get('DB_STICKY_SECONDS', 10)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_write(db_session):
+    db_session.info.pop('wrote', None)
+
+
+# -- health -------------------------------------------------------------------
+
+def health(engines):
+    """Round trip time, pool state and (MySQL) replication lag per engine"""
+    report = {}
+    for key, engine in sorted(engines.items(), key=lambda item: item[0] or ''):
+        entry = {'url': engine.url.render_as_string(hide_password=True)}
+        started = time.perf_counter()
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+                entry['ok'] = True
+                entry['latency_ms'] = (time.perf_counter() - started) * 1000
+                if key and engine.dialect.name == 'mysql':
+                    entry['lag_seconds'] = _replica_lag(connection)
+        except Exception as e:
+            entry['ok'] = False
+            entry['error'] = str(e)
+        if isinstance(engine.pool, TimedQueuePool):
+            entry['pool'] = engine.pool.stats()
+        report[key or 'primary'] = entry
+    return report
+
+
+def _replica_lag(connection):
+    for statement in ('SHOW REPLICA STATUS', 'SHOW SLAVE STATUS'):
+        try:
+            row = connection.execute(text(statement)).mappings().first()
+        except Exception:
+            continue
+        if row is None:
+            return None
+        return row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+    return None
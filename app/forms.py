@@ -0,0 +1,49 @@
+BOOK_FIELDS = ('title', 'author', 'genre', 'availability', 'publisher', 'year')
+OPTIONAL_FIELDS = ('genre', 'publisher', 'year')
+
+
+def clean_book_fields(data):
+    """Validates submitted book fields and returns them ready for Book(**fields).
+
+    ``data`` is any mapping with ``.get`` (a request form, a CSV row, a
+    decoded JSON object). Raises ValueError with a message fit to show the
+    user when a field is invalid. A missing or empty availability, and a
+    genre, publisher or year that is not in ``data`` at all, are left out,
+    so a new Book gets the column default and an update leaves them as
+    they are.
+    """
+    availability_input = data.get('availability')
+    year_input = data.get('year')
+
+    # Convert availability to int
+    try:
+        availability = int(availability_input) if availability_input not in (None, '') else None
+    except (TypeError, ValueError):
+        raise ValueError("Availability must be a valid number.")
+
+    # Convert year to int
+    try:
+        year = int(year_input) if year_input not in (None, '') else None
+    except (TypeError, ValueError):
+        raise ValueError("Year must be a valid number.")
+
+    title = data.get('title')
+    author = data.get('author')
+    if not title or not author:
+        raise ValueError("Title and author are required.")
+
+    fields = {
+        'title': title,
+        'author': author,
+        'genre': data.get('genre'),
+        'availability': availability,
+        'publisher': data.get('publisher'),
+        'year': year
+    }
+    if availability is None:
+        del fields['availability']
+    # A feed without one of these columns leaves it as it is
+    for name in OPTIONAL_FIELDS:
+        if name not in data:
+            del fields[name]
+    return fields
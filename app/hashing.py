@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import bcrypt as bcrypt_lib
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing queue is full, or a hash took longer than the
+    timeout, and the caller should back off"""
+
+
+# Worker functions run in the pool processes, so they must stay importable
+# module-level functions that only need bcrypt.
+
+def _hash(password, rounds):
+    return bcrypt_lib.hashpw(password.encode('utf-8'), bcrypt_lib.gensalt(rounds)).decode('utf-8')
+
+
+def _check(password_hash, password):
+    try:
+        return bcrypt_lib.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
+
+def hash_rounds(password_hash):
+    """Work factor a bcrypt hash was made with ('$2b$12$...' -> 12)"""
+    try:
+        return int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded process pool instead of on request workers.
+
+    At a realistic work factor one hash pins a CPU for a few hundred ms, so
+    calls are handed to a pool of ``pool_size`` processes and the request
+    thread only waits on the result. At most ``max_queue`` calls may be in
+    flight; beyond that callers get HasherBusy straight away instead of
+    queueing behind a login burst. ``pool_size=0`` hashes inline.
+    """
+
+    def __init__(self, app=None, rounds=12, pool_size=None, max_queue=None, timeout=30):
+        self.configure(rounds, pool_size, max_queue, timeout)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(
+            rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+            pool_size=app.config.get('HASHER_POOL_SIZE'),
+            max_queue=app.config.get('HASHER_MAX_QUEUE'),
+            timeout=app.config.get('HASHER_TIMEOUT', 30)
+        )
+        app.extensions['hasher'] = self
+
+    def configure(self, rounds=12, pool_size=None, max_queue=None, timeout=30):
+        self.shutdown()
+        self.rounds = rounds
+        self.pool_size = (os.cpu_count() or 1) if pool_size is None else pool_size
+        self.max_queue = max_queue or max(1, self.pool_size) * 4
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+        self._latency = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+
+    def shutdown(self):
+        executor = getattr(self, '_executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _pool(self):
+        # Created on first use so every server process gets its own pool
+        # after forking, and with 'spawn' so workers never inherit locks
+        # held by request threads.
+        if self._executor is None:
+            # Imported here: CLI runs and inline hashing never start a pool
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.pool_size,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+        return self._executor
+
+    def _record(self, started):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._in_flight -= 1
+            latency = self._latency
+            latency['count'] += 1
+            latency['sum'] += elapsed
+            latency['max'] = max(latency['max'], elapsed)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    latency['buckets'][i] += 1
+                    break
+
+    def submit(self, fn, *args):
+        """Queues fn(*args) on the pool and returns a Future"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise HasherBusy()
+        with self._lock:
+            self._in_flight += 1
+        started = time.perf_counter()
+
+        def done(_future):
+            self._record(started)
+            self._slots.release()
+
+        if self.pool_size == 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            done(future)
+            return future
+        future = self._pool().submit(fn, *args)
+        future.add_done_callback(done)
+        return future
+
+    def submit_hash(self, password):
+        return self.submit(_hash, password, self.rounds)
+
+    def wait(self, future):
+        """The result of a submitted call, waiting at most ``timeout``
+        seconds. Raises HasherBusy when the pool is too backed up for that."""
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise HasherBusy()
+
+    def hash_password(self, password):
+        return self.wait(self.submit_hash(password))
+
+    def check_password(self, password_hash, password):
+        return self.wait(self.submit(_check, password_hash, password))
+
+    def needs_rehash(self, password_hash):
+        return hash_rounds(password_hash) != self.rounds
+
+    def metrics(self):
+        with self._lock:
+            latency = dict(self._latency, buckets=dict(zip(
+                ['le_%s' % bound for bound in LATENCY_BUCKETS], self._latency['buckets'])))
+            return {
+                'pool_size': self.pool_size,
+                'rounds': self.rounds,
+                'queue_depth': self._in_flight,
+                'max_queue': self.max_queue,
+                'rejected': self._rejected,
+                'latency_seconds': latency
+            }
+
+
+hasher = PasswordHasher()
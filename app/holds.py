@@ -0,0 +1,325 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from blinker import Namespace
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, select, update
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.database import RoutingSession
+from app.models import Book, Hold, User
+from app.stock import claim_copy, release_copies
+
+logger = logging.getLogger(__name__)
+
+HOLD_PICKUP_DAYS = 3
+OPEN = ('waiting', 'ready')
+
+signals = Namespace()
+# Sent once the transaction that set a copy aside has committed, with
+# hold_id, book_id, user_id, email, first_name, title and expires_at
+hold_ready = signals.signal('hold-ready')
+
+
+class AlreadyHolding(Exception):
+    """Raised when the user already has an open hold on the book"""
+
+
+class NoSuchHold(Exception):
+    """Raised when a hold does not exist, belongs to someone else or is
+    no longer open"""
+
+
+def init_app(app):
+    """Sends this app's ready holds through the notification sink"""
+    notices.init_app(app)
+    hold_ready.connect(notify_hold_ready, app)
+
+
+# -- queue operations ---------------------------------------------------------
+
+def place_hold(book_id, user_id):
+    """Puts the user at the back of the book's line and commits.
+
+    A copy that is already free is handed over straight away, so the hold
+    may come back 'ready'.
+    """
+    existing = db.session.scalar(
+        select(Hold.id).where(Hold.user_id == user_id, Hold.status.in_(OPEN), Hold.book_id == book_id)
+    )
+    if existing is not None:
+        db.session.rollback()
+        raise AlreadyHolding(book_id)
+    hold = Hold(book_id=book_id, user_id=user_id, status='waiting', created_at=datetime.now())
+    db.session.add(hold)
+    db.session.flush()
+    allocate(book_id)
+    db.session.commit()
+    return hold
+
+
+def allocate(book_id):
+    """Sets free copies of a book aside for the oldest waiting holds.
+
+    Runs inside the caller's transaction after a copy came back (a return,
+    a cancelled or expired ready hold, a new hold, copies added or moved by
+    app/stock.py). Each step takes the head
+    of the line through the (book_id, status, id) index and claims a copy
+    from a branch with claim_copy(), as a borrow does, so a copy is never
+    given out twice. Returns the number of holds made ready.
+    """
+    allocated = 0
+    while True:
+        head = db.session.execute(
+            select(Hold.id, Hold.user_id, User.email, User.first_name, Book.title)
+            .join(User, User.id == Hold.user_id)
+            .join(Book, Book.id == Hold.book_id)
+            .where(Hold.book_id == book_id, Hold.status == 'waiting')
+            .order_by(Hold.id)
+            .limit(1)
+            .with_for_update(skip_locked=True, of=Hold)
+        ).first()
+        if head is None:
+            return allocated
+
+        branch_id = claim_copy(book_id)
+        if branch_id is None:
+            return allocated
+
+        now = datetime.now()
+        expires_at = now + timedelta(days=current_app.config.get('HOLD_PICKUP_DAYS', HOLD_PICKUP_DAYS))
+        made_ready = db.session.execute(
+            update(Hold).where(Hold.id == head.id, Hold.status == 'waiting')
+            .values(status='ready', ready_at=now, expires_at=expires_at, branch_id=branch_id)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not made_ready:
+            # Cancelled since we read it: put the copy back, try the next
+            release_copies(book_id, branch_id)
+            continue
+        db.session.info.setdefault('holds_ready', []).append(dict(
+            hold_id=head.id, book_id=book_id, user_id=head.user_id, email=head.email,
+            first_name=head.first_name, title=head.title, expires_at=expires_at
+        ))
+        allocated += 1
+
+
+def has_waiting_holds(book_id):
+    """True while readers are in the book's line; one seek on the
+    (book_id, status, id) index"""
+    return db.session.scalar(
+        select(Hold.id).where(Hold.book_id == book_id, Hold.status == 'waiting').limit(1)
+    ) is not None
+
+
+def claim_ready_hold(book_id, user_id):
+    """Turns the user's ready hold on the book into a loan's copy.
+
+    Called by borrow_copy inside its transaction. Returns the hold (its id
+    and branch_id) when a copy was already set aside, so no other copy
+    must be taken, otherwise None.
+    """
+    hold = db.session.execute(
+        select(Hold.id, Hold.branch_id)
+        .where(Hold.user_id == user_id, Hold.status == 'ready', Hold.book_id == book_id)
+    ).first()
+    if hold is None:
+        return None
+    fulfilled = db.session.execute(
+        update(Hold).where(Hold.id == hold.id, Hold.status == 'ready')
+        .values(status='fulfilled')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    return hold if fulfilled else None
+
+
+def cancel_hold(hold_id, user_id=None):
+    """Takes a hold out of line and commits; a copy set aside for it goes to
+    the next holder. Pass ``user_id`` to only allow that user's holds.
+    Returns the book id."""
+    hold = db.session.execute(
+        select(Hold.book_id, Hold.user_id, Hold.status, Hold.branch_id).where(Hold.id == hold_id)
+    ).first()
+    if hold is None or hold.status not in OPEN or (user_id is not None and hold.user_id != user_id):
+        db.session.rollback()
+        raise NoSuchHold(hold_id)
+    cancelled = db.session.execute(
+        update(Hold).where(Hold.id == hold_id, Hold.status == hold.status)
+        .values(status='cancelled')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not cancelled:
+        db.session.rollback()
+        raise NoSuchHold(hold_id)
+    if hold.status == 'ready':
+        release_copies(hold.book_id, hold.branch_id)
+        allocate(hold.book_id)
+    db.session.commit()
+    return hold.book_id
+
+
+def expire_holds(now=None, batch_size=500):
+    """Expires ready holds nobody picked up in time and passes their copies
+    down the line, one batch per transaction. Returns the number expired
+    and the ids of the books involved."""
+    now = now or datetime.now()
+    expired = 0
+    book_ids = set()
+    while True:
+        rows = db.session.execute(
+            select(Hold.id, Hold.book_id, Hold.branch_id)
+            .where(Hold.status == 'ready', Hold.expires_at < now)
+            .order_by(Hold.expires_at, Hold.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not rows:
+            db.session.rollback()
+            return expired, book_ids
+        db.session.execute(
+            update(Hold).where(Hold.id.in_([row.id for row in rows]), Hold.status == 'ready')
+            .values(status='expired')
+            .execution_options(synchronize_session=False)
+        )
+        for (book_id, branch_id), count in Counter((row.book_id, row.branch_id) for row in rows).items():
+            release_copies(book_id, branch_id, count)
+        for book_id in {row.book_id for row in rows}:
+            allocate(book_id)
+        db.session.commit()
+        expired += len(rows)
+        book_ids.update(row.book_id for row in rows)
+
+
+# -- reads --------------------------------------------------------------------
+
+def holds_with_positions(user_id):
+    """The user's open holds with their place in line (None once ready), in
+    one statement: each position is an index range count"""
+    ahead = aliased(Hold)
+    position = (
+        select(func.count(ahead.id))
+        .where(ahead.book_id == Hold.book_id, ahead.status == 'waiting', ahead.id <= Hold.id)
+        .correlate(Hold)
+        .scalar_subquery()
+    )
+    rows = db.session.execute(
+        select(Hold, Book.title, Book.author, position)
+        .join(Book, Book.id == Hold.book_id)
+        .where(Hold.user_id == user_id, Hold.status.in_(OPEN))
+        .order_by(Hold.id)
+    ).all()
+    return [(hold, title, author, count if hold.status == 'waiting' else None)
+            for hold, title, author, count in rows]
+
+
+def queue_position(hold):
+    return db.session.scalar(
+        select(func.count(Hold.id))
+        .where(Hold.book_id == hold.book_id, Hold.status == 'waiting', Hold.id <= hold.id)
+    )
+
+
+# -- notifications ------------------------------------------------------------
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _announce_ready(db_session):
+    ready = db_session.info.pop('holds_ready', None)
+    if not ready or not has_app_context():
+        return
+    app = current_app._get_current_object()
+    for hold in ready:
+        hold_ready.send(app, **hold)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_ready(db_session):
+    db_session.info.pop('holds_ready', None)
+
+
+def notify_hold_ready(app, **hold):
+    """Queues the holder's notice that their copy is waiting"""
+    notices.add({
+        'key': 'hold-ready-%d' % hold['hold_id'],
+        'hold_id': hold['hold_id'],
+        'email': hold['email'],
+        'subject': 'Ready for pickup: %s' % hold['title'],
+        'body': 'Hi %s,\n\nA copy of "%s" is being held for you until %s.\n'
+                % (hold['first_name'], hold['title'], hold['expires_at'].strftime('%Y-%m-%d %H:%M'))
+    })
+
+
+class HoldNotices:
+    """Sends hold-ready notices through OVERDUE_SINK off the request thread.
+
+    The commit that made a hold ready only queues its notice. A background
+    thread sends whatever has queued every ``interval`` seconds as one
+    batch, so a slow or unreachable mail server never holds up a return or
+    an edit. With ``interval`` 0 (scripts, tests) notices are sent right
+    after the commit. Best effort: a batch that fails, or is still queued
+    when the process dies, is logged and dropped, and the hold stays ready
+    on the holder's holds page until it expires.
+    """
+
+    def __init__(self, app=None, interval=0):
+        self.app = None
+        self.interval = interval
+        self._pending = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('HOLD_NOTICE_INTERVAL', 1.0)
+        app.extensions['hold_notices'] = self
+        atexit.register(self.flush)
+
+    def add(self, notification):
+        if not self.interval:
+            self._send([notification])
+            return
+        self._ensure_thread()
+        with self._lock:
+            self._pending.append(notification)
+
+    def _ensure_thread(self):
+        # Started lazily so each forked server process gets its own thread
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._pending = []
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='hold-notices', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Sends the queued notices now"""
+        with self._lock:
+            notifications, self._pending = self._pending, []
+        if notifications:
+            self._send(notifications)
+
+    def _send(self, notifications):
+        from app.overdue import sink_from_config
+        try:
+            sink_from_config(self.app.config).send_many(notifications)
+        except Exception:
+            logger.exception('Could not send hold notices %s',
+                             ', '.join(notification['key'] for notification in notifications))
+
+
+notices = HoldNotices()
@@ -0,0 +1,354 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+from flask import Response, g, has_request_context, request
+from flask import request_finished, request_started
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+MAX_PATTERNS = 200
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram per label set"""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+                break
+        series['sum'] += value
+        series['count'] += 1
+
+    def summary(self, labels):
+        series = self._series.get(labels)
+        return (series['sum'], series['count']) if series else (0.0, 0)
+
+    def label_sets(self):
+        return list(self._series)
+
+    def render(self, label_names):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for labels, series in sorted(self._series.items()):
+            base = _labels(label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['buckets']):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, base, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, base, series['count']))
+            lines.append('%s_sum{%s} %s' % (self.name, base, repr(series['sum'])))
+            lines.append('%s_count{%s} %d' % (self.name, base, series['count']))
+        return lines
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in zip(names, values))
+
+
+def _metric(name, kind, help, samples):
+    """Renders a counter or gauge from [(label_string, value)]"""
+    lines = ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind)]
+    for labels, value in samples:
+        lines.append('%s{%s} %s' % (name, labels, value) if labels else '%s %s' % (name, value))
+    return lines
+
+
+class RequestStats:
+    __slots__ = ('started', 'db_time', 'queries', 'statements', 'samples')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.queries = 0
+        self.statements = Counter()
+        self.samples = None
+
+
+class Instrumentation:
+    """Per-request timing, SQL counting and N+1 detection.
+
+    Every request records wall time, time spent in the database and the
+    number of queries, aggregated per endpoint into histograms served at
+    /metrics in Prometheus text format. A request that runs the same
+    statement ``N_PLUS_ONE_THRESHOLD`` times or more (typically a lazy
+    relationship loaded in a loop) is logged and counted as an N+1 pattern.
+
+    With ``PROFILER_ENABLED`` a background thread samples the stacks of
+    in-flight requests every ``PROFILER_INTERVAL`` seconds and writes the
+    ones slower than ``SLOW_REQUEST_SECONDS`` to ``PROFILER_DIR`` as folded
+    stacks, ready for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._collectors = []
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def _reset(self):
+        self.request_seconds = Histogram('library_request_duration_seconds',
+                                         'Wall time of requests', SECONDS_BUCKETS)
+        self.db_seconds = Histogram('library_request_db_seconds',
+                                    'Time per request spent waiting on SQL', SECONDS_BUCKETS)
+        self.query_counts = Histogram('library_request_queries',
+                                      'SQL statements per request', QUERY_BUCKETS)
+        self.responses = Counter()
+        self.n_plus_one = Counter()
+        self.patterns = OrderedDict()
+
+    def init_app(self, app):
+        self.slow_seconds = app.config.get('SLOW_REQUEST_SECONDS', 0.5)
+        self.n_plus_one_threshold = app.config.get('N_PLUS_ONE_THRESHOLD', 5)
+        self.profiler_interval = app.config.get('PROFILER_INTERVAL', 0.005)
+        self.profiler_dir = app.config.get('PROFILER_DIR') or os.path.join(app.instance_path, 'profiles')
+        self.profiling = app.config.get('PROFILER_ENABLED', False)
+        self._active = {}
+
+        # Engine-class listeners see every engine, including ones created
+        # later; init_app may run once per app, so register only once
+        if not event.contains(Engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        request_started.connect(self._request_started, app, weak=False)
+        request_finished.connect(self._request_finished, app, weak=False)
+        if app.config.get('METRICS_ENABLED', True):
+            app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+        if self.profiling:
+            self._start_sampler()
+        app.extensions['instrumentation'] = self
+
+    def add_collector(self, collect):
+        """Registers a callable returning extra Prometheus lines for /metrics"""
+        self._collectors.append(collect)
+
+    # -- request lifecycle ------------------------------------------------------
+
+    def _request_started(self, sender, **extra):
+        stats = g._request_stats = RequestStats()
+        if self.profiling:
+            stats.samples = Counter()
+            self._active[threading.get_ident()] = stats
+
+    def _request_finished(self, sender, response, **extra):
+        stats = g.pop('_request_stats', None)
+        if stats is None:
+            return
+        elapsed = time.perf_counter() - stats.started
+        if self.profiling:
+            self._active.pop(threading.get_ident(), None)
+        endpoint = request.endpoint or 'unmatched'
+        labels = (endpoint, request.method)
+        repeated = [(statement, count) for statement, count in stats.statements.items()
+                    if count >= self.n_plus_one_threshold]
+
+        with self._lock:
+            self.request_seconds.observe(labels, elapsed)
+            self.db_seconds.observe(labels, stats.db_time)
+            self.query_counts.observe(labels, stats.queries)
+            self.responses[labels + (response.status_code,)] += 1
+            if repeated:
+                self.n_plus_one[labels] += 1
+            for statement, count in repeated:
+                key = (endpoint, statement)
+                pattern = self.patterns.pop(key, None) or {'requests': 0, 'max_repeats': 0}
+                pattern['requests'] += 1
+                pattern['max_repeats'] = max(pattern['max_repeats'], count)
+                self.patterns[key] = pattern
+                if len(self.patterns) > MAX_PATTERNS:
+                    self.patterns.popitem(last=False)
+                if pattern['requests'] == 1:
+                    logger.warning('Possible N+1 in %s: %d x %s', endpoint, count, statement[:300])
+
+        if stats.samples and elapsed >= self.slow_seconds:
+            self._dump_profile(endpoint, elapsed, stats.samples)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context so a failed statement leaves nothing behind
+        context._query_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = g.get('_request_stats') if has_request_context() else None
+        if stats is not None:
+            stats.db_time += time.perf_counter() - context._query_started
+            stats.queries += 1
+            # Statements are parameterised, so an N+1 loop repeats one string
+            stats.statements[statement] += 1
+
+    # -- sampling profiler ------------------------------------------------------
+
+    def _start_sampler(self):
+        thread = threading.Thread(target=self._sample_forever, name='request-profiler', daemon=True)
+        thread.start()
+
+    def _sample_forever(self):
+        while True:
+            time.sleep(self.profiler_interval)
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            for ident, stats in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is not None and stats.samples is not None:
+                    stats.samples[_fold(frame)] += 1
+
+    def _dump_profile(self, endpoint, elapsed, samples):
+        os.makedirs(self.profiler_dir, exist_ok=True)
+        path = os.path.join(self.profiler_dir, '%s-%s-%dms.folded' % (
+            datetime.now().strftime('%Y%m%dT%H%M%S.%f'), endpoint.replace('.', '_'), elapsed * 1000))
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write('%s %d\n' % (stack, count))
+        logger.info('Slow request %s (%.0f ms) profiled to %s', endpoint, elapsed * 1000, path)
+
+    # -- reporting --------------------------------------------------------------
+
+    def report(self):
+        """Per-endpoint averages and the N+1 patterns seen, as plain data"""
+        with self._lock:
+            endpoints = {}
+            for labels in self.request_seconds.label_sets():
+                total, count = self.request_seconds.summary(labels)
+                db_total, _ = self.db_seconds.summary(labels)
+                queries, _ = self.query_counts.summary(labels)
+                endpoints['%s %s' % (labels[1], labels[0])] = {
+                    'requests': count,
+                    'avg_ms': total * 1000 / count,
+                    'avg_db_ms': db_total * 1000 / count,
+                    'avg_queries': queries / count,
+                    'n_plus_one_requests': self.n_plus_one.get(labels, 0)
+                }
+            patterns = [dict(pattern, endpoint=endpoint, statement=statement)
+                        for (endpoint, statement), pattern in reversed(self.patterns.items())]
+        return {'endpoints': endpoints, 'n_plus_one': patterns}
+
+    def render_metrics(self):
+        names = ('endpoint', 'method')
+        with self._lock:
+            lines = self.request_seconds.render(names)
+            lines += self.db_seconds.render(names)
+            lines += self.query_counts.render(names)
+            lines += _metric('library_responses_total', 'counter', 'Responses by status', [
+                (_labels(names + ('status',), labels), count) for labels, count in sorted(self.responses.items())
+            ])
+            lines += _metric('library_n_plus_one_requests_total', 'counter',
+                             'Requests that repeated one SQL statement at least N_PLUS_ONE_THRESHOLD times', [
+                                 (_labels(names, labels), count) for labels, count in sorted(self.n_plus_one.items())
+                             ])
+        for collect in self._collectors:
+            try:
+                lines += collect()
+            except Exception:
+                logger.exception('Metrics collector %r failed', collect)
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        return Response(self.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def _fold(frame):
+    """'outer;...;inner' stack of a frame, the format flame graph tools read"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# Gauges for the other extensions' counters
+
+def cache_metrics():
+    from app.cache import cache
+    stats = cache.stats()
+    lines = _metric('library_cache_entries', 'gauge', 'Entries in the read-through cache',
+                    [('backend="%s"' % stats['backend'], stats['entries'] or 0)])
+    for kind in ('hits', 'misses'):
+        lines += _metric('library_cache_%s_total' % kind, 'counter', 'Cache %s by key namespace' % kind, [
+            ('namespace="%s"' % namespace, counts[kind]) for namespace, counts in sorted(stats['namespaces'].items())
+        ])
+    return lines
+
+
+def hasher_metrics():
+    from app.hashing import hasher
+    metrics = hasher.metrics()
+    return (
+        _metric('library_hasher_queue_depth', 'gauge', 'Password hashes in flight', [('', metrics['queue_depth'])])
+        + _metric('library_hasher_rejected_total', 'counter', 'Hash requests refused while the queue was full',
+                  [('', metrics['rejected'])])
+    )
+
+
+def audit_metrics():
+    from app.audit import audit
+    metrics = audit.metrics()
+    lines = _metric('library_audit_queue_depth', 'gauge', 'Audit events waiting to be written',
+                    [('', metrics['queue_depth'])])
+    for kind in ('written', 'spilled', 'refused', 'dropped'):
+        lines += _metric('library_audit_%s_total' % kind, 'counter', 'Audit events %s' % kind,
+                         [('', metrics[kind])])
+    return lines
+
+
+def ratelimit_metrics():
+    from app.ratelimit import limiter
+    metrics = limiter.metrics()
+    lines = _metric('library_ratelimit_keys', 'gauge', 'Rate limit buckets held',
+                    [('store="%s"' % metrics['store'], metrics['keys'])])
+    for kind in ('allowed', 'limited'):
+        lines += _metric('library_ratelimit_%s_total' % kind, 'counter', 'Requests %s by rate limit' % kind, [
+            ('limit="%s"' % name, counts[kind]) for name, counts in sorted(metrics['limits'].items())
+        ])
+    lines += _metric('library_ratelimit_store_errors_total', 'counter',
+                     'Checks let through because the store failed', [('', metrics['errors'])])
+    return lines
+
+
+def db_pool_metrics():
+    from app import db
+    from app.database import WAIT_BUCKETS, TimedQueuePool
+    pools = [(key or 'primary', engine.pool) for key, engine in sorted(db.engines.items(), key=lambda item: item[0] or '')
+             if isinstance(engine.pool, TimedQueuePool)]
+    stats = [(key, pool.stats()) for key, pool in pools]
+    lines = []
+    for name, field, kind, help in (
+            ('library_db_pool_checked_out', 'checked_out', 'gauge', 'Connections in use'),
+            ('library_db_pool_size', 'size', 'gauge', 'Connections kept open by the pool'),
+            ('library_db_pool_saturation', 'saturation', 'gauge', 'Checked out share of size plus overflow'),
+            ('library_db_pool_timeouts_total', 'timeouts', 'counter', 'Checkouts that gave up waiting')):
+        lines += _metric(name, kind, help, [('bind="%s"' % key, values[field]) for key, values in stats])
+    lines += ['# HELP library_db_pool_wait_seconds Time spent waiting for a pooled connection',
+              '# TYPE library_db_pool_wait_seconds histogram']
+    for key, values in stats:
+        cumulative = 0
+        for bound, count in zip(WAIT_BUCKETS, values['wait_seconds']['buckets'].values()):
+            cumulative += count
+            lines.append('library_db_pool_wait_seconds_bucket{bind="%s",le="%s"} %d'
+                         % (key, '+Inf' if bound == float('inf') else bound, cumulative))
+        lines.append('library_db_pool_wait_seconds_sum{bind="%s"} %r' % (key, values['wait_seconds']['sum']))
+        lines.append('library_db_pool_wait_seconds_count{bind="%s"} %d' % (key, values['checkouts']))
+    return lines
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,122 @@
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+
+from app import db
+from app.analytics import record_borrow, record_return
+from app.holds import allocate, claim_ready_hold, has_waiting_holds
+from app.models import BookLoan
+from app.stock import claim_copy, release_copies
+
+LOAN_DAYS = 7
+
+# MySQL deadlock and lock wait timeout errors; both are safe to retry
+RETRYABLE_MYSQL_ERRORS = {1205, 1213}
+
+
+class NoCopiesLeft(Exception):
+    """Raised when a book has no copy left to lend (or does not exist)"""
+
+
+class NotOnLoan(Exception):
+    """Raised when a loan does not exist, belongs to someone else or was
+    already returned"""
+
+
+def is_retryable(error):
+    """True for lock conflicts that a fresh attempt of the transaction can win"""
+    orig = getattr(error, 'orig', None)
+    args = getattr(orig, 'args', None)
+    if args and args[0] in RETRYABLE_MYSQL_ERRORS:
+        return True
+    # SQLite reports a busy database instead of a deadlock
+    return 'database is locked' in str(orig)
+
+
+def borrow_copy(book_id, user_id, loan_days=LOAN_DAYS, retries=5, backoff=0.005):
+    """Claims one copy of a book and records the loan in one transaction.
+
+    The copy comes from a branch with stock through claim_copy(), whose
+    conditional ``UPDATE ... WHERE copies > 0`` lets the database decide
+    which concurrent borrower gets the last copy, so stock can never go
+    negative; the row lock is only held from that statement to the commit.
+    A borrower whose hold is ready takes the copy already set aside for
+    them instead, and while others wait in the book's line nobody else
+    gets one. The loan is counted in the rollups (see app/analytics.py).
+    Deadlocks and lock timeouts are retried with jittered exponential
+    backoff.
+    """
+    for attempt in range(retries + 1):
+        try:
+            hold = claim_ready_hold(book_id, user_id)
+            if hold is not None:
+                branch_id = hold.branch_id
+            elif has_waiting_holds(book_id):
+                # Any copy on the shelf is the line's
+                branch_id = None
+            else:
+                branch_id = claim_copy(book_id)
+            if hold is None and branch_id is None:
+                db.session.rollback()
+                raise NoCopiesLeft(book_id)
+
+            borrow_date = date.today()
+            loan = BookLoan(
+                book_id=book_id,
+                user_id=user_id,
+                borrow_date=borrow_date,
+                return_date=borrow_date + timedelta(days=loan_days),
+                returned=False,
+                branch_id=branch_id
+            )
+            db.session.add(loan)
+            record_borrow(book_id, user_id)
+            db.session.commit()
+            return loan
+        except OperationalError as e:
+            db.session.rollback()
+            if attempt == retries or not is_retryable(e):
+                raise
+            time.sleep(backoff * (2 ** attempt) * random.random())
+
+
+def return_copy(loan_id, user_id=None, retries=5, backoff=0.005):
+    """Marks a loan returned and puts its copy back on its branch's shelf.
+
+    The ``returned = false`` condition makes a second return of the same
+    loan (a double click, two librarians) a no-op instead of adding a
+    phantom copy. If the book has a line of holds, the copy is set aside
+    for the first holder right away. Pass ``user_id`` to only allow that
+    borrower's loans. Returns (book_id, user_id) of the loan.
+    """
+    for attempt in range(retries + 1):
+        try:
+            loan = db.session.execute(
+                select(BookLoan.book_id, BookLoan.user_id, BookLoan.branch_id).where(BookLoan.id == loan_id)
+            ).first()
+            if loan is None or (user_id is not None and loan.user_id != user_id):
+                db.session.rollback()
+                raise NotOnLoan(loan_id)
+
+            returned = db.session.execute(
+                update(BookLoan).where(BookLoan.id == loan_id, BookLoan.returned == False)
+                .values(returned=True)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not returned:
+                db.session.rollback()
+                raise NotOnLoan(loan_id)
+
+            release_copies(loan.book_id, loan.branch_id)
+            allocate(loan.book_id)
+            record_return(loan.book_id, loan.user_id)
+            db.session.commit()
+            return loan.book_id, loan.user_id
+        except OperationalError as e:
+            db.session.rollback()
+            if attempt == retries or not is_retryable(e):
+                raise
+            time.sleep(backoff * (2 ** attempt) * random.random())
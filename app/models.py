@@ -1,7 +1,6 @@
 from app import db
-from flask_bcrypt import generate_password_hash
 
-from datetime import date
+from datetime import date, datetime
 
 
 
@@ -25,6 +24,24 @@ class Book(db.Model):
     availability = db.Column(db.Integer, default=1)
     publisher = db.Column(db.String(255)) 
     year = db.Column(db.Integer)     
+    # Bumped on every catalog edit (not on borrow/return, which only move
+    # availability); the API derives its ETags from it. As the mapper's
+    # version_id_col, every ORM UPDATE of a book is conditional on it.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # Set by every INSERT and UPDATE of the row, ORM or Core; the search
+    # index of each process refreshes from it. NULL for rows untouched
+    # since the column was added.
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp())
+
+    # (title, author) is the key 'flask books import' upserts on
+    __table_args__ = (
+        db.Index('ix_books_title_author', 'title', 'author'),
+        db.Index('ix_books_author', 'author'),
+        db.Index('ix_books_genre', 'genre'),
+        db.Index('ix_books_updated_at', 'updated_at'),
+    )
+    __mapper_args__ = {'version_id_col': version}
 
 
 class AdminUser(db.Model):
@@ -41,6 +58,14 @@ class Log(db.Model):
     admin_id = db.Column(db.Integer, db.ForeignKey('admin_users.id'), nullable=True)
     action = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.TIMESTAMP, server_default=db.func.current_timestamp())
+
+    # Per-account history is read newest first; the bare timestamp index
+    # serves date ranges and pruning
+    __table_args__ = (
+        db.Index('ix_logs_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_logs_admin_id_timestamp', 'admin_id', 'timestamp'),
+        db.Index('ix_logs_timestamp', 'timestamp'),
+    )
 #flask db migrate -m "Added new fields"
 #flask db upgrade
 class BookLoan(db.Model):
@@ -51,7 +76,146 @@ class BookLoan(db.Model):
     borrow_date = db.Column(db.Date, default=date.today, nullable=False)
     return_date = db.Column(db.Date, nullable=True)
     returned = db.Column(db.Boolean, default=False)
+    fine = db.Column(db.Numeric(10, 2), nullable=False, default=0, server_default='0')
+    overdue_notified_at = db.Column(db.DateTime, nullable=True)
+
+    # The overdue job walks open loans by due date through the first index;
+    # (book_id, returned) serves a book's open loans and cascading deletes.
+    # The id-ordered ones let the loan lists page through a user's history
+    # and the open loans without sorting.
+    __table_args__ = (
+        db.Index('ix_book_loans_returned_return_date', 'returned', 'return_date'),
+        db.Index('ix_book_loans_book_id_returned', 'book_id', 'returned'),
+        db.Index('ix_book_loans_user_id_id', 'user_id', 'id'),
+        db.Index('ix_book_loans_returned_id', 'returned', 'id'),
+    )
+
+    # The branch the copy came from and goes back to; NULL for loans from
+    # before branches (they go back to the default branch). No foreign key,
+    # so adding the column does not rebuild the table.
+    branch_id = db.Column(db.Integer, nullable=True)
+
+    # When the loan was written, on the database's clock, so the rollup
+    # refreshes can tell loans that may not have committed yet; NULL for
+    # loans from before the column
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp(), nullable=True)
 
     # relationships
     book = db.relationship('Book', backref='loans', lazy=True)
-    user = db.relationship('User', backref='loans', lazy=True)
\ No newline at end of file
+    user = db.relationship('User', backref='loans', lazy=True)
+
+
+# Reservation queue for books with no copy on the shelf (app/holds.py). A
+# hold is 'waiting' in line, 'ready' once a returned copy was set aside for
+# it, then 'fulfilled', 'cancelled' or 'expired'.
+class Hold(db.Model):
+    __tablename__ = 'holds'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='waiting', server_default='waiting')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    ready_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True)
+    # Where the copy of a ready hold was set aside, as on book_loans
+    branch_id = db.Column(db.Integer, nullable=True)
+
+    # Ids grow in arrival order, so a book's line is its waiting holds by id:
+    # the head and anyone's position are index seeks, never a sort. The
+    # other two serve a user's holds and the expiry sweep.
+    __table_args__ = (
+        db.Index('ix_holds_book_id_status_id', 'book_id', 'status', 'id'),
+        db.Index('ix_holds_user_id_status', 'user_id', 'status'),
+        db.Index('ix_holds_status_expires_at', 'status', 'expires_at'),
+    )
+
+    book = db.relationship('Book', lazy=True)
+
+
+class Branch(db.Model):
+    __tablename__ = 'branches'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    code = db.Column(db.String(20), unique=True, nullable=False)
+    name = db.Column(db.String(255), nullable=False)
+
+
+class BranchStock(db.Model):
+    """Copies of a book on the shelf at a branch. A busy title can have its
+    copies at a branch split over several stripes (see app/stock.py);
+    books.availability is the maintained total."""
+    __tablename__ = 'branch_stock'
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    branch_id = db.Column(db.Integer, db.ForeignKey('branches.id', ondelete='CASCADE'), primary_key=True)
+    stripe = db.Column(db.Integer, primary_key=True, default=0, autoincrement=False)
+    copies = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Loan rollups kept by app/analytics.py
+class BookLoanStats(db.Model):
+    __tablename__ = 'loan_stats_books'
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    borrow_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+    active_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class UserLoanStats(db.Model):
+    __tablename__ = 'loan_stats_users'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    borrow_count = db.Column(db.Integer, nullable=False, default=0)
+    active_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+
+class GenreMonthStats(db.Model):
+    __tablename__ = 'loan_stats_genre_month'
+    month = db.Column(db.String(7), primary_key=True)  # 'YYYY-MM'
+    genre = db.Column(db.String(100), primary_key=True)  # '' when the book has none
+    borrow_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Co-borrowing counts and top-K lists kept by app/recommendations.py. A pair
+# is stored in both directions: readers is the number of readers who
+# borrowed both books. The (book_id, readers, other_id) index reads a
+# book's strongest pairs in order.
+class BookCoBorrow(db.Model):
+    __tablename__ = 'book_co_borrows'
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    readers = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_book_co_borrows_book_id_readers_other_id', 'book_id', 'readers', 'other_id'),
+    )
+
+
+class BookRecommendation(db.Model):
+    __tablename__ = 'book_recommendations'
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    recommended_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
+    readers = db.Column(db.Integer, nullable=False)
+
+
+# Signed-in sessions (app/sessions.py), keyed by the SHA-256 of the token in
+# the session cookie. account_id is a users.id, or an admin_users.id when
+# is_admin is set, so there is no foreign key; deleting an account or
+# changing its password deletes its rows.
+class UserSession(db.Model):
+    __tablename__ = 'user_sessions'
+    id = db.Column(db.String(64), primary_key=True)
+    account_id = db.Column(db.Integer, nullable=False)
+    is_admin = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_user_sessions_account_id_is_admin', 'account_id', 'is_admin'),
+        db.Index('ix_user_sessions_expires_at', 'expires_at'),
+    )
+
+
+class AnalyticsState(db.Model):
+    __tablename__ = 'analytics_state'
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.TIMESTAMP, server_default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp())
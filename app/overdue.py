@@ -0,0 +1,200 @@
+import json
+import logging
+import smtplib
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+from email.message import EmailMessage
+
+from sqlalchemy import and_, bindparam, insert, or_, select, update
+
+from app import db
+from app.models import Book, BookLoan, Log, User
+
+logger = logging.getLogger(__name__)
+
+
+# -- notification sinks -------------------------------------------------------
+#
+# A sink receives a list of notification dicts per batch. Delivery is
+# at-least-once: a crash between sending and committing resends that batch,
+# so every notification carries a stable 'key' receivers can dedupe on.
+
+class LogSink:
+    def send_many(self, notifications):
+        for notification in notifications:
+            logger.info('Overdue notice for %s: %s', notification['email'], notification['subject'])
+
+
+class FileSink:
+    """Appends notifications as JSON lines, e.g. for a mailer to pick up"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send_many(self, notifications):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for notification in notifications:
+                f.write(json.dumps(notification, default=str) + '\n')
+
+
+class SMTPSink:
+    """Sends one email per notification over a single SMTP connection per batch.
+
+    A local stand-in such as ``python -m aiosmtpd -n -l localhost:8025`` is
+    enough for development.
+    """
+
+    def __init__(self, host='localhost', port=25, sender='library@localhost'):
+        self.host = host
+        self.port = port
+        self.sender = sender
+
+    def send_many(self, notifications):
+        with smtplib.SMTP(self.host, self.port) as smtp:
+            for notification in notifications:
+                message = EmailMessage()
+                message['From'] = self.sender
+                message['To'] = notification['email']
+                message['Subject'] = notification['subject']
+                message['Message-ID'] = '<%s@library>' % notification['key']
+                message.set_content(notification['body'])
+                smtp.send_message(message)
+
+
+def sink_from_config(config):
+    kind = config.get('OVERDUE_SINK', 'log')
+    if kind == 'file':
+        return FileSink(config.get('OVERDUE_SINK_PATH', 'overdue_notifications.jsonl'))
+    if kind == 'smtp':
+        return SMTPSink(config.get('OVERDUE_SMTP_HOST', 'localhost'),
+                        config.get('OVERDUE_SMTP_PORT', 25),
+                        config.get('MAIL_SENDER', 'library@localhost'))
+    return LogSink()
+
+
+# -- the job ------------------------------------------------------------------
+
+def fine_for(days_overdue, per_day, maximum):
+    return min(per_day * days_overdue, maximum)
+
+
+def process_overdue(sink, today=None, batch_size=500, fine_per_day=Decimal('0.25'), fine_max=Decimal('10.00')):
+    """Fines and notifies every open loan past its return date.
+
+    Loans are read in (return_date, id) keyset order through the
+    (returned, return_date) index, one batch per transaction, so memory is
+    bounded by batch_size however many loans are open. The job is
+    idempotent: fines are recomputed from the due date rather than added,
+    and each loan is notified and logged once (overdue_notified_at).
+    Concurrent runs on MySQL 8 skip each other's locked rows. Returns
+    (loans_seen, notifications_sent).
+    """
+    today = today or date.today()
+    last_date, last_id = None, 0
+    seen = sent = 0
+
+    while True:
+        stmt = (
+            select(BookLoan.id, BookLoan.user_id, BookLoan.return_date, BookLoan.fine,
+                   BookLoan.overdue_notified_at, User.email, User.first_name, Book.title)
+            .join(User, User.id == BookLoan.user_id)
+            .join(Book, Book.id == BookLoan.book_id)
+            .where(BookLoan.returned == False, BookLoan.return_date < today)
+            .order_by(BookLoan.return_date, BookLoan.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True, of=BookLoan)
+        )
+        if last_date is not None:
+            stmt = stmt.where(or_(
+                BookLoan.return_date > last_date,
+                and_(BookLoan.return_date == last_date, BookLoan.id > last_id)
+            ))
+        rows = db.session.execute(stmt).all()
+        if not rows:
+            db.session.rollback()
+            break
+
+        fines, notifications, logs = [], [], []
+        now = datetime.now()
+        for row in rows:
+            days = (today - row.return_date).days
+            fine = fine_for(days, fine_per_day, fine_max)
+            if fine != row.fine:
+                fines.append({'loan_id': row.id, 'fine': fine})
+            if row.overdue_notified_at is None:
+                notifications.append({
+                    'key': 'overdue-loan-%d' % row.id,
+                    'loan_id': row.id,
+                    'email': row.email,
+                    'subject': 'Overdue: %s' % row.title,
+                    'body': 'Hi %s,\n\n"%s" was due back on %s (%d days ago). '
+                            'Your fine so far is %s; it grows by %s a day up to %s.\n'
+                            % (row.first_name, row.title, row.return_date, days, fine, fine_per_day, fine_max)
+                })
+                logs.append({
+                    'user_id': row.user_id,
+                    'action': "Loan #%d of '%s' overdue by %d days, fine %s" % (row.id, row.title, days, fine),
+                    'timestamp': now
+                })
+
+        loans = BookLoan.__table__
+        if fines:
+            db.session.execute(
+                update(loans).where(loans.c.id == bindparam('loan_id')).values(fine=bindparam('fine')),
+                fines
+            )
+        if notifications:
+            sink.send_many(notifications)
+            db.session.execute(
+                update(loans).where(loans.c.id.in_([n['loan_id'] for n in notifications]))
+                .values(overdue_notified_at=now)
+            )
+            db.session.execute(insert(Log), logs)
+        db.session.commit()
+
+        seen += len(rows)
+        sent += len(notifications)
+        last_date, last_id = rows[-1].return_date, rows[-1].id
+
+    return seen, sent
+
+
+def run_overdue_job(app, sink=None):
+    with app.app_context():
+        config = app.config
+        return process_overdue(
+            sink or sink_from_config(config),
+            batch_size=config.get('OVERDUE_BATCH_SIZE', 500),
+            fine_per_day=Decimal(str(config.get('FINE_PER_DAY', '0.25'))),
+            fine_max=Decimal(str(config.get('FINE_MAX', '10.00')))
+        )
+
+
+class OverdueScheduler:
+    """Runs the overdue job every ``interval`` seconds on a daemon thread"""
+
+    def __init__(self, app, interval=3600, sink=None):
+        self.app = app
+        self.interval = interval
+        self.sink = sink
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='overdue-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                seen, sent = run_overdue_job(self.app, self.sink)
+                logger.info('Overdue job: %d overdue loans, %d notified', seen, sent)
+            except Exception:
+                logger.exception('Overdue job failed')
+            self._stop.wait(self.interval)
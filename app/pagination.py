@@ -0,0 +1,52 @@
+from collections import namedtuple
+
+from app import db
+
+# One page of results plus the cursors to reach its neighbours (None when
+# there is nothing further in that direction).
+Page = namedtuple('Page', ['items', 'prev_cursor', 'next_cursor'])
+
+
+def keyset_page(stmt, key, after=None, before=None, per_page=50, descending=False, scalars=False):
+    """Returns one Page of ``stmt`` ordered by the unique column ``key``.
+
+    Instead of OFFSET, the query seeks past the cursor (``key > after`` or
+    ``key < before``, flipped when ``descending``), so every page costs one
+    index range read no matter how deep into the table it is. Pass
+    ``scalars=True`` when ``stmt`` selects a single ORM entity.
+    """
+    result = db.session.execute(keyset_query(stmt, key, after, before, per_page, descending))
+    rows = (result.scalars() if scalars else result).all()
+    return keyset_result(rows, key, after, before, per_page)
+
+
+def keyset_query(stmt, key, after=None, before=None, per_page=50, descending=False):
+    """The query keyset_page runs, for callers with their own connection"""
+    if before is not None:
+        # Walk towards the start of the listing, then flip the rows back
+        stmt = stmt.where(key > before if descending else key < before)
+        stmt = stmt.order_by(key if descending else key.desc())
+    else:
+        if after is not None:
+            stmt = stmt.where(key < after if descending else key > after)
+        stmt = stmt.order_by(key.desc() if descending else key)
+
+    # Fetch one extra row to learn whether another page exists
+    return stmt.limit(per_page + 1)
+
+
+def keyset_result(rows, key, after=None, before=None, per_page=50):
+    """Turns the rows of keyset_query into a Page"""
+    backwards = before is not None
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return Page([], None, None)
+
+    first = getattr(rows[0], key.key)
+    last = getattr(rows[-1], key.key)
+    if backwards:
+        return Page(rows, first if has_more else None, last)
+    return Page(rows, first if after is not None else None, last if has_more else None)
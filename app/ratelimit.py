@@ -0,0 +1,223 @@
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache, wraps
+
+from flask import request
+from werkzeug.exceptions import TooManyRequests
+
+from app.sessions import current_principal
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    """'10/minute' -> (bucket capacity, tokens added per second)"""
+    count, _, period = rate.partition('/')
+    try:
+        count, seconds = int(count), PERIODS[period.strip()]
+    except (KeyError, ValueError):
+        raise ValueError('Rate limits look like "10/minute", not %r' % rate)
+    return count, count / float(seconds)
+
+
+# -- keys ---------------------------------------------------------------------
+#
+# Each returns the caller's identity for a limit, or None to skip it. They
+# read the request and the signed-in account, which is nearly always
+# resolved from memory (app/sessions.py).
+
+def by_ip():
+    return 'ip:%s' % request.remote_addr
+
+
+def by_email():
+    email = (request.form.get('email') or '').strip().lower()
+    return 'email:%s' % email[:254] if email else None
+
+
+def by_user():
+    principal = current_principal()
+    return None if principal is None else 'user:%s:%d' % ('admin' if principal.is_admin else 'reader', principal.id)
+
+
+# -- stores -------------------------------------------------------------------
+
+class MemoryStore:
+    """Token buckets in this process, spread over ``shards`` dicts with a
+    lock each, so concurrent requests almost never wait on one another.
+
+    A bucket is [tokens, last update, time it is full again]. Buckets that
+    have refilled are the same as absent ones, so they are the first to go
+    when a shard passes its share of ``max_keys``.
+    """
+
+    name = 'memory'
+
+    def __init__(self, shards=64, max_keys=100000):
+        shards = 1 << max(0, int(shards) - 1).bit_length()
+        self._mask = shards - 1
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self._max_per_shard = max(1, max_keys // shards)
+
+    def hit(self, key, capacity, per_second):
+        """Takes a token from the key's bucket. Returns 0 if there was one,
+        otherwise the seconds until there will be."""
+        now = time.monotonic()
+        buckets, lock = self._shards[hash(key) & self._mask]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= self._max_per_shard:
+                    self._prune(buckets, now)
+                tokens = float(capacity)
+                bucket = buckets[key] = [tokens, now, now]
+            else:
+                tokens = min(capacity, bucket[0] + (now - bucket[1]) * per_second)
+            if tokens < 1:
+                bucket[0], bucket[1] = tokens, now
+                return (1 - tokens) / per_second
+            bucket[0], bucket[1] = tokens - 1, now
+            bucket[2] = now + (capacity - bucket[0]) / per_second
+            return 0
+
+    def _prune(self, buckets, now):
+        full = [key for key, bucket in buckets.items() if bucket[2] <= now]
+        if len(full) < len(buckets) // 4:
+            # Mostly active buckets: drop the oldest quarter anyway
+            full += [key for key, _ in zip(buckets, range(len(buckets) // 4 + 1))]
+        for key in full:
+            buckets.pop(key, None)
+
+    def size(self):
+        return sum(len(buckets) for buckets, _ in self._shards)
+
+    def clear(self):
+        for buckets, lock in self._shards:
+            with lock:
+                buckets.clear()
+
+
+# Refill and take in one round trip, on the server's clock so app servers
+# with drifting clocks share buckets fairly. Returns the wait as a string;
+# Lua numbers come back from Redis as integers.
+TOKEN_BUCKET_SCRIPT = '''
+local capacity, rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or capacity
+local at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+'''
+
+
+class RedisStore:
+    """Buckets in Redis, shared by every worker and server"""
+
+    name = 'redis'
+
+    def __init__(self, url, prefix='library:ratelimit:'):
+        import redis  # only needed when this backend is configured
+
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def hit(self, key, capacity, per_second):
+        return float(self._script(keys=[self.prefix + key], args=[capacity, per_second]))
+
+    def size(self):
+        return sum(1 for _ in self._client.scan_iter(self.prefix + '*'))
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + '*'):
+            self._client.delete(key)
+
+
+# -- limiter ------------------------------------------------------------------
+
+class RateLimiter:
+    """Per-route token-bucket limits, checked before the view runs.
+
+    Views opt in with the ``limit`` decorator. A request over any of its
+    limits gets a 429 with Retry-After before the view touches the database
+    or the password hasher. When the store fails (Redis down) requests are
+    let through rather than refused.
+    """
+
+    def __init__(self, app=None):
+        self.store = MemoryStore()
+        self.enabled = True
+        self.rates = {}
+        self._stats = defaultdict(lambda: {'allowed': 0, 'limited': 0})
+        self._errors = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('RATELIMIT_STORAGE', 'memory') == 'redis':
+            self.store = RedisStore(app.config.get('RATELIMIT_REDIS_URL') or app.config['CACHE_REDIS_URL'])
+        else:
+            self.store = MemoryStore(app.config.get('RATELIMIT_SHARDS', 64),
+                                     app.config.get('RATELIMIT_MAX_KEYS', 100000))
+        self.enabled = app.config.get('RATELIMIT_ENABLED', True)
+        # e.g. RATELIMITS = {'login-email': '3/minute'}
+        self.rates = dict(app.config.get('RATELIMITS', {}))
+        for rate in self.rates.values():
+            parse_rate(rate)
+        app.extensions['ratelimit'] = self
+
+    def limit(self, name, rate, key=by_ip, methods=None):
+        """Allows ``rate`` requests (e.g. '10/minute') per ``key`` to the
+        view, or only to its ``methods``. Views sharing a name share buckets;
+        stack the decorator to limit by several keys."""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if self.enabled and (methods is None or request.method in methods):
+                    self.check(name, rate, key)
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+    def check(self, name, rate, key):
+        identity = key()
+        if identity is None:
+            return
+        capacity, per_second = parse_rate(self.rates.get(name, rate))
+        try:
+            wait = self.store.hit('%s:%s' % (name, identity), capacity, per_second)
+        except Exception:
+            self._errors += 1
+            logger.warning('Rate limit store failed, letting %s through', name, exc_info=True)
+            return
+        if wait:
+            self._stats[name]['limited'] += 1
+            raise TooManyRequests('Too many requests, please try again in a moment.',
+                                  retry_after=math.ceil(wait))
+        self._stats[name]['allowed'] += 1
+
+    def reset(self):
+        self.store.clear()
+
+    def metrics(self):
+        return {
+            'store': self.store.name,
+            'keys': self.store.size(),
+            'errors': self._errors,
+            'limits': {name: dict(counts) for name, counts in self._stats.items()}
+        }
+
+
+limiter = RateLimiter()
@@ -0,0 +1,343 @@
+from collections import Counter
+from itertools import chain, groupby, permutations
+
+from flask import current_app
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import db
+from app.analytics import _insert_all, _numpy, get_state, increment, set_state, settled, settled_before
+from app.cache import cache
+from app.database import on_primary
+from app.models import Book, BookCoBorrow, BookLoan, BookRecommendation
+
+# book_loans.id up to which co-borrowing has been counted
+WATERMARK = 'recommendations_loan_id'
+TOP_K = 10
+# Readers who borrow thousands of books say little about any two of them and
+# would cost millions of pairs each, so only their first books count
+MAX_BOOKS_PER_READER = 500
+
+
+def _key(book_id):
+    return 'recs:%d' % book_id
+
+
+def recommended_books(book_id):
+    """Books most often borrowed by readers of this one, best first.
+
+    One primary-key range read of the precomputed list, cached per book.
+    """
+    def load():
+        with on_primary():
+            return [row._asdict() for row in db.session.execute(_list_query(book_id))]
+    return cache.get_or_set(_key(book_id), load, ttl=current_app.config.get('RECOMMENDATIONS_CACHE_TTL', 3600))
+
+
+async def recommended_books_async(engine, book_id):
+    """recommended_books() through an async engine, for app/asgi.py"""
+    async def load():
+        async with engine.connect() as connection:
+            return [row._asdict() for row in await connection.execute(_list_query(book_id))]
+    return await cache.get_or_set_async(_key(book_id), load,
+                                        ttl=current_app.config.get('RECOMMENDATIONS_CACHE_TTL', 3600))
+
+
+def _list_query(book_id):
+    return (
+        select(Book.id, Book.title, Book.author, BookRecommendation.readers)
+        .join(Book, Book.id == BookRecommendation.recommended_id)
+        .where(BookRecommendation.book_id == book_id)
+        .order_by(BookRecommendation.rank)
+    )
+
+
+def _settings():
+    config = current_app.config
+    return (config.get('RECOMMENDATIONS_TOP_K', TOP_K),
+            config.get('RECOMMENDATIONS_MAX_BOOKS_PER_READER', MAX_BOOKS_PER_READER))
+
+
+# -- incremental job ----------------------------------------------------------
+
+def refresh(batch_size=10000):
+    """Counts loans added since the last run into the co-borrowing pairs and
+    recomputes the lists of the books they touched.
+
+    Walks book_loans by primary key from the stored watermark, one batch per
+    transaction, and leaves loans that may not have committed yet for the
+    next run, like analytics.refresh(). Only a reader's first loan of a
+    book counts, and only for their first MAX_BOOKS_PER_READER books, the
+    same rule rebuild() applies. Returns the number of loans read.
+    """
+    top_k, max_books = _settings()
+    last_id = get_state(WATERMARK)
+    before = settled_before()
+    counted = 0
+    while True:
+        loans = settled(db.session.execute(
+            select(BookLoan.id, BookLoan.user_id, BookLoan.created_at)
+            .where(BookLoan.id > last_id)
+            .order_by(BookLoan.id)
+            .limit(batch_size)
+        ).all(), before)
+        if not loans:
+            return counted
+        batch_last = loans[-1].id
+        user_ids = sorted({loan.user_id for loan in loans})
+
+        deltas = Counter()
+        for start in range(0, len(user_ids), 500):
+            history = db.session.execute(
+                select(BookLoan.user_id, BookLoan.book_id, BookLoan.id)
+                .where(BookLoan.user_id.in_(user_ids[start:start + 500]), BookLoan.id <= batch_last)
+                .order_by(BookLoan.user_id, BookLoan.id)
+            )
+            for _, rows in groupby(history, key=lambda row: row.user_id):
+                books = _first_loans(((row.book_id, row.id) for row in rows), max_books)
+                # Each new book pairs with every book the reader had before it
+                for i, (book_id, loan_id) in enumerate(books):
+                    if loan_id > last_id:
+                        for other_id, _ in books[:i]:
+                            deltas[book_id, other_id] += 1
+                            deltas[other_id, book_id] += 1
+
+        _add_pairs(deltas)
+        touched = sorted({book_id for book_id, _ in deltas})
+        _replace_lists(touched, [_top_pairs(book_id, top_k) for book_id in touched])
+        last_id = batch_last
+        set_state(WATERMARK, last_id)
+        db.session.commit()
+        cache.delete(*[_key(book_id) for book_id in touched])
+        counted += len(loans)
+
+
+def _first_loans(loans, max_books):
+    """[(book_id, first loan id)] of a reader's distinct books, oldest first"""
+    seen, books = set(), []
+    for book_id, loan_id in loans:
+        if book_id not in seen:
+            seen.add(book_id)
+            books.append((book_id, loan_id))
+            if len(books) == max_books:
+                break
+    return books
+
+
+def _add_pairs(deltas):
+    table = BookCoBorrow.__table__
+    dialect = db.engine.dialect.name
+    if dialect == 'mysql':
+        stmt = mysql_insert(table)
+        stmt = stmt.on_duplicate_key_update(readers=table.c.readers + stmt.inserted.readers)
+    elif dialect == 'sqlite':
+        stmt = sqlite_insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=['book_id', 'other_id'],
+                                          set_={'readers': table.c.readers + stmt.excluded.readers})
+    else:
+        for (book_id, other_id), count in deltas.items():
+            increment(BookCoBorrow, {'book_id': book_id, 'other_id': other_id}, readers=count)
+        return
+    _executemany(stmt, ('book_id', 'other_id', 'readers'),
+                 [(book_id, other_id, count) for (book_id, other_id), count in deltas.items()])
+
+
+def _top_pairs(book_id, top_k):
+    return db.session.execute(
+        select(BookCoBorrow.other_id, BookCoBorrow.readers)
+        .where(BookCoBorrow.book_id == book_id)
+        .order_by(BookCoBorrow.readers.desc(), BookCoBorrow.other_id.desc())
+        .limit(top_k)
+    ).all()
+
+
+def _replace_lists(book_ids, lists):
+    for start in range(0, len(book_ids), 500):
+        db.session.execute(delete(BookRecommendation).where(
+            BookRecommendation.book_id.in_(book_ids[start:start + 500])))
+    _insert_all(BookRecommendation, [
+        {'book_id': book_id, 'rank': rank, 'recommended_id': other_id, 'readers': readers}
+        for book_id, pairs in zip(book_ids, lists)
+        for rank, (other_id, readers) in enumerate(pairs, 1)
+    ])
+
+
+# -- full recomputation -------------------------------------------------------
+
+def rebuild(chunk_size=100000, partitions=4, pair_budget=5000000):
+    """Recomputes every pair count and list from book_loans.
+
+    Makes one pass over the loans, in reader order, for each of
+    ``partitions`` ranges of book ids, and counts only the pairs whose first
+    book is in the range. Each reader's books are expanded into pairs with
+    NumPy when it is installed, at most ``pair_budget`` pairs at a time.
+    Memory is bounded by one range's distinct pairs and ``pair_budget``, not
+    by the loan count. Each range is replaced in its own transaction; do not
+    run refresh() meanwhile. Returns the number of pairs stored.
+    """
+    top_k, max_books = _settings()
+    max_id = db.session.scalar(select(func.max(BookLoan.id))) or 0
+    first_book, last_book = db.session.execute(select(func.min(Book.id), func.max(Book.id))).one()
+    stored = 0
+    if max_id and first_book is not None:
+        span = max(last_book, db.session.scalar(select(func.max(BookLoan.book_id)))) + 1
+        step = -(-(last_book - first_book + 1) // max(1, partitions))
+        for lo in range(first_book, last_book + 1, step):
+            hi = lo + step
+            left, right, readers = _count_pairs(_readers(max_id, chunk_size, max_books), lo, hi, span, pair_budget)
+            db.session.execute(delete(BookCoBorrow).where(BookCoBorrow.book_id >= lo, BookCoBorrow.book_id < hi))
+            db.session.execute(delete(BookRecommendation).where(
+                BookRecommendation.book_id >= lo, BookRecommendation.book_id < hi))
+            _insert_columns(BookCoBorrow, ('book_id', 'other_id', 'readers'), (left, right, readers))
+            _insert_columns(BookRecommendation, ('book_id', 'rank', 'recommended_id', 'readers'),
+                            _top_k(left, right, readers, top_k))
+            db.session.commit()
+            stored += len(left)
+    set_state(WATERMARK, max_id)
+    db.session.commit()
+    return stored
+
+
+def _readers(max_id, chunk_size, max_books):
+    """Yields lists of readers' distinct books in first-borrow order, about
+    chunk_size loans at a time; readers with one book pair with nothing"""
+    stmt = (select(BookLoan.user_id, BookLoan.book_id)
+            .where(BookLoan.id <= max_id)
+            .order_by(BookLoan.user_id, BookLoan.id))
+    result = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    current, books, seen = None, [], set()
+    for chunk in result.partitions():
+        readers = []
+        for user_id, book_id in chunk:
+            if user_id != current:
+                if len(books) > 1:
+                    readers.append(books)
+                current, books, seen = user_id, [], set()
+            if book_id not in seen and len(books) < max_books:
+                seen.add(book_id)
+                books.append(book_id)
+        yield readers
+    if len(books) > 1:
+        yield [books]
+
+
+def _count_pairs(chunks, lo, hi, span, pair_budget):
+    """Readers per (book, other book) with lo <= book < hi, as three columns
+    sorted by book, then readers and other book descending"""
+    np = _numpy()
+    if np is None:
+        counts = Counter()
+        for readers in chunks:
+            for books in readers:
+                counts.update(pair for pair in permutations(books, 2) if lo <= pair[0] < hi)
+        ordered = sorted(counts.items(), key=lambda item: (item[0][0], -item[1], -item[0][1]))
+        return ([book_id for (book_id, _), _ in ordered], [other_id for (_, other_id), _ in ordered],
+                [count for _, count in ordered])
+
+    # Unique pairs per batch, merged whenever the unmerged ones pass the budget
+    keys, counts, total, merged = [], [], 0, 0
+    for readers in chunks:
+        for batch in _within_budget(readers, pair_budget):
+            sizes = np.fromiter(map(len, batch), dtype=np.int64, count=len(batch))
+            books = np.fromiter(chain.from_iterable(batch), dtype=np.int64, count=int(sizes.sum()))
+            batch_keys, batch_counts = np.unique(_pair_keys(np, books, sizes, lo, hi, span), return_counts=True)
+            keys.append(batch_keys)
+            counts.append(batch_counts)
+            total += len(batch_keys)
+            if total - merged > pair_budget:
+                merged_keys, merged_counts = _merge(np, keys, counts)
+                keys, counts, total = [merged_keys], [merged_counts], len(merged_keys)
+                merged = total
+    keys, counts = _merge(np, keys, counts)
+    left, right = keys // span, keys % span
+    order = np.lexsort((-right, -counts, left))
+    return left[order], right[order], counts[order]
+
+
+def _within_budget(readers, pair_budget):
+    """Splits readers into runs that expand to at most pair_budget pairs"""
+    batch, pairs = [], 0
+    for books in readers:
+        if batch and pairs + len(books) ** 2 > pair_budget:
+            yield batch
+            batch, pairs = [], 0
+        batch.append(books)
+        pairs += len(books) ** 2
+    if batch:
+        yield batch
+
+
+def _pair_keys(np, books, sizes, lo, hi, span):
+    """Every ordered pair of different books read by the same reader, with
+    the first in [lo, hi), encoded as book * span + other book.
+
+    ``books`` holds each reader's books back to back, ``sizes`` how many
+    each reader has; each book in range is repeated once per book of its
+    reader and lined up against all of them.
+    """
+    starts = np.repeat(np.cumsum(sizes) - sizes, sizes)
+    group_sizes = np.repeat(sizes, sizes)
+    first = np.flatnonzero((books >= lo) & (books < hi))
+    repeats = group_sizes[first]
+    offsets = np.arange(int(repeats.sum())) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    left = np.repeat(books[first], repeats)
+    right = books[np.repeat(starts[first], repeats) + offsets]
+    different = left != right
+    return left[different] * span + right[different]
+
+
+def _merge(np, keys, counts):
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    merged, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    return merged, np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+
+
+def _top_k(left, right, readers, top_k):
+    """The first top_k pairs of each book as (book, rank, other, readers)
+    columns; the input is sorted as _count_pairs returns it"""
+    np = _numpy()
+    if np is not None and hasattr(left, 'dtype'):
+        starts = np.flatnonzero(np.r_[True, left[1:] != left[:-1]]) if len(left) else left
+        ranks = np.arange(1, len(left) + 1) - np.repeat(starts, np.diff(np.r_[starts, len(left)]))
+        top = ranks <= top_k
+        return left[top], ranks[top], right[top], readers[top]
+
+    books, ranks, others, counts = [], [], [], []
+    rank, previous = 0, None
+    for book_id, other_id, count in zip(left, right, readers):
+        rank = rank + 1 if book_id == previous else 1
+        previous = book_id
+        if rank <= top_k:
+            books.append(book_id)
+            ranks.append(rank)
+            others.append(other_id)
+            counts.append(count)
+    return books, ranks, others, counts
+
+
+def _values(column):
+    return column.tolist() if hasattr(column, 'tolist') else column
+
+
+def _insert_columns(model, names, columns, batch_size=50000):
+    stmt = model.__table__.insert()
+    for start in range(0, len(columns[0]), batch_size):
+        _executemany(stmt, names, list(zip(*[_values(column[start:start + batch_size]) for column in columns])))
+
+
+def _executemany(stmt, names, rows, batch_size=50000):
+    """Runs stmt for each tuple of plain ints in rows with the driver's
+    executemany. Millions of pair rows are written per run, and SQLAlchemy's
+    per-row parameter handling would cost more than the database does."""
+    connection = db.session.connection()
+    compiled = stmt.compile(dialect=connection.dialect, column_keys=list(names))
+    if compiled.positional:
+        positions = [names.index(name) for name in compiled.positiontup]
+        if positions != list(range(len(names))):
+            rows = [tuple(row[i] for i in positions) for row in rows]
+    else:
+        rows = [dict(zip(names, row)) for row in rows]
+    for start in range(0, len(rows), batch_size):
+        connection.exec_driver_sql(compiled.string, rows[start:start + batch_size])
@@ -0,0 +1,104 @@
+import time
+from functools import wraps
+
+from flask import current_app, request, session
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from app.cache import Cache, SimpleBackend, cache
+from app.database import on_primary
+
+# Rendered template fragments. Each key holds everything the fragment shows
+# (a book row is keyed by id, version and availability), so entries never
+# go stale and writes need not drop them. They stay in this process: no
+# round trip per row even with a Redis cache, and new templates after a
+# deploy start from an empty cache.
+fragments = Cache()
+
+PAGE_GENERATION_KEY = 'page:generation'
+
+
+def init_app(app):
+    fragments.backend = SimpleBackend(app.config.get('FRAGMENT_CACHE_MAX_ENTRIES', 20000))
+    fragments.default_ttl = app.config.get('FRAGMENT_CACHE_TTL', 3600)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache_enabled = app.config.get('FRAGMENT_CACHE_ENABLED', True)
+    app.extensions['fragments'] = fragments
+
+
+class FragmentCacheExtension(Extension):
+    """Caches the markup of a block under the values it is keyed by:
+
+        {% cache 'book-row', book.id, book.version, book.availability %}
+            ...
+        {% endcache %}
+
+    The first value names the fragment, and its hits and misses are counted
+    under that name.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache_enabled=True)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(parts)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        if not self.environment.fragment_cache_enabled:
+            return caller()
+        key = ':'.join(str(part) for part in parts)
+        return Markup(fragments.get_or_set(key, lambda: str(caller())))
+
+
+# -- whole pages --------------------------------------------------------------
+#
+# Cached pages are keyed by a generation stored in the shared cache. Any
+# book write starts a new generation, so every worker stops serving the old
+# pages at once, and the old entries age out of the backend.
+
+def page_generation():
+    return cache.peek(PAGE_GENERATION_KEY, 0)
+
+
+def invalidate_pages():
+    # Outlives any page, so a cached page is never served after its generation
+    cache.set(PAGE_GENERATION_KEY, time.time_ns(), ttl=86400)
+
+
+def page_cache_key():
+    """The cache key of this request's page, or None when the visitor must
+    get a page of their own"""
+    if (not current_app.config.get('PAGE_CACHE_ENABLED', True) or request.method != 'GET'
+            or 'sid' in session or '_flashes' in session):
+        return None
+    return 'page:%s:%s' % (page_generation(), request.full_path)
+
+
+def cached_page(f):
+    """Serves the view's page to anonymous visitors from the cache for up
+    to PAGE_CACHE_TTL seconds. For views that return HTML, rendered or
+    streamed; a streamed page is joined before it is stored. Pages that go
+    into the cache are rendered from the primary, like other shared cache
+    entries (see on_primary())."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = page_cache_key()
+        if key is None:
+            return f(*args, **kwargs)
+
+        def render():
+            with on_primary():
+                html = f(*args, **kwargs)
+                return html if isinstance(html, str) else ''.join(html)
+
+        return cache.get_or_set(key, render, ttl=current_app.config.get('PAGE_CACHE_TTL', 60))
+    return decorated_function
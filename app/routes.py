@@ -1,19 +1,35 @@
-from flask import Blueprint, request, jsonify, redirect, url_for, flash, session
-from flask import render_template
-from app import db
-from app.models import Book, User, AdminUser
-from flask_bcrypt import Bcrypt
-from functools import wraps
+from flask import Blueprint, request, jsonify, redirect, url_for, flash
+from flask import render_template, stream_template, current_app, abort
 from datetime import date
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, load_only
+from app import db
+from app import analytics, holds, recommendations, stock
+from app.audit import audit
+from app.auth import authenticate
+from app.cache import cache
+from app.database import health, on_primary, read_only
+from app.catalog import (BOOK_LIST_COLUMNS, EditConflict, edit_diff, get_book_or_404,
+                         invalidate_books, newest_books, update_book)
+from app.forms import clean_book_fields
+from app.hashing import HasherBusy, hasher
+from app.holds import AlreadyHolding, NoSuchHold
+from app.instrumentation import instrumentation
+from app.loans import borrow_copy, return_copy, NoCopiesLeft, NotOnLoan
+from app.pagination import keyset_page
+from app.ratelimit import by_email, by_ip, by_user, limiter
+from app.render_cache import cached_page, fragments
+from app.search import search_index
+from app.sessions import current_principal, sessions, sign_in, sign_out
 from app.models import Book, BookLoan, User
+from functools import wraps
 
-bcrypt = Bcrypt()
 main = Blueprint('main', __name__)
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if current_principal() is None:
             flash("Please log in first", "danger")
             return redirect(url_for('main.login_page'))
         return f(*args, **kwargs)
@@ -22,30 +38,123 @@ def login_required(f):
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not session.get('user_id'):
+        principal = current_principal()
+        if principal is None:
             flash("You must be logged in!", "danger")
             return redirect(url_for('main.login_page'))
-        if not session.get('is_admin'):
+        if not principal.is_admin:
             flash("You do not have permission to access this page.", "danger")
             return redirect(url_for('main.home'))
         return f(*args, **kwargs)
     return decorated_function
 
+def audit_event(action):
+    """Queues an audit log entry for the signed-in account"""
+    principal = current_principal()
+    if principal is None:
+        audit.record(action)
+    elif principal.is_admin:
+        audit.record(action, admin_id=principal.id)
+    else:
+        audit.record(action, user_id=principal.id)
+
+def book_list_page(per_page=None):
+    """Returns the catalog page selected by the ?after= / ?before= cursors"""
+    if per_page is None:
+        per_page = current_app.config.get('BOOKS_PER_PAGE', 50)
+    return keyset_page(
+        select(*BOOK_LIST_COLUMNS),
+        Book.id,
+        after=request.args.get('after', type=int),
+        before=request.args.get('before', type=int),
+        per_page=per_page
+    )
+
+def loan_list_page(stmt, descending=False):
+    """One page of loans with their book and borrower loaded in the same query"""
+    stmt = stmt.options(
+        joinedload(BookLoan.book).load_only(Book.id, Book.title, Book.author),
+        joinedload(BookLoan.user).load_only(User.id, User.first_name, User.last_name, User.email)
+    )
+    return keyset_page(
+        stmt,
+        BookLoan.id,
+        after=request.args.get('after', type=int),
+        before=request.args.get('before', type=int),
+        per_page=current_app.config.get('LOANS_PER_PAGE', 50),
+        descending=descending,
+        scalars=True
+    )
+
 @main.route('/')
+@read_only
+@cached_page
 def home():
-    newest_books = Book.query.order_by(Book.id.desc()).limit(3).all()
-    return render_template('index.html', books=newest_books)
+    return render_template('index.html', books=newest_books())
 
 
 
 @main.route('/books_page', methods=['GET'])
+@read_only
+@cached_page
 def books_page():
-    """Renders books in an HTML template"""
-    books = Book.query.all()
-    return render_template('books.html', books=books)
+    """Renders one page of books in an HTML template"""
+    page = book_list_page()
+    return stream_template('books.html', books=page.items, page=page)
+
+
+@main.route('/books_page/json', methods=['GET'])
+@read_only
+def books_page_json():
+    """Same pages as books_page, as JSON for clients walking the catalog"""
+    max_per_page = current_app.config.get('BOOKS_MAX_PER_PAGE', 500)
+    per_page = request.args.get('limit', type=int) or current_app.config.get('BOOKS_PER_PAGE', 50)
+    page = book_list_page(per_page=max(1, min(per_page, max_per_page)))
+    return jsonify(
+        books=[row._asdict() for row in page.items],
+        prev=page.prev_cursor,
+        next=page.next_cursor
+    )
+
+
+def search_books():
+    """Runs the ?q= search and loads the matching rows in rank order"""
+    hits = search_index.search(
+        request.args.get('q', ''),
+        genre=request.args.get('genre') or None,
+        year=request.args.get('year', type=int),
+        limit=current_app.config.get('SEARCH_RESULTS_LIMIT', 50)
+    )
+    if not hits:
+        return []
+    scores = dict(hits)
+    rows = db.session.execute(
+        select(*BOOK_LIST_COLUMNS).where(Book.id.in_(scores))
+    ).all()
+    missing = scores.keys() - {row.id for row in rows}
+    if missing:
+        # Deleted by another process, unless the replica has yet to see them
+        with on_primary():
+            missing -= set(db.session.scalars(select(Book.id).where(Book.id.in_(missing))))
+        search_index.forget(missing)
+    return sorted(rows, key=lambda row: scores[row.id], reverse=True)
+
+
+@main.route('/search', methods=['GET'])
+@read_only
+def search_page():
+    """Renders ranked search results over title, author, genre and publisher"""
+    return render_template('search.html', books=search_books(), index_ready=search_index.ready)
+
+
+@main.route('/search/json', methods=['GET'])
+@read_only
+def search_json():
+    return jsonify(books=[row._asdict() for row in search_books()])
 
 
 @main.route('/register_page', methods=['GET', 'POST'])
+@limiter.limit('register', '10/hour', by_ip, methods=('POST',))
 def register_page():
     if request.method == 'POST':
         first_name = request.form.get('first_name')
@@ -54,11 +163,23 @@ def register_page():
         phone = request.form.get('phone')
         password = request.form.get('password')
 
+        # Start hashing right away; the email check runs while it computes
+        try:
+            pending_hash = hasher.submit_hash(password)
+        except HasherBusy:
+            flash("The server is busy, please try again in a moment.", "danger")
+            return redirect(url_for('main.register_page'))
+
         if User.query.filter_by(email=email).first():
+            pending_hash.cancel()
             flash("Email already registered!", "danger")
             return redirect(url_for('main.register_page'))
 
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+        try:
+            hashed_password = hasher.wait(pending_hash)
+        except HasherBusy:
+            flash("The server is busy, please try again in a moment.", "danger")
+            return redirect(url_for('main.register_page'))
         new_user = User(
             first_name=first_name,
             last_name=last_name,
@@ -80,24 +201,25 @@ def login_page():
     return render_template('login.html')
 
 @main.route('/login_page', methods=['POST'])
+@limiter.limit('login-ip', '30/minute', by_ip)
+@limiter.limit('login-email', '5/minute', by_email)
 def login():
     email = request.form.get('email')
     password = request.form.get('password')
-    
-    # Check regular users
-    user = User.query.filter_by(email=email).first()
-    if user and bcrypt.check_password_hash(user.password_hash, password):
-        session['user_id'] = user.id
-        session['is_admin'] = False
-        return redirect(url_for('main.home'))
-    
-    # Check admin users
-    admin_user = AdminUser.query.filter_by(email=email).first()
-    if admin_user and bcrypt.check_password_hash(admin_user.password_hash, password):
-        session['user_id'] = admin_user.id
-        session['is_admin'] = True
+
+    # One lookup covers both users and admins
+    try:
+        account = authenticate(email, password)
+    except HasherBusy:
+        flash("Too many sign-ins right now, please try again in a moment.", "danger")
+        return redirect(url_for('main.login_page'))
+
+    if account:
+        sign_in(*account)
+        audit_event("Signed in")
         return redirect(url_for('main.home'))
-    
+
+    audit.record("Failed sign-in for %s" % email)
     flash("Invalid credentials", "danger")
     return redirect(url_for('main.login_page'))
 
@@ -105,47 +227,25 @@ def login():
 @main.route('/dashboard')
 @admin_required
 def dashboard():
-    books = Book.query.all()
-    return render_template('dashboard.html', books=books)
+    page = book_list_page()
+    return stream_template('dashboard.html', books=page.items, page=page)
 @main.route('/books/add', methods=['GET', 'POST'])
 def add_book_page():
     if request.method == 'POST':
-        title = request.form.get('title')
-        author = request.form.get('author')
-        genre = request.form.get('genre')
-        availability_input = request.form.get('availability')
-        publisher = request.form.get('publisher')  # NEW
-        year_input = request.form.get('year')      # NEW
-
-        # Convert availability to int
-        try:
-            availability = int(availability_input) if availability_input else 1
-        except ValueError:
-            flash("Availability must be a valid number.", "danger")
-            return redirect(url_for('main.add_book_page'))
-
-        # Convert year to int
         try:
-            year = int(year_input) if year_input else None
-        except ValueError:
-            flash("Year must be a valid number.", "danger")
+            fields = clean_book_fields(request.form)
+        except ValueError as e:
+            flash(str(e), "danger")
             return redirect(url_for('main.add_book_page'))
 
-        if not title or not author:
-            flash("Title and author are required.", "danger")
-            return redirect(url_for('main.add_book_page'))
-
-        new_book = Book(
-            title=title,
-            author=author,
-            genre=genre,
-            availability=availability,
-            publisher=publisher,  # NEW
-            year=year             # NEW
-        )
+        new_book = Book(**fields)
         try:
             db.session.add(new_book)
+            db.session.flush()
+            stock.stock_new_books({new_book.id: new_book.availability})
             db.session.commit()
+            invalidate_books(new_book.id, added=True)
+            audit_event("Added book #%d '%s'" % (new_book.id, new_book.title))
             flash("Book added successfully!", "success")
         except Exception as e:
             db.session.rollback()
@@ -158,34 +258,33 @@ def add_book_page():
 def edit_book_page(id):
     book = Book.query.get_or_404(id)
     if request.method == 'POST':
-        book.title = request.form.get('title')
-        book.author = request.form.get('author')
-        book.genre = request.form.get('genre')
-        publisher = request.form.get('publisher')  # NEW
-        year_input = request.form.get('year')      # NEW
-
-        availability_input = request.form.get('availability')
         try:
-            book.availability = int(availability_input) if availability_input else 1
-        except ValueError:
-            flash("Availability must be a valid number.", "danger")
+            fields = clean_book_fields(request.form)
+        except ValueError as e:
+            flash(str(e), "danger")
             return redirect(url_for('main.edit_book_page', id=id))
 
-        # Convert year to int
+        # The form carries the version and availability the editor started from
         try:
-            book.year = int(year_input) if year_input else None
-        except ValueError:
-            flash("Year must be a valid number.", "danger")
+            changed = update_book(book, fields, request.form.get('version', type=int),
+                                  request.form.get('availability_seen', book.availability, type=int))
+        except EditConflict as e:
+            return render_template('edit_book.html', book=e.book, form=fields,
+                                   diff=edit_diff(e.book, fields)), 409
+        except ValueError as e:
+            flash(str(e), "danger")
             return redirect(url_for('main.edit_book_page', id=id))
-
-        book.publisher = publisher  # NEW
-
-        try:
-            db.session.commit()
-            flash("Book updated successfully!", "success")
         except Exception as e:
             db.session.rollback()
             flash("Error updating book: " + str(e), "danger")
+            return redirect(url_for('main.dashboard'))
+
+        if changed:
+            invalidate_books(id)
+            audit_event("Edited book #%d '%s' (%s)" % (id, fields['title'], ', '.join(changed)))
+            flash("Book updated successfully!", "success")
+        else:
+            flash("Nothing to update.", "info")
         return redirect(url_for('main.dashboard'))
 
     return render_template('edit_book.html', book=book)
@@ -193,9 +292,12 @@ def edit_book_page(id):
 def delete_book(id):
     book = Book.query.get_or_404(id)
     if request.method == 'POST':
+        title = book.title
         try:
             db.session.delete(book)
             db.session.commit()
+            invalidate_books(id)
+            audit_event("Deleted book #%d '%s'" % (id, title))
             flash("Book deleted successfully!", "success")
         except Exception as e:
             db.session.rollback()
@@ -204,66 +306,198 @@ def delete_book(id):
     return render_template('confirm_delete.html', book=book)
 
     
+@main.route('/admin/cache')
+@admin_required
+def cache_stats():
+    """Hit/miss counters of the read-through, template fragment and session caches"""
+    return jsonify(dict(cache.stats(), fragments=fragments.stats(), sessions=sessions.stats()))
+
+
+@main.route('/admin/queries')
+@admin_required
+def query_stats():
+    """Per-endpoint timings, query counts and the N+1 patterns seen"""
+    return jsonify(instrumentation.report())
+
+
+@main.route('/admin/reports')
+@admin_required
+def reports_page():
+    """Loan reports served from the precomputed rollup tables"""
+    return render_template('reports.html', reports=analytics.reports())
+
+
+@main.route('/admin/reports/json')
+@admin_required
+def reports_json():
+    return jsonify(analytics.reports(
+        limit=request.args.get('limit', 20, type=int),
+        months=request.args.get('months', 12, type=int)
+    ))
+
+
+@main.route('/admin/db/health')
+@admin_required
+def db_health():
+    """Reachability, latency, pool state and replica lag of every database"""
+    report = health(db.engines)
+    return jsonify(report), 200 if all(entry['ok'] for entry in report.values()) else 503
+
+
+@main.route('/admin/hasher')
+@admin_required
+def hasher_stats():
+    """Queue depth and latency of the password hashing pool"""
+    return jsonify(hasher.metrics())
+
+
 @main.route('/logout')
 def logout():
-    session.pop('user_id', None)
+    if current_principal() is not None:
+        audit_event("Signed out")
+    sign_out()
     return redirect(url_for('main.login'))
 
 
+@main.route('/loans')
+@login_required
+def my_loans():
+    """The signed-in user's loan history, newest first"""
+    page = loan_list_page(
+        select(BookLoan).where(BookLoan.user_id == current_principal().id),
+        descending=True
+    )
+    return render_template('loans.html', loans=page.items, page=page, today=date.today())
+
+
+@main.route('/admin/loans')
+@admin_required
+def loans_board():
+    """Every book currently out, oldest loan first"""
+    page = loan_list_page(select(BookLoan).where(BookLoan.returned == False))
+    return render_template('loans_board.html', loans=page.items, page=page, today=date.today())
+
+
+@main.route('/loans/<int:loan_id>/return', methods=['POST'])
+@login_required
+def return_book(loan_id):
+    principal = current_principal()
+    is_admin = principal.is_admin
+    # Librarians can check in any loan, readers only their own
+    try:
+        book_id, _ = return_copy(loan_id, user_id=None if is_admin else principal.id)
+    except NotOnLoan:
+        flash("That loan is not open.", "danger")
+    except Exception as e:
+        db.session.rollback()
+        flash("Error returning book: " + str(e), "danger")
+    else:
+        invalidate_books(book_id)
+        audit_event("Returned loan #%d of book #%d" % (loan_id, book_id))
+        flash("Book returned. Thank you!", "success")
+    return redirect(url_for('main.loans_board' if is_admin else 'main.my_loans'))
+
+
 @main.route('/book/<int:book_id>')
+@read_only
 def book_detail(book_id):
-    book = Book.query.get_or_404(book_id)
-    latest_book = Book.query.order_by(Book.id.desc()).first()
+    book = get_book_or_404(book_id)
+    return render_book_detail(book, newest_books(), recommendations.recommended_books(book_id))
+
+
+def render_book_detail(book, newest, also_borrowed):
+    """The book page; app/asgi.py loads the same data asynchronously"""
+    latest_book = newest[0] if newest else None
     user_name = "John Doe"  # Example user name or get from session
     return render_template(
         'book_detail.html',
         book=book,
         latest_book=latest_book,
+        also_borrowed=also_borrowed,
         user_name=user_name
     )
 
 @main.route('/books/borrow/<int:book_id>', methods=['POST'])
+@limiter.limit('borrow', '30/minute', by_user)
 def borrow_book(book_id):
     if request.method == 'GET':
         # Optionally, you can redirect or display a confirmation page
         return redirect(url_for('main.home'))
 
     # Check if user is logged in
-    if 'user_id' not in session:
+    principal = current_principal()
+    if principal is None:
         flash("You must be logged in to borrow books.", "danger")
         return redirect(url_for('main.login_page'))
     
-    # Get the book by id
-    book = Book.query.get_or_404(book_id)
-    
-    # Check if the book is available
-    if book.availability <= 0:
-        flash("No copies left to borrow.", "danger")
-        return redirect(url_for('main.home'))
-    
-    # Set the borrow date to today
-    borrow_date = date.today()
-    # Set the expected return date to one week from today
-    expected_return_date = borrow_date + timedelta(days=7)
-    
-    # Create a new BookLoan record
-    new_loan = BookLoan(
-        book_id=book.id,
-        user_id=session['user_id'],
-        borrow_date=borrow_date,
-        return_date=expected_return_date,
-        returned=False
-    )
-    db.session.add(new_loan)
-    
-    # Decrement the book's availability
-    book.availability -= 1
-    
+    # Claim a copy and record the loan atomically
     try:
-        db.session.commit()
-        flash("Book borrowed successfully! Please return it by " + expected_return_date.strftime('%Y-%m-%d'), "success")
+        loan = borrow_copy(book_id, principal.id,
+                           loan_days=current_app.config.get('LOAN_DAYS', 7))
+    except NoCopiesLeft:
+        if db.session.get(Book, book_id) is None:
+            abort(404)
+        flash("No copies left to borrow. Place a hold and we will let you know when one is set aside "
+              "for you.", "danger")
+        return redirect(url_for('main.book_detail', book_id=book_id))
     except Exception as e:
         db.session.rollback()
         flash("Error borrowing book: " + str(e), "danger")
-    
-    return redirect(url_for('main.home'))
\ No newline at end of file
+        return redirect(url_for('main.home'))
+
+    invalidate_books(book_id)
+    audit_event("Borrowed book #%d (loan #%d)" % (book_id, loan.id))
+    flash("Book borrowed successfully! Please return it by " + loan.return_date.strftime('%Y-%m-%d'), "success")
+    return redirect(url_for('main.home'))
+
+
+@main.route('/books/<int:book_id>/hold', methods=['POST'])
+@login_required
+@limiter.limit('hold', '30/minute', by_user)
+def hold_book(book_id):
+    """Joins the book's reservation line instead of retrying the borrow"""
+    if db.session.get(Book, book_id) is None:
+        abort(404)
+    try:
+        hold = holds.place_hold(book_id, current_principal().id)
+    except AlreadyHolding:
+        flash("You already have a hold on this book.", "info")
+        return redirect(url_for('main.my_holds'))
+    except Exception as e:
+        db.session.rollback()
+        flash("Error placing hold: " + str(e), "danger")
+        return redirect(url_for('main.book_detail', book_id=book_id))
+
+    audit_event("Placed hold #%d on book #%d" % (hold.id, book_id))
+    if hold.status == 'ready':
+        invalidate_books(book_id)
+        flash("A copy is being held for you. Borrow it from My Holds.", "success")
+    else:
+        flash("You are number %d in line. We will let you know when a copy is set aside for you."
+              % holds.queue_position(hold), "success")
+    return redirect(url_for('main.my_holds'))
+
+
+@main.route('/holds')
+@login_required
+def my_holds():
+    """The signed-in user's open holds with their place in line"""
+    return render_template('holds.html', holds=holds.holds_with_positions(current_principal().id))
+
+
+@main.route('/holds/<int:hold_id>/cancel', methods=['POST'])
+@login_required
+def cancel_hold(hold_id):
+    try:
+        principal = current_principal()
+        book_id = holds.cancel_hold(hold_id, user_id=None if principal.is_admin else principal.id)
+    except NoSuchHold:
+        flash("That hold is not open.", "danger")
+    except Exception as e:
+        db.session.rollback()
+        flash("Error cancelling hold: " + str(e), "danger")
+    else:
+        invalidate_books(book_id)
+        audit_event("Cancelled hold #%d on book #%d" % (hold_id, book_id))
+        flash("Hold cancelled.", "success")
+    return redirect(url_for('main.my_holds'))
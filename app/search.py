@@ -0,0 +1,389 @@
+import heapq
+import logging
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from datetime import timedelta
+
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from app.models import Book
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Matches in the title count for more than matches in the publisher
+FIELD_WEIGHTS = {'title': 3.0, 'author': 2.0, 'genre': 1.0, 'publisher': 1.0}
+
+# Query terms also match longer words starting with them, at a discount
+PREFIX_WEIGHT = 0.7
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def _weighted_terms(fields):
+    terms = {}
+    for name, weight in FIELD_WEIGHTS.items():
+        for token in tokenize(fields.get(name)):
+            terms[token] = terms.get(token, 0.0) + weight
+    return terms
+
+
+def _fields(book):
+    fields = {name: getattr(book, name) for name in FIELD_WEIGHTS}
+    fields['year'] = book.year
+    fields['version'] = book.version
+    return fields
+
+
+def _rows(stmt, batch_size):
+    return db.session.execute(stmt.execution_options(yield_per=batch_size))
+
+
+INDEXED_COLUMNS = (Book.id, Book.title, Book.author, Book.genre, Book.publisher, Book.year, Book.version)
+
+
+class SearchIndex:
+    """In-process inverted index over the searchable Book columns.
+
+    Postings are kept as parallel arrays of book ids and term weights
+    sorted by id, and per-book data (including the ids of its terms, to
+    take them out again on an edit) lives in arrays indexed by book id, so
+    a catalog of a million titles costs tens of MB rather than a dict per
+    row. The first search starts a background thread that builds the index
+    and then, every ``refresh_interval`` seconds, reindexes the books whose
+    ``updated_at`` moved, so edits made by other processes (imports, other
+    workers) show up too. Edits in this process apply at commit through the
+    Book mapper events below. Books deleted elsewhere are dropped when a
+    search finds them gone (see forget()).
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.RLock()
+        self.app = None
+        self.k1 = 1.2
+        self.b = 0.75
+        self.max_expansions = 64
+        self.refresh_interval = 30
+        self.refresh_lag = 60
+        self._thread = None
+        self._pid = None
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.k1 = app.config.get('SEARCH_BM25_K1', 1.2)
+        self.b = app.config.get('SEARCH_BM25_B', 0.75)
+        self.max_expansions = app.config.get('SEARCH_MAX_PREFIX_EXPANSIONS', 64)
+        self.refresh_interval = app.config.get('SEARCH_REFRESH_INTERVAL', 30)
+        self.refresh_lag = app.config.get('SEARCH_REFRESH_LAG', 60)
+        app.extensions['search'] = self
+
+    @staticmethod
+    def _empty():
+        return {
+            'ready': False,
+            'postings': {},             # term -> (array of book ids, array of weights)
+            'vocab': [],                # sorted terms, for prefix lookups
+            'term_ids': {},             # term -> its index in terms
+            'terms': [],
+            'doc_len': array('f'),      # indexed by book id, 0 = not indexed
+            'years': array('i'),        # indexed by book id, 0 = unknown
+            'genres': array('I'),       # indexed by book id, id into genre_ids
+            'versions': array('I'),     # indexed by book id, Book.version indexed
+            'doc_terms_at': array('Q'),   # indexed by book id, start in doc_terms
+            'doc_terms_len': array('H'),  # indexed by book id
+            'doc_terms': array('I'),    # term ids of each indexed book, back to back
+            'genre_ids': {None: 0},
+            'doc_count': 0,
+            'total_len': 0.0,
+            # updated_at of the newest change seen, None before any
+            'watermark': None,
+        }
+
+    def _reset(self):
+        self.__dict__.update(self._empty())
+
+    # -- building --------------------------------------------------------
+
+    def build(self, batch_size=5000):
+        """(Re)builds the whole index, streaming the books table.
+
+        The new index is built on the side and swapped in, so searches keep
+        using the old one meanwhile. Changes committed during the build are
+        picked up by the refresh that follows it.
+        """
+        fresh = SearchIndex()
+        watermark = db.session.scalar(select(func.max(Book.updated_at)))
+        for row in _rows(select(*INDEXED_COLUMNS).order_by(Book.id), batch_size):
+            fresh._add(row.id, row._asdict(), keep_vocab_sorted=False)
+        fresh.vocab.sort()
+        fresh.ready = True
+        fresh.watermark = watermark
+        with self._lock:
+            self.__dict__.update({name: getattr(fresh, name) for name in self._empty()})
+        self.refresh(batch_size)
+
+    def refresh(self, batch_size=5000):
+        """Reindexes books whose updated_at is at or after the watermark,
+        less ``refresh_lag`` seconds for transactions that committed late.
+        Rows whose version is the one indexed are skipped."""
+        if not self.ready:
+            return
+        watermark = db.session.scalar(select(func.max(Book.updated_at)))
+        if watermark is None:
+            return
+        stmt = select(*INDEXED_COLUMNS)
+        if self.watermark is not None:
+            stmt = stmt.where(Book.updated_at >= self.watermark - timedelta(seconds=self.refresh_lag))
+        else:
+            stmt = stmt.where(Book.updated_at.isnot(None))
+        with self._lock:
+            for row in _rows(stmt, batch_size):
+                self._put(row.id, row._asdict())
+            self.watermark = watermark
+
+    def reindex(self, book_ids):
+        """Reads these books again now, e.g. after a bulk update that went
+        around the mapper events"""
+        if not self.ready or not book_ids:
+            return
+        found = set()
+        with self._lock:
+            for row in _rows(select(*INDEXED_COLUMNS).where(Book.id.in_(book_ids)), 5000):
+                self._put(row.id, row._asdict())
+                found.add(row.id)
+            self.forget(set(book_ids) - found)
+
+    def forget(self, book_ids):
+        """Drops books that no longer exist"""
+        with self._lock:
+            for book_id in book_ids:
+                self._remove(book_id)
+
+    def invalidate(self):
+        """Drops the index; the next search rebuilds it"""
+        with self._lock:
+            self._reset()
+
+    def _ensure_started(self):
+        # Started lazily so each forked server process gets its own thread
+        if self.app is None or (self._pid == os.getpid() and self._thread is not None):
+            return
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='search-index', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            if self.ready:
+                time.sleep(self.refresh_interval)
+            try:
+                with self.app.app_context():
+                    if self.ready:
+                        self.refresh()
+                    else:
+                        self.build()
+            except Exception:
+                logger.exception('Search index refresh failed')
+                time.sleep(self.refresh_interval)
+
+    # -- postings maintenance ----------------------------------------------
+
+    def _is_indexed(self, book_id):
+        return book_id < len(self.doc_len) and self.doc_len[book_id] > 0
+
+    def _grow(self, book_id):
+        missing = book_id + 1 - len(self.doc_len)
+        if missing > 0:
+            # Grow geometrically so a stream of new ids is amortised O(1)
+            missing = max(missing, len(self.doc_len) // 2)
+            for per_book in (self.doc_len, self.years, self.genres, self.versions,
+                             self.doc_terms_at, self.doc_terms_len):
+                per_book.extend([0] * missing)
+
+    def _term_id(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def _put(self, book_id, fields):
+        """Indexes a book, replacing its entry unless it is already at
+        this version"""
+        if self._is_indexed(book_id):
+            if self.versions[book_id] == (fields.get('version') or 0):
+                return
+            self._remove(book_id)
+        self._add(book_id, fields)
+
+    def _add(self, book_id, fields, keep_vocab_sorted=True):
+        terms = _weighted_terms(fields)
+        if not terms:
+            return
+        self._grow(book_id)
+        for term, weight in terms.items():
+            entry = self.postings.get(term)
+            if entry is None:
+                entry = self.postings[term] = (array('I'), array('f'))
+                if keep_vocab_sorted:
+                    insort(self.vocab, term)
+                else:
+                    self.vocab.append(term)
+            ids, weights = entry
+            if not ids or ids[-1] < book_id:
+                ids.append(book_id)
+                weights.append(weight)
+            else:
+                i = bisect_left(ids, book_id)
+                ids.insert(i, book_id)
+                weights.insert(i, weight)
+
+        genre = (fields.get('genre') or '').lower() or None
+        self.doc_len[book_id] = sum(terms.values())
+        self.years[book_id] = fields.get('year') or 0
+        self.genres[book_id] = self.genre_ids.setdefault(genre, len(self.genre_ids))
+        self.versions[book_id] = fields.get('version') or 0
+        # An edited book's old term ids stay behind in doc_terms until the
+        # next build
+        self.doc_terms_at[book_id] = len(self.doc_terms)
+        self.doc_terms_len[book_id] = len(terms)
+        self.doc_terms.extend(self._term_id(term) for term in terms)
+        self.doc_count += 1
+        self.total_len += self.doc_len[book_id]
+
+    def _remove(self, book_id):
+        if not self._is_indexed(book_id):
+            return
+        at = self.doc_terms_at[book_id]
+        for term_id in self.doc_terms[at:at + self.doc_terms_len[book_id]]:
+            term = self.terms[term_id]
+            entry = self.postings.get(term)
+            if entry is None:
+                continue
+            ids, weights = entry
+            i = bisect_left(ids, book_id)
+            if i < len(ids) and ids[i] == book_id:
+                del ids[i]
+                del weights[i]
+            if not ids:
+                del self.postings[term]
+                del self.vocab[bisect_left(self.vocab, term)]
+        self.doc_count -= 1
+        self.total_len -= self.doc_len[book_id]
+        self.doc_len[book_id] = 0.0
+
+    def apply(self, ops):
+        """Applies committed ('put' | 'remove', book_id, fields) operations"""
+        with self._lock:
+            if not self.ready:
+                return
+            for op, book_id, fields in ops:
+                if op == 'put':
+                    self._put(book_id, fields)
+                else:
+                    self._remove(book_id)
+
+    # -- querying ----------------------------------------------------------
+
+    def _expand(self, token):
+        """Yields (term, weight) for the vocabulary terms a query token matches"""
+        i = bisect_left(self.vocab, token)
+        for term in self.vocab[i:i + self.max_expansions]:
+            if not term.startswith(token):
+                break
+            yield term, 1.0 if term == token else PREFIX_WEIGHT
+
+    def _score_token(self, token, avg_len):
+        scores = {}
+        for term, query_weight in self._expand(token):
+            ids, weights = self.postings[term]
+            idf = math.log(1 + (self.doc_count - len(ids) + 0.5) / (len(ids) + 0.5))
+            for book_id, tf in zip(ids, weights):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[book_id] / avg_len)
+                score = query_weight * idf * tf * (self.k1 + 1) / (tf + norm)
+                if score > scores.get(book_id, 0.0):
+                    scores[book_id] = score
+        return scores
+
+    def search(self, query, genre=None, year=None, limit=20):
+        """Returns [(book_id, score)] for books matching every query token.
+
+        Each token matches whole words and, at a lower weight, words it is
+        a prefix of; results are ranked by BM25.
+        """
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return []
+        self._ensure_started()
+        with self._lock:
+            # Nothing until the first build is done
+            if not self.doc_count:
+                return []
+            avg_len = self.total_len / self.doc_count
+
+            # Score the rarest token first and intersect the rest into it
+            per_token = sorted((self._score_token(t, avg_len) for t in tokens), key=len)
+            scores = per_token[0]
+            for other in per_token[1:]:
+                scores = {i: s + other[i] for i, s in scores.items() if i in other}
+                if not scores:
+                    return []
+
+            if genre:
+                genre_id = self.genre_ids.get(genre.lower())
+                scores = {i: s for i, s in scores.items() if self.genres[i] == genre_id}
+            if year:
+                scores = {i: s for i, s in scores.items() if self.years[i] == year}
+            return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+
+search_index = SearchIndex()
+
+
+# -- keeping the index current ----------------------------------------------
+#
+# Mapper events fire during flush, before we know whether the transaction
+# commits, so changes are staged on the session and applied after commit.
+
+def _stage(target, op, fields):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('search_ops', []).append((op, target.id, fields))
+
+
+@event.listens_for(Book, 'after_insert')
+@event.listens_for(Book, 'after_update')
+def _book_written(mapper, connection, target):
+    _stage(target, 'put', _fields(target))
+
+
+@event.listens_for(Book, 'after_delete')
+def _book_deleted(mapper, connection, target):
+    _stage(target, 'remove', None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_staged(session):
+    ops = session.info.pop('search_ops', None)
+    if ops:
+        search_index.apply(ops)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_staged(session):
+    session.info.pop('search_ops', None)
@@ -0,0 +1,185 @@
+import hashlib
+import secrets
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from flask import g, has_request_context, session
+from sqlalchemy import delete, event, inspect, insert, select, update
+
+from app import db
+from app.cache import Cache, SimpleBackend
+from app.database import RoutingSession
+from app.models import AdminUser, User, UserSession
+
+# The signed-in account of a request: a users.id, or an admin_users.id when
+# is_admin is set
+Principal = namedtuple('Principal', ['id', 'is_admin'])
+
+
+def _digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class SessionStore:
+    """Sign-ins kept on the server.
+
+    The session cookie only carries a random token. The SHA-256 of the token
+    is the key of a ``user_sessions`` row naming the account, so deleting
+    the row revokes the session, and a copy of the table signs no one in.
+    Each process keeps the sessions it has looked up in an LRU for
+    ``cache_ttl`` seconds. A signed-in request is normally resolved without
+    a query, and a session revoked by another process stops working here
+    within that time.
+
+    Sessions last ``lifetime`` (PERMANENT_SESSION_LIFETIME) from their last
+    use. The row is only rewritten once half of that has passed.
+    """
+
+    def __init__(self, app=None):
+        self.front = Cache()
+        self.front.default_ttl = 30
+        self.lifetime = 31 * 86400
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.front.backend = SimpleBackend(app.config.get('SESSION_CACHE_MAX_ENTRIES', 100000))
+        self.front.default_ttl = app.config.get('SESSION_CACHE_TTL', 30)
+        self.lifetime = app.permanent_session_lifetime.total_seconds()
+        app.before_request(_forget_principal)
+        app.context_processor(lambda: {'principal': current_principal() if has_request_context() else None})
+        app.extensions['sessions'] = self
+
+    def create(self, account_id, is_admin):
+        """Stores a new session for the account and returns its token"""
+        token = secrets.token_urlsafe(32)
+        key = _digest(token)
+        expires = time.time() + self.lifetime
+        with db.engine.begin() as connection:
+            connection.execute(insert(UserSession).values(
+                id=key, account_id=account_id, is_admin=bool(is_admin),
+                created_at=datetime.now(), expires_at=datetime.fromtimestamp(expires)
+            ))
+        self.front.set('session:' + key, (account_id, bool(is_admin), expires))
+        return token
+
+    def resolve(self, token):
+        """Returns the Principal of a live session token, otherwise None"""
+        key = _digest(token)
+        # Unknown tokens are remembered too, so guessing costs no queries
+        entry = self.front.get_or_set('session:' + key, lambda: self._load(key))
+        if not entry:
+            return None
+        account_id, is_admin, expires = entry
+        now = time.time()
+        if expires <= now:
+            return None
+        if expires - now < self.lifetime / 2:
+            self._extend(key, account_id, is_admin)
+        return Principal(account_id, is_admin)
+
+    def _load(self, key):
+        # Always the primary: a replica may not have a session created a
+        # moment ago
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                select(UserSession.account_id, UserSession.is_admin, UserSession.expires_at)
+                .where(UserSession.id == key)
+            ).first()
+        if row is None:
+            return False
+        return row.account_id, bool(row.is_admin), row.expires_at.timestamp()
+
+    def _extend(self, key, account_id, is_admin):
+        expires = time.time() + self.lifetime
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(UserSession).where(UserSession.id == key)
+                .values(expires_at=datetime.fromtimestamp(expires))
+            )
+        self.front.set('session:' + key, (account_id, is_admin, expires))
+
+    def revoke(self, token):
+        key = _digest(token)
+        with db.engine.begin() as connection:
+            connection.execute(delete(UserSession).where(UserSession.id == key))
+        self.front.delete('session:' + key)
+
+    def revoke_account(self, account_id, is_admin):
+        """Ends every session of the account. Returns how many there were."""
+        match = (UserSession.account_id == account_id, UserSession.is_admin == bool(is_admin))
+        with db.engine.begin() as connection:
+            keys = connection.execute(select(UserSession.id).where(*match)).scalars().all()
+            connection.execute(delete(UserSession).where(*match))
+        self.front.delete(*['session:' + key for key in keys])
+        return len(keys)
+
+    def prune(self):
+        """Deletes expired sessions; returns how many"""
+        with db.engine.begin() as connection:
+            return connection.execute(
+                delete(UserSession).where(UserSession.expires_at <= datetime.now())
+            ).rowcount
+
+    def stats(self):
+        return self.front.stats()
+
+
+sessions = SessionStore()
+
+
+# -- requests -----------------------------------------------------------------
+
+def _forget_principal():
+    # g outlives the request when an app context was already pushed (tests,
+    # scripts), so never carry a principal over
+    g.pop('principal', None)
+
+
+def current_principal():
+    """The signed-in account, resolved at most once per request"""
+    if 'principal' not in g:
+        token = session.get('sid')
+        g.principal = sessions.resolve(token) if token else None
+    return g.principal
+
+
+def sign_in(account_id, is_admin):
+    # Always a new token, so one planted in the browser beforehand is useless
+    sign_out()
+    session['sid'] = sessions.create(account_id, is_admin)
+    g.principal = Principal(account_id, bool(is_admin))
+
+
+def sign_out():
+    token = session.pop('sid', None)
+    if token:
+        sessions.revoke(token)
+    g.principal = None
+
+
+# -- revocation on password changes -------------------------------------------
+#
+# Changing an account's password through the ORM or deleting the account ends
+# all its sessions once the transaction commits. Bulk UPDATEs (such as the
+# rehash after a login) are not password changes and are not seen here.
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _note_password_changes(db_session, flush_context):
+    for account in list(db_session.dirty) + list(db_session.deleted):
+        if not isinstance(account, (User, AdminUser)) or account.id is None:
+            continue
+        if account in db_session.deleted or inspect(account).attrs.password_hash.history.has_changes():
+            db_session.info.setdefault('revoke', set()).add((account.id, isinstance(account, AdminUser)))
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _revoke_changed_accounts(db_session):
+    for account_id, is_admin in db_session.info.pop('revoke', ()):
+        sessions.revoke_account(account_id, is_admin)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_password_changes(db_session):
+    db_session.info.pop('revoke', None)
@@ -0,0 +1,305 @@
+import atexit
+import logging
+import os
+import random
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import delete, event, func, insert, or_, select, update
+
+from app import backfill, db
+from app.analytics import increment
+from app.database import RoutingSession
+from app.models import Book, BookLoan, BranchStock, Hold
+
+logger = logging.getLogger(__name__)
+
+# The branch copies go to when none is named (new books, imports, loans
+# from before branches); the migration creates it
+DEFAULT_BRANCH_ID = 1
+# books.id up to which an interrupted 'flask stock reconcile' got
+RECONCILE_CHECKPOINT = 'stock_reconcile_book_id'
+
+
+def default_branch_id():
+    return current_app.config.get('DEFAULT_BRANCH_ID', DEFAULT_BRANCH_ID)
+
+
+def _changed(*book_ids):
+    # Recounted into books.availability once the transaction commits
+    db.session.info.setdefault('stock_changed', set()).update(book_ids)
+
+
+# -- allocator ----------------------------------------------------------------
+#
+# Copies on the shelf live in branch_stock, one row per (book, branch,
+# stripe). Most books have a single stripe per branch. Busy titles can be
+# split over several ('flask stock stripe'), so concurrent borrows pick
+# different rows at random and do not queue on one row lock.
+
+def _stripes(book_id, branch_id=None, in_stock=False):
+    stmt = select(BranchStock.branch_id, BranchStock.stripe).where(BranchStock.book_id == book_id)
+    if branch_id is not None:
+        stmt = stmt.where(BranchStock.branch_id == branch_id)
+    if in_stock:
+        stmt = stmt.where(BranchStock.copies > 0)
+    return db.session.execute(stmt).all()
+
+
+def claim_copy(book_id, branch_id=None):
+    """Takes one copy of a book off a shelf inside the caller's transaction.
+
+    Tries the stripes that have copies in random order, each with a
+    conditional ``UPDATE ... WHERE copies > 0``, so a copy is never given
+    out twice and stock never goes negative. Pass ``branch_id`` to only
+    take from that branch. Returns the branch the copy came from, or None
+    when there is none left.
+    """
+    candidates = _stripes(book_id, branch_id, in_stock=True)
+    random.shuffle(candidates)
+    for branch, stripe in candidates:
+        claimed = db.session.execute(
+            update(BranchStock)
+            .where(BranchStock.book_id == book_id, BranchStock.branch_id == branch,
+                   BranchStock.stripe == stripe, BranchStock.copies > 0)
+            .values(copies=BranchStock.copies - 1)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if claimed:
+            _changed(book_id)
+            return branch
+    return None
+
+
+def release_copies(book_id, branch_id=None, count=1):
+    """Puts copies back on a branch's shelf (the default branch if None),
+    on one of its stripes at random"""
+    branch_id = branch_id or default_branch_id()
+    stripes = [stripe for _, stripe in _stripes(book_id, branch_id)]
+    increment(BranchStock, {'book_id': book_id, 'branch_id': branch_id,
+                            'stripe': random.choice(stripes) if stripes else 0}, copies=count)
+    _changed(book_id)
+
+
+def _serve_holds(book_id):
+    # New copies go to the book's line before anyone else can borrow them
+    from app.holds import allocate  # app.holds builds on this module
+    allocate(book_id)
+
+
+def adjust_copies(book_id, delta):
+    """Adds copies at the default branch, or takes copies off any shelf
+    when ``delta`` is negative. Added copies are set aside for waiting
+    holds first. Returns the change made, which is smaller than asked when
+    fewer copies are on the shelves."""
+    if delta > 0:
+        release_copies(book_id, count=delta)
+        _serve_holds(book_id)
+        return delta
+    taken = 0
+    while taken < -delta and claim_copy(book_id) is not None:
+        taken += 1
+    return -taken
+
+
+def stock_new_books(copies):
+    """Shelves the first copies of just inserted books at the default
+    branch; ``copies`` maps book ids to how many"""
+    rows = [{'book_id': book_id, 'branch_id': default_branch_id(), 'stripe': 0, 'copies': count}
+            for book_id, count in copies.items() if count]
+    if rows:
+        db.session.execute(insert(BranchStock), rows)
+    _changed(*copies)
+
+
+def set_copies(copies):
+    """Brings existing books to the given totals on the shelves (a map of
+    book id to copies), as far as copies not on loan allow"""
+    current = dict(db.session.execute(
+        select(BranchStock.book_id, func.sum(BranchStock.copies))
+        .where(BranchStock.book_id.in_(list(copies)))
+        .group_by(BranchStock.book_id)
+    ).all())
+    for book_id, count in copies.items():
+        delta = count - (current.get(book_id) or 0)
+        if delta:
+            adjust_copies(book_id, delta)
+
+
+def set_owned_copies(copies):
+    """Brings existing books to the given numbers of copies owned (a map of
+    book id to copies). Copies out on loan or set aside for a ready hold are
+    owned too, so the shelves get the rest."""
+    book_ids = list(copies)
+    out = dict(db.session.execute(
+        select(BookLoan.book_id, func.count())
+        .where(BookLoan.book_id.in_(book_ids), BookLoan.returned == False)
+        .group_by(BookLoan.book_id)
+    ).all())
+    for book_id, held in db.session.execute(
+        select(Hold.book_id, func.count())
+        .where(Hold.book_id.in_(book_ids), Hold.status == 'ready')
+        .group_by(Hold.book_id)
+    ):
+        out[book_id] = out.get(book_id, 0) + held
+    set_copies({book_id: max(count - out.get(book_id, 0), 0) for book_id, count in copies.items()})
+
+
+def move_copies(book_id, from_branch, to_branch, count):
+    """Moves up to ``count`` shelved copies between branches and commits.
+    Returns how many moved."""
+    moved = 0
+    while moved < count and claim_copy(book_id, from_branch) is not None:
+        moved += 1
+    if moved:
+        release_copies(book_id, to_branch, moved)
+        _serve_holds(book_id)
+    db.session.commit()
+    return moved
+
+
+def restripe(book_id, stripes):
+    """Spreads each branch's copies of a book evenly over ``stripes`` rows
+    and commits. Returns the copies on the shelves."""
+    rows = db.session.execute(
+        select(BranchStock.branch_id, BranchStock.copies)
+        .where(BranchStock.book_id == book_id)
+        .with_for_update()
+    ).all()
+    totals = {}
+    for branch_id, copies in rows:
+        totals[branch_id] = totals.get(branch_id, 0) + copies
+    db.session.execute(delete(BranchStock).where(BranchStock.book_id == book_id))
+    new_rows = [
+        {'book_id': book_id, 'branch_id': branch_id, 'stripe': stripe,
+         'copies': total // stripes + (1 if stripe < total % stripes else 0)}
+        for branch_id, total in totals.items()
+        for stripe in range(stripes)
+    ]
+    if new_rows:
+        db.session.execute(insert(BranchStock), new_rows)
+    db.session.commit()
+    return sum(totals.values())
+
+
+# -- summary ------------------------------------------------------------------
+
+def _recount_stmt(condition):
+    shelved = (select(func.coalesce(func.sum(BranchStock.copies), 0))
+               .where(BranchStock.book_id == Book.id)
+               .scalar_subquery())
+    return (update(Book.__table__)
+            .where(condition, or_(Book.availability.is_(None), Book.availability != shelved))
+            .values(availability=shelved))
+
+
+def recount(book_ids, connection=None):
+    """Sets books.availability to the copies on all shelves, in one UPDATE
+    that only writes the rows that are off. Returns how many were."""
+    stmt = _recount_stmt(Book.id.in_(book_ids))
+    if connection is not None:
+        return connection.execute(stmt).rowcount
+    return db.session.execute(stmt).rowcount
+
+
+def reconcile(batch_size=1000, pause=None, report=None):
+    """Recounts every book's availability from branch_stock, one id range
+    per transaction, resuming where an interrupted run stopped (see
+    app/backfill.py). Returns how many books were off."""
+    return backfill.run(
+        db.session, Book.id,
+        lambda after, upto: db.session.execute(_recount_stmt(backfill.in_range(Book.id, after, upto))).rowcount,
+        name=RECONCILE_CHECKPOINT, batch_size=batch_size, pause=pause, report=report
+    )
+
+
+class StockSummary:
+    """Keeps books.availability, the copies on all shelves, in step with
+    branch_stock.
+
+    Borrows, returns and holds only write branch_stock. Once their
+    transaction commits, the books they touched are queued, and a
+    background thread recounts the queued books every ``interval`` seconds
+    in one UPDATE, then drops their cached pages. A run of loans of one
+    title therefore costs one write to its books row per interval, not one
+    per loan. With ``interval`` 0 (scripts, tests) the recount runs right
+    after the commit. Books queued when a process dies are put right by
+    'flask stock reconcile'.
+    """
+
+    def __init__(self, app=None, interval=0):
+        self.app = None
+        self.interval = interval
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('STOCK_SUMMARY_INTERVAL', 1.0)
+        app.extensions['stock_summary'] = self
+        atexit.register(self.flush)
+
+    def changed(self, book_ids):
+        if not self.interval or self.app is None:
+            self._recount(book_ids)
+            return
+        self._ensure_thread()
+        with self._lock:
+            self._pending.update(book_ids)
+
+    def _ensure_thread(self):
+        # Started lazily so each forked server process gets its own thread
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._pending = set()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='stock-summary', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Recounts the queued books now"""
+        with self._lock:
+            book_ids, self._pending = self._pending, set()
+        if not book_ids:
+            return
+        try:
+            with self.app.app_context():
+                self._recount(book_ids)
+        except Exception:
+            logger.exception('Recounting availability of %d books failed', len(book_ids))
+            with self._lock:
+                self._pending.update(book_ids)
+
+    def _recount(self, book_ids):
+        from app.catalog import invalidate_books
+        book_ids = sorted(book_ids)
+        with db.engine.begin() as connection:
+            recount(book_ids, connection)
+        invalidate_books(*book_ids)
+
+
+summary = StockSummary()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _recount_changed_books(db_session):
+    book_ids = db_session.info.pop('stock_changed', None)
+    if book_ids and has_app_context():
+        summary.changed(book_ids)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_changed_books(db_session):
+    db_session.info.pop('stock_changed', None)
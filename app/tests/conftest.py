@@ -0,0 +1,146 @@
+"""Shared fixtures for the app tests.
+
+Builds the schema with the Alembic migrations and seeds it with synthetic
+data once per test module. Runs on a throwaway SQLite file by default. Point
+QUERY_PLAN_DATABASE_URL at an empty MySQL database to use MySQL instead;
+the tables are dropped afterwards. QUERY_PLAN_BOOKS sets the catalog size
+(loans, users and logs scale with it).
+"""
+import os
+from datetime import date, datetime, timedelta
+
+import pytest
+from flask_migrate import upgrade
+from sqlalchemy import event, insert, text
+
+from app import create_app, db, init_migrate
+from app.cache import cache
+from app.hashing import _hash
+from app.models import AdminUser, Book, BookLoan, Branch, BranchStock, Hold, Log, User
+from app.search import search_index
+from app.sessions import sessions
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                          'migrations')
+BOOKS = int(os.environ.get('QUERY_PLAN_BOOKS', 20000))
+PASSWORD = 'correct horse'
+GENRES = ('Fantasy', 'Science', 'History', 'Poetry', 'Crime', 'Travel', 'Cooking', 'Drama')
+
+
+def make_config(database_url):
+    class QueryPlanConfig:
+        SQLALCHEMY_DATABASE_URI = database_url
+        SECRET_KEY = 'query-plans'
+        TESTING = True
+        BCRYPT_LOG_ROUNDS = 4
+        HASHER_POOL_SIZE = 0
+        CACHE_BACKEND = 'simple'
+        OVERDUE_SINK = 'log'
+        STOCK_SUMMARY_INTERVAL = 0
+        HOLD_NOTICE_INTERVAL = 0
+        BOOK_COUNTS_INTERVAL = 0
+        ANALYTICS_REFRESH_LAG = 0
+        # Tests build and refresh the search index themselves
+        SEARCH_REFRESH_INTERVAL = 3600
+    return QueryPlanConfig
+
+
+def seed(books, chunk=10000):
+    users = max(10, books // 10)
+    loans = books * 3
+    password_hash = _hash(PASSWORD, 4)
+    today = date.today()
+
+    def insert_chunked(model, count, row):
+        for start in range(0, count, chunk):
+            db.session.execute(insert(model), [row(i) for i in range(start, min(start + chunk, count))])
+
+    insert_chunked(Book, books, lambda i: {
+        'title': 'Title %d' % i, 'author': 'Author %d' % (i % 5000), 'genre': GENRES[i % len(GENRES)],
+        'publisher': 'Publisher %d' % (i % 300), 'year': 1950 + i % 75, 'availability': i % 4
+    })
+    # The copies of each book are split between the main branch (made by
+    # the migration) and a second one
+    db.session.execute(insert(Branch), [{'id': 2, 'code': 'east', 'name': 'East branch'}])
+    insert_chunked(BranchStock, books, lambda i: {
+        'book_id': i + 1, 'branch_id': 1, 'stripe': 0, 'copies': (i % 4 + 1) // 2
+    })
+    insert_chunked(BranchStock, books, lambda i: {
+        'book_id': i + 1, 'branch_id': 2, 'stripe': 0, 'copies': i % 4 // 2
+    })
+    insert_chunked(User, users, lambda i: {
+        'first_name': 'First%d' % i, 'last_name': 'Last%d' % i,
+        'email': 'user%d@example.com' % i, 'password_hash': password_hash
+    })
+    db.session.execute(insert(AdminUser), [{
+        'username': 'admin', 'email': 'admin@example.com', 'password_hash': password_hash
+    }])
+    insert_chunked(BookLoan, loans, lambda i: {
+        'book_id': i % books + 1, 'user_id': i % users + 1,
+        'borrow_date': today - timedelta(days=i % 400),
+        'return_date': today - timedelta(days=i % 400 - 7),
+        'returned': i % 5 != 0
+    })
+    insert_chunked(Log, loans, lambda i: {
+        'user_id': i % users + 1, 'action': 'Borrowed book %d' % (i % books + 1)
+    })
+    # Lines of about 40 holds on every 40th of the out-of-stock books (ids
+    # 1, 5, 9, ...), mostly waiting, the rest already settled
+    now = datetime.now()
+    hold_statuses = ('waiting',) * 6 + ('ready', 'fulfilled', 'cancelled', 'expired')
+    insert_chunked(Hold, books, lambda i: {
+        'book_id': 4 * (i % (books // 40)) + 1, 'user_id': i % users + 1,
+        'status': hold_statuses[i % len(hold_statuses)], 'created_at': now - timedelta(minutes=books - i),
+        'expires_at': now - timedelta(days=1) if i % len(hold_statuses) == 6 else None
+    })
+    db.session.commit()
+
+    from app import analytics
+    analytics.rebuild()
+
+    # Give the planner real statistics, as a long-running database has
+    if db.engine.dialect.name == 'mysql':
+        db.session.execute(text('ANALYZE TABLE books, users, admin_users, book_loans, logs, '
+                                'loan_stats_books, loan_stats_users, loan_stats_genre_month'))
+    else:
+        db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    database_url = os.environ.get('QUERY_PLAN_DATABASE_URL') or \
+        'sqlite:///' + str(tmp_path_factory.mktemp('query_plans') / 'plans.db')
+    app = create_app(make_config(database_url))
+    init_migrate(app)
+    with app.app_context():
+        upgrade(directory=MIGRATIONS)
+        seed(BOOKS)
+        search_index.build()
+        yield app
+        db.session.remove()
+        if db.engine.dialect.name != 'sqlite':
+            db.drop_all()
+            db.session.execute(text('DROP TABLE alembic_version'))
+            db.session.commit()
+
+
+@pytest.fixture
+def captured(app):
+    """Records every SELECT sent while the test runs"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.append((statement, parameters))
+
+    cache.clear()
+    event.listen(db.engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def login(client, user_id=1, is_admin=False):
+    token = sessions.create(user_id, is_admin)
+    with client.session_transaction() as session:
+        session['sid'] = token
@@ -0,0 +1,57 @@
+"""Loan rollups: per-book counts and the refresh watermark"""
+from datetime import date, timedelta
+
+from sqlalchemy import func, insert, select, update
+
+from app import analytics, db
+from app.models import BookLoan, BookLoanStats, GenreMonthStats
+from conftest import BOOKS
+
+
+def book_stats(book_id):
+    row = db.session.execute(select(BookLoanStats.borrow_count, BookLoanStats.active_count)
+                             .where(BookLoanStats.book_id == book_id)).first()
+    return tuple(row) if row else (0, 0)
+
+
+def test_book_counts_are_added_after_the_loan_commits(app):
+    from app.loans import borrow_copy, return_copy
+    book_id = BOOKS // 4 * 3 + 4
+    borrows, active = book_stats(book_id)
+
+    loan = borrow_copy(book_id, 3)
+    assert book_stats(book_id) == (borrows + 1, active + 1)
+    return_copy(loan.id)
+    assert book_stats(book_id) == (borrows + 1, active)
+
+    # Queued counts are added together by the next flush
+    counts = analytics.BookCounts()
+    counts.app, counts.interval = app, 3600
+    counts.add({book_id: (1, 1)})
+    counts.add({book_id: (1, 0)})
+    assert book_stats(book_id) == (borrows + 1, active)
+    counts.flush()
+    assert book_stats(book_id) == (borrows + 3, active + 1)
+
+
+def test_refresh_leaves_loans_that_may_not_have_committed(app, monkeypatch):
+    month = date.today().strftime('%Y-%m')
+    counted = select(func.coalesce(func.sum(GenreMonthStats.borrow_count), 0)).where(GenreMonthStats.month == month)
+    analytics.refresh()
+    before = db.session.scalar(counted)
+    monkeypatch.setitem(app.config, 'ANALYTICS_REFRESH_LAG', 60)
+
+    db.session.execute(insert(BookLoan), [
+        {'book_id': book_id, 'user_id': 1, 'borrow_date': date.today(), 'returned': False}
+        for book_id in (BOOKS // 2, BOOKS // 3)
+    ])
+    db.session.commit()
+    assert analytics.refresh() == 0
+    assert db.session.scalar(counted) == before
+
+    # A few minutes on, they are old enough
+    earlier = db.session.scalar(select(func.current_timestamp())) - timedelta(minutes=5)
+    db.session.execute(update(BookLoan).where(BookLoan.created_at >= earlier).values(created_at=earlier))
+    db.session.commit()
+    assert analytics.refresh() == 2
+    assert db.session.scalar(counted) == before + 2
@@ -0,0 +1,94 @@
+"""The JSON API: validators, conditional GETs and compressed listings"""
+import zlib
+
+import pytest
+from sqlalchemy import update
+
+from app import db
+from app.catalog import invalidate_books
+from app.models import Book
+from conftest import BOOKS
+
+
+def bump(book_id):
+    db.session.execute(update(Book).where(Book.id == book_id).values(version=Book.version + 1))
+    db.session.commit()
+    invalidate_books(book_id)
+
+
+def test_book_etag_follows_its_version(app):
+    client = app.test_client()
+    book_id = BOOKS // 7
+    response = client.get('/api/v1/books/%d' % book_id)
+    book = response.get_json()
+    etag = '%d.%d.%d' % (book_id, book['version'], book['availability'])
+    assert response.status_code == 200
+    assert response.get_etag() == (etag, False)
+    assert response.cache_control.no_cache
+
+    # The client's copy is current: nothing but the headers comes back
+    response = client.get('/api/v1/books/%d' % book_id, headers={'If-None-Match': '"%s"' % etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.get_etag() == (etag, False)
+
+    bump(book_id)
+    response = client.get('/api/v1/books/%d' % book_id, headers={'If-None-Match': '"%s"' % etag})
+    assert response.status_code == 200
+    assert response.get_json()['version'] == book['version'] + 1
+    assert response.get_etag()[0] != etag
+
+
+def test_listing_etag_covers_its_rows_and_cursor(app):
+    client = app.test_client()
+    url = '/api/v1/books?after=%d&limit=10' % (BOOKS // 2)
+    response = client.get(url)
+    etag = response.get_etag()[0]
+    assert response.status_code == 200 and len(response.get_json()['books']) == 10
+    assert client.get('/api/v1/books?after=%d&limit=10' % (BOOKS // 2 + 1)).get_etag()[0] != etag
+
+    response = client.get(url, headers={'If-None-Match': '"%s"' % etag})
+    assert response.status_code == 304 and response.get_data() == b''
+
+    bump(BOOKS // 2 + 4)
+    response = client.get(url, headers={'If-None-Match': '"%s"' % etag})
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+
+
+def test_long_listings_stream_gzip(app):
+    client = app.test_client()
+    url = '/api/v1/books?after=%d&limit=200' % (BOOKS // 4)
+    plain = client.get(url)
+    assert 'Content-Encoding' not in plain.headers
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200 and response.is_streamed
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert zlib.decompress(response.get_data(), 31) == plain.get_data()
+    # Each encoding is its own representation with its own validator
+    etag = response.get_etag()[0]
+    assert etag == plain.get_etag()[0] + '-gzip'
+    assert client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"%s"' % etag}).status_code == 304
+    assert client.get(url, headers={'If-None-Match': '"%s"' % etag}).status_code == 200
+
+    # Short listings are sent as they are
+    short = client.get('/api/v1/books?limit=5', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in short.headers
+
+
+def test_brotli_is_preferred_when_installed(app, monkeypatch):
+    client = app.test_client()
+    url = '/api/v1/books?after=%d&limit=200' % (BOOKS // 5)
+    headers = {'Accept-Encoding': 'br, gzip'}
+
+    monkeypatch.setattr('app.api.brotli', None)
+    assert client.get(url, headers=headers).headers['Content-Encoding'] == 'gzip'
+    monkeypatch.undo()
+
+    brotli = pytest.importorskip('brotli')
+    response = client.get(url, headers=headers)
+    assert response.headers['Content-Encoding'] == 'br'
+    assert response.get_etag()[0].endswith('-br')
+    assert brotli.decompress(response.get_data()) == client.get(url).get_data()
@@ -0,0 +1,139 @@
+"""The ASGI adapter: environ, request bodies, streamed responses and errors"""
+import asyncio
+import io
+import zlib
+
+import pytest
+
+from app.asgi import ASYNC_VIEWS, AsgiApp, build_environ
+from app.cache import cache
+from conftest import BOOKS, PASSWORD, login
+
+
+@pytest.fixture
+def asgi(app):
+    asgi = AsgiApp(app)
+    if asgi.engines is None:
+        pytest.skip('no async driver for this database')
+    cache.clear()
+    return asgi
+
+
+def call(asgi, method, url, body=(b'',), headers=()):
+    """Sends one request through the adapter; returns its status, headers
+    and the body messages it sent"""
+    path, _, query = url.partition('?')
+    incoming = [{'type': 'http.request', 'body': chunk, 'more_body': n < len(body) - 1}
+                for n, chunk in enumerate(body)]
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        try:
+            await asgi({'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+                        'headers': [(name.encode(), value.encode()) for name, value in headers],
+                        'http_version': '1.1', 'server': ('testserver', 80)}, receive, send)
+        finally:
+            for engine in asgi.engines:
+                await engine.dispose()
+
+    asyncio.run(run())
+    start, bodies = sent[0], sent[1:]
+    assert start['type'] == 'http.response.start'
+    assert all(message['type'] == 'http.response.body' for message in bodies)
+    # Only the last body message closes the response
+    assert [message.get('more_body', False) for message in bodies] == [True] * (len(bodies) - 1) + [False]
+    return start['status'], {name.decode(): value.decode() for name, value in start['headers']}, bodies
+
+
+def body_of(bodies):
+    return b''.join(message['body'] for message in bodies)
+
+
+def test_environ_carries_the_scope_and_headers():
+    environ = build_environ({
+        'type': 'http', 'method': 'POST', 'root_path': '/lib', 'path': '/lib/café',
+        'query_string': b'q=1', 'http_version': '1.1', 'scheme': 'https',
+        'server': ('library.example', 8443), 'client': ('10.0.0.5', 51000),
+        'headers': [(b'content-type', b'text/plain'), (b'content-length', b'3'),
+                    (b'cookie', b'a=1'), (b'cookie', b'b=2'),
+                    (b'accept', b'text/html'), (b'accept', b'*/*'), (b'x-request-id', b'7')],
+    }, io.BytesIO(b'abc'))
+    assert (environ['SCRIPT_NAME'], environ['PATH_INFO']) == ('/lib', '/café'.encode().decode('latin-1'))
+    assert (environ['REQUEST_METHOD'], environ['QUERY_STRING']) == ('POST', 'q=1')
+    assert (environ['SERVER_NAME'], environ['SERVER_PORT'], environ['REMOTE_ADDR']) == \
+        ('library.example', '8443', '10.0.0.5')
+    assert environ['wsgi.url_scheme'] == 'https'
+    assert (environ['CONTENT_TYPE'], environ['CONTENT_LENGTH']) == ('text/plain', '3')
+    assert 'HTTP_CONTENT_TYPE' not in environ
+    # Repeated cookies join as one Cookie header, other headers with commas
+    assert environ['HTTP_COOKIE'] == 'a=1; b=2'
+    assert environ['HTTP_ACCEPT'] == 'text/html,*/*'
+    assert environ['HTTP_X_REQUEST_ID'] == '7'
+    assert environ['wsgi.input'].read() == b'abc'
+
+
+def test_request_body_in_several_messages_reaches_the_view(app, asgi):
+    form = ('email=user20%40example.com&password=' + PASSWORD.replace(' ', '+')).encode()
+    status, headers, bodies = call(asgi, 'POST', '/login_page', body=(form[:10], form[10:20], form[20:]),
+                                   headers=[('content-type', 'application/x-www-form-urlencoded'),
+                                            ('content-length', str(len(form)))])
+    # Signed in: sent home, not back to the form
+    assert status == 302
+    assert headers['location'] == '/'
+    assert 'session=' in headers['set-cookie']
+
+
+def test_wsgi_routes_stream_chunk_by_chunk(app, asgi):
+    client = app.test_client()
+    expected = client.get('/search?q=Title').get_data()
+    status, headers, bodies = call(asgi, 'GET', '/search?q=Title')
+    assert status == 200 and headers['content-type'].startswith('text/html')
+    assert body_of(bodies) == expected
+
+    # A streamed template goes out as several messages, not one
+    login(client, is_admin=True)
+    cookie = 'session=%s' % client.get_cookie('session').value
+    status, _, bodies = call(asgi, 'GET', '/dashboard', headers=[('cookie', cookie)])
+    assert status == 200 and len(bodies) > 1
+    assert body_of(bodies) == client.get('/dashboard').get_data()
+
+    # And so does a compressed API listing
+    status, headers, bodies = call(asgi, 'GET', '/api/v1/books?limit=200', headers=[('accept-encoding', 'gzip')])
+    assert status == 200 and headers['content-encoding'] == 'gzip'
+    assert len(bodies) > 1
+    assert zlib.decompress(body_of(bodies), 31) == client.get('/api/v1/books?limit=200').get_data()
+
+
+def test_async_views_answer_head_and_missing_books(app, asgi):
+    status, headers, bodies = call(asgi, 'GET', '/book/7')
+    assert status == 200 and b'Title 6' in body_of(bodies)
+    status, head_headers, bodies = call(asgi, 'HEAD', '/book/7')
+    assert status == 200 and body_of(bodies) == b''
+    assert head_headers['content-type'] == headers['content-type']
+
+    status, _, bodies = call(asgi, 'GET', '/book/%d' % (BOOKS * 10))
+    assert status == 404
+    assert body_of(bodies) == app.test_client().get('/book/%d' % (BOOKS * 10)).get_data()
+
+
+def test_errors_become_500s_on_both_paths(app, asgi, monkeypatch):
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', False)
+
+    async def broken(engine, book_id):
+        raise RuntimeError('async view failed')
+
+    def broken_view():
+        raise RuntimeError('wsgi view failed')
+
+    monkeypatch.setitem(ASYNC_VIEWS, 'main.book_detail', broken)
+    monkeypatch.setitem(app.view_functions, 'main.search_page', broken_view)
+    for url in ('/book/7', '/search?q=Title'):
+        status, headers, bodies = call(asgi, 'GET', url)
+        assert status == 500, url
+        assert b'Internal Server Error' in body_of(bodies)
@@ -0,0 +1,96 @@
+"""The audit writer: batching, spilling and refused events"""
+import json
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+
+from app import audit as audit_module, db
+from app.audit import AuditLog, replay_spill
+from app.models import Log
+
+
+def writer(app, **settings):
+    log = AuditLog()
+    log.configure(**settings)
+    log.app = app
+    return log
+
+
+def logged(prefix):
+    return db.session.scalar(select(func.count(Log.id)).where(Log.action.like(prefix + '%')))
+
+
+def test_events_are_written_in_batches(app):
+    log = writer(app, batch_size=3, flush_interval=0.05)
+    for i in range(7):
+        log.record('Batched %d' % i, user_id=1)
+    log.flush()
+    metrics = log.metrics()
+    assert (metrics['queued'], metrics['written']) == (7, 7)
+    assert 3 <= metrics['batches'] <= 7
+    assert logged('Batched') == 7
+    log.close()
+
+
+def test_failed_batches_spill_and_replay(app, tmp_path, monkeypatch):
+    spill = str(tmp_path / 'audit.jsonl')
+    log = writer(app, flush_interval=0.05, spill_path=spill)
+
+    def unavailable(events):
+        raise OperationalError('INSERT', {}, Exception('database is down'))
+    monkeypatch.setattr(audit_module, '_insert_events', unavailable)
+    log.record('Spilled 1', user_id=1)
+    log.record('Spilled 2', admin_id=1)
+    log.flush()
+    assert log.metrics()['spilled'] == 2
+    monkeypatch.undo()
+
+    # One event was spilled before it could be refused by the database
+    with open(spill, 'a') as f:
+        f.write(json.dumps({'user_id': 1, 'admin_id': None, 'action': None,
+                            'timestamp': '2026-01-01T00:00:00'}) + '\n')
+    assert replay_spill(spill) == 2
+    assert logged('Spilled') == 2
+    assert not (tmp_path / 'audit.jsonl').exists()
+    dead = [json.loads(line) for line in (tmp_path / 'audit.jsonl.dead').read_text().splitlines()]
+    assert [event['action'] for event in dead] == [None]
+    log.close()
+
+
+def test_refused_events_go_to_the_dead_letter_file(app, tmp_path):
+    spill = tmp_path / 'audit.jsonl'
+    log = writer(app, flush_interval=0.05, spill_path=str(spill))
+    log.record('Kept 1', user_id=1)
+    log.record(None, user_id=1)
+    log.record('Kept 2', user_id=1)
+    log.flush()
+    metrics = log.metrics()
+    assert (metrics['written'], metrics['refused'], metrics['spilled']) == (2, 1, 0)
+    assert logged('Kept') == 2
+    assert not spill.exists()
+    assert len((tmp_path / 'audit.jsonl.dead').read_text().splitlines()) == 1
+    log.close()
+
+
+def test_events_that_cannot_be_spilled_are_dropped(app, tmp_path):
+    log = writer(app, max_queue=1, block_timeout=0, spill_path=str(tmp_path / 'missing' / 'audit.jsonl'))
+    log._ensure_writer = lambda: None
+    log.record('Queued', user_id=1)
+    log.record('Overflow', user_id=1)
+    assert log.metrics()['dropped'] == 1
+
+
+def test_reconfiguring_drains_the_running_writer(app):
+    log = writer(app, flush_interval=0.05)
+    log.record('Before reconfigure', user_id=1)
+    running = log._thread
+    log.configure(flush_interval=0.05)
+    assert not running.is_alive()
+    assert logged('Before reconfigure') == 1
+
+    log.app = app
+    log.record('After reconfigure', user_id=1)
+    log.flush()
+    assert logged('After reconfigure') == 1
+    assert log.metrics()['written'] == 1
+    log.close()
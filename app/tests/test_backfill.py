@@ -0,0 +1,32 @@
+"""Chunked, resumable backfills"""
+import pytest
+
+from app import db
+from app.models import Book
+from conftest import BOOKS
+
+
+def test_backfill_resumes_from_its_checkpoint_and_uses_indexes(app):
+    from app import backfill
+    batches = []
+    stop_after = 2
+
+    def apply(after, upto):
+        if len(batches) == stop_after:
+            raise RuntimeError('stopped')
+        batches.append((after, upto))
+        return upto - (after or 0)
+
+    with pytest.raises(RuntimeError):
+        backfill.run(db.session, Book.id, apply, name='test_backfill', batch_size=BOOKS // 5)
+    db.session.rollback()
+    assert backfill.get_checkpoint(db.session, 'test_backfill') == batches[-1][1]
+
+    # The rerun starts after the last batch that committed
+    resumed_from = batches[-1][1]
+    batches.clear()
+    stop_after = None
+    done = backfill.run(db.session, Book.id, apply, name='test_backfill', batch_size=BOOKS // 5)
+    assert batches[0][0] == resumed_from and batches[-1][1] == BOOKS
+    assert done == BOOKS - resumed_from
+    assert backfill.get_checkpoint(db.session, 'test_backfill') is None
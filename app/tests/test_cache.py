@@ -0,0 +1,58 @@
+"""The read-through cache: eviction, expiry and invalidation"""
+from sqlalchemy import update
+
+from app import db
+from app.cache import MISSING, Cache, SimpleBackend
+from app.models import Book
+from conftest import BOOKS
+
+
+def test_simple_backend_evicts_least_recently_used():
+    backend = SimpleBackend(max_entries=2)
+    backend.set('a', 1, 60)
+    backend.set('b', 2, 60)
+    assert backend.get('a') == 1
+    backend.set('c', 3, 60)
+    assert backend.get('b') is MISSING
+    assert (backend.get('a'), backend.get('c'), backend.size()) == (1, 3, 2)
+
+
+def test_simple_backend_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('app.cache.time.monotonic', lambda: now[0])
+    backend = SimpleBackend()
+    backend.set('a', 1, 30)
+    now[0] += 29
+    assert backend.get('a') == 1
+    now[0] += 2
+    assert backend.get('a') is MISSING
+    assert backend.size() == 0
+
+
+def test_cache_counts_hits_and_misses_per_namespace():
+    cache = Cache()
+    loads = []
+    for _ in range(3):
+        cache.get_or_set('book:1', lambda: loads.append(1) or 'one')
+    assert loads == [1]
+    assert cache.stats()['namespaces']['book'] == {'hits': 2, 'misses': 1, 'hit_ratio': 2 / 3}
+
+
+def test_book_writes_invalidate_cached_books(app, captured):
+    from app.catalog import get_book_or_404, invalidate_books, newest_books
+    book_id = BOOKS // 5
+    assert get_book_or_404(book_id)['title'] == 'Title %d' % (book_id - 1)
+    newest = newest_books()
+
+    db.session.execute(update(Book).where(Book.id.in_([book_id, newest[0]['id']]))
+                       .values(title='Renamed'))
+    db.session.commit()
+    assert get_book_or_404(book_id)['title'] != 'Renamed'
+
+    invalidate_books(book_id)
+    assert get_book_or_404(book_id)['title'] == 'Renamed'
+    # The newest list only holds other books, so it stays
+    assert newest_books() == newest
+
+    invalidate_books(newest[0]['id'])
+    assert newest_books()[0]['title'] == 'Renamed'
@@ -0,0 +1,33 @@
+"""Editing books"""
+from app import db
+from app.models import Book
+from conftest import BOOKS, login
+
+
+def test_book_edits_keep_concurrent_loans_and_detect_conflicts(app, captured):
+    from app.stock import release_copies
+    book_id = BOOKS // 8 + 1
+    book = db.session.get(Book, book_id)
+    form = {'title': book.title, 'author': book.author, 'genre': book.genre, 'publisher': book.publisher,
+            'year': str(book.year), 'version': str(book.version), 'availability_seen': str(book.availability)}
+    seen_version, seen_availability = book.version, book.availability
+    client = app.test_client()
+    login(client, is_admin=True)
+
+    # Two copies come back while the librarian adds one and retitles the book
+    release_copies(book_id, count=2)
+    db.session.commit()
+    response = client.post('/books/edit/%d' % book_id,
+                           data=dict(form, title='Retitled', availability=str(seen_availability + 1)))
+    assert response.status_code == 302
+    db.session.expire_all()
+    book = db.session.get(Book, book_id)
+    assert (book.title, book.availability, book.version) == ('Retitled', seen_availability + 3, seen_version + 1)
+
+    # A second librarian saving over the old version sees what changed
+    response = client.post('/books/edit/%d' % book_id,
+                           data=dict(form, title='Other title', availability=str(seen_availability)))
+    assert response.status_code == 409
+    assert b'Retitled' in response.data and b'Other title' in response.data
+    db.session.expire_all()
+    assert db.session.get(Book, book_id).title == 'Retitled'
@@ -0,0 +1,40 @@
+"""Read-replica routing"""
+import shutil
+
+import pytest
+from sqlalchemy import create_engine, update
+
+from app import db
+from app.models import Book
+from conftest import BOOKS, login
+
+
+@pytest.fixture
+def lagging_replica(app, tmp_path):
+    """A replica that stopped replicating before the test's writes"""
+    if db.engine.dialect.name != 'sqlite':
+        pytest.skip('copies the SQLite database file')
+    db.session.commit()
+    path = tmp_path / 'replica.db'
+    shutil.copy(db.engine.url.database, path)
+    db.engines['replica0'] = create_engine('sqlite:///%s' % path)
+    try:
+        yield
+    finally:
+        db.engines.pop('replica0').dispose()
+
+
+def test_shared_cache_is_filled_from_the_primary(app, captured, lagging_replica):
+    book_id = BOOKS // 9
+    db.session.execute(update(Book).where(Book.id.in_([book_id, BOOKS]))
+                       .values(title='Fresh title', version=Book.version + 1))
+    db.session.commit()
+
+    client = app.test_client()
+    for url in ('/book/%d' % book_id, '/api/v1/books/%d' % book_id, '/',
+                '/books_page?after=%d' % (book_id - 1)):
+        assert b'Fresh title' in client.get(url).get_data(), url
+
+    # Pages that are not cached still read from the replica
+    login(client, user_id=5)
+    assert b'Fresh title' not in client.get('/books_page?after=%d' % (book_id - 1)).get_data()
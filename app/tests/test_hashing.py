@@ -0,0 +1,29 @@
+"""The password hashing pool under load"""
+from concurrent.futures import Future
+
+from app.hashing import hasher
+from app.models import User
+from conftest import PASSWORD
+
+
+def test_register_turns_away_a_hash_that_takes_too_long(app, monkeypatch):
+    monkeypatch.setattr(hasher, 'submit_hash', lambda password: Future())
+    monkeypatch.setattr(hasher, 'timeout', 0.01)
+    response = app.test_client().post('/register_page', data={
+        'first_name': 'Slow', 'last_name': 'Hash', 'email': 'slow@example.com', 'password': 'secret'
+    })
+    assert response.status_code == 302
+    assert response.location.endswith('/register_page')
+    assert User.query.filter_by(email='slow@example.com').first() is None
+
+
+def test_login_turns_away_a_check_that_takes_too_long(app, monkeypatch):
+    monkeypatch.setattr(hasher, 'submit', lambda fn, *args: Future())
+    monkeypatch.setattr(hasher, 'timeout', 0.01)
+    client = app.test_client()
+    response = client.post('/login_page', data={'email': 'user1@example.com', 'password': PASSWORD})
+    assert response.status_code == 302
+    assert response.location.endswith('/login_page')
+    with client.session_transaction() as session:
+        assert 'sid' not in session
+        assert any('Too many sign-ins' in message for _, message in session['_flashes'])
@@ -0,0 +1,105 @@
+"""Holds: the line is served in order, whatever puts copies back"""
+import pytest
+from sqlalchemy import func, select, update
+
+from app import db, stock
+from app.holds import place_hold
+from app.loans import NoCopiesLeft, borrow_copy
+from app.models import Book, BookLoan, BranchStock, Hold
+from conftest import BOOKS
+
+
+def statuses(book_id):
+    return dict(db.session.execute(select(Hold.user_id, Hold.status).where(Hold.book_id == book_id)).all())
+
+
+def shelved(book_id):
+    return db.session.scalar(select(func.coalesce(func.sum(BranchStock.copies), 0))
+                             .where(BranchStock.book_id == book_id))
+
+
+def test_restocked_copies_go_to_the_line_in_order(app):
+    # Out of stock and nobody in line yet
+    book_id = BOOKS // 2 + 1
+    assert shelved(book_id) == 0 and not statuses(book_id)
+    for user_id in (11, 12, 13):
+        place_hold(book_id, user_id)
+
+    # An edit adding copies serves the oldest holds first
+    stock.adjust_copies(book_id, 2)
+    db.session.commit()
+    assert statuses(book_id) == {11: 'ready', 12: 'ready', 13: 'waiting'}
+    assert shelved(book_id) == 0
+
+    # A copy on the shelf is not lent past the line
+    db.session.execute(update(BranchStock).where(BranchStock.book_id == book_id, BranchStock.branch_id == 1)
+                       .values(copies=BranchStock.copies + 1))
+    db.session.commit()
+    with pytest.raises(NoCopiesLeft):
+        borrow_copy(book_id, 14)
+
+    # Nor is one moved to another branch
+    assert stock.move_copies(book_id, 1, 2, 1) == 1
+    assert statuses(book_id)[13] == 'ready'
+    with pytest.raises(NoCopiesLeft):
+        borrow_copy(book_id, 14)
+    assert borrow_copy(book_id, 11).book_id == book_id
+
+    # An import that raises the copies owned serves the line too
+    from app.cli import upsert_books
+    place_hold(book_id, 15)
+    book = db.session.get(Book, book_id)
+    out = db.session.scalar(select(func.count(BookLoan.id))
+                            .where(BookLoan.book_id == book_id, BookLoan.returned == False))
+    upsert_books([{'title': book.title, 'author': book.author, 'availability': out + 2 + 1}])
+    db.session.commit()
+    assert statuses(book_id)[15] == 'ready'
+    assert shelved(book_id) == 0
+    with pytest.raises(NoCopiesLeft):
+        borrow_copy(book_id, 14)
+
+
+class RecordingSink:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+
+    def send_many(self, notifications):
+        if self.fail:
+            raise OSError('mail server unreachable')
+        self.batches.append([notification['key'] for notification in notifications])
+
+
+def test_ready_notices_are_sent_after_the_commit_in_batches(app, monkeypatch):
+    from app import holds
+    sink = RecordingSink()
+    monkeypatch.setattr('app.overdue.sink_from_config', lambda config: sink)
+    notices = holds.HoldNotices()
+    notices.app, notices.interval = app, 3600
+    monkeypatch.setattr(holds, 'notices', notices)
+
+    book_id = BOOKS // 2 + 5
+    assert shelved(book_id) == 0
+    hold_ids = [place_hold(book_id, user_id).id for user_id in (21, 22)]
+    stock.adjust_copies(book_id, 2)
+    db.session.commit()
+    assert statuses(book_id) == {21: 'ready', 22: 'ready'}
+
+    # Queued by the commit, sent together by the next flush
+    assert sink.batches == []
+    notices.flush()
+    assert sink.batches == [['hold-ready-%d' % hold_id for hold_id in hold_ids]]
+
+
+def test_a_failing_sink_does_not_undo_the_hold(app, monkeypatch, caplog):
+    from app import holds
+    # The migrations' logging config switches existing loggers off
+    monkeypatch.setattr(holds.logger, 'disabled', False)
+    monkeypatch.setattr('app.overdue.sink_from_config', lambda config: RecordingSink(fail=True))
+    book_id = BOOKS // 2 + 9
+    assert shelved(book_id) == 0
+    hold = place_hold(book_id, 23)
+    stock.adjust_copies(book_id, 1)
+    db.session.commit()
+    assert statuses(book_id) == {23: 'ready'}
+    assert 'Could not send hold notices hold-ready-%d' % hold.id in caplog.text
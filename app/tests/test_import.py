@@ -0,0 +1,76 @@
+"""Bulk import: rejected lines and copies owned"""
+import json
+
+from sqlalchemy import func, select
+
+from app import db
+from app.models import Book, BookLoan, BranchStock
+from conftest import BOOKS
+
+
+def shelved(book_id):
+    return db.session.scalar(select(func.coalesce(func.sum(BranchStock.copies), 0))
+                             .where(BranchStock.book_id == book_id))
+
+
+def test_import_rejects_bad_lines_and_sets_copies_owned(app, tmp_path):
+    book = db.session.get(Book, BOOKS // 2 + 1)
+    on_loan = db.session.scalar(select(func.count(BookLoan.id))
+                                .where(BookLoan.book_id == book.id, BookLoan.returned == False))
+    assert on_loan
+    other = db.session.get(Book, BOOKS // 2 + 3)
+    other_shelved = shelved(other.id)
+
+    feed = tmp_path / 'feed.jsonl'
+    feed.write_text('\n'.join([
+        json.dumps({'title': book.title, 'author': book.author, 'availability': on_loan + 2}),
+        '{"title": "Broken',
+        '[1, 2]',
+        json.dumps({'title': other.title, 'author': other.author, 'publisher': 'New publisher'}),
+        json.dumps({'title': 'Imported title', 'author': 'Imported author'}),
+    ]) + '\n')
+    result = app.test_cli_runner().invoke(args=['books', 'import', str(feed)])
+    assert result.exit_code == 0, result.output
+    assert '1 inserted, 2 updated, 2 rejected' in result.output
+
+    rejects = [json.loads(line) for line in (tmp_path / 'feed.jsonl.rejects').read_text().splitlines()]
+    assert [row['line'] for row in rejects] == ['{"title": "Broken', '[1, 2]']
+    assert all(row['error'] for row in rejects)
+
+    # Availability counts the copies on loan; leaving it out keeps the stock
+    db.session.expire_all()
+    assert shelved(book.id) == 2
+    assert db.session.get(Book, book.id).availability == 2
+    assert shelved(other.id) == other_shelved
+    assert db.session.get(Book, other.id).publisher == 'New publisher'
+    new_book = db.session.scalar(select(Book).where(Book.title == 'Imported title'))
+    assert shelved(new_book.id) == new_book.availability == 1
+
+
+def test_import_leaves_columns_the_feed_lacks(app, tmp_path):
+    from app.cli import upsert_books
+    book = db.session.get(Book, BOOKS // 2 + 5)
+    twin = Book(title=book.title, author=book.author, genre='Twin genre', year=1999)
+    db.session.add(twin)
+    db.session.commit()
+    genre, publisher = book.genre, book.publisher
+    assert genre is not None
+
+    feed = tmp_path / 'feed.csv'
+    feed.write_text('title,author,year\n%s,%s,2001\n' % (book.title, book.author))
+    result = app.test_cli_runner().invoke(args=['books', 'import', str(feed)])
+    assert result.exit_code == 0, result.output
+    assert '0 inserted, 2 updated' in result.output
+
+    # Both books with the pair get the year and keep their own genre
+    db.session.expire_all()
+    assert (book.genre, book.publisher, book.year) == (genre, publisher, 2001)
+    assert (twin.genre, twin.year) == ('Twin genre', 2001)
+
+    # Within a batch the last row for a pair wins, and only its columns
+    upsert_books([{'title': book.title, 'author': book.author, 'genre': 'First'},
+                  {'title': book.title, 'author': book.author, 'publisher': 'Last'}])
+    db.session.commit()
+    db.session.expire_all()
+    assert (book.genre, book.publisher) == (genre, 'Last')
+    assert (twin.genre, twin.publisher) == ('Twin genre', 'Last')
@@ -0,0 +1,79 @@
+"""Request metrics: /metrics, per-endpoint counters and N+1 detection"""
+import re
+
+from flask import jsonify
+from sqlalchemy import select
+
+from app import db
+from app.instrumentation import instrumentation
+from app.models import Book
+from conftest import login
+
+
+def sample(text, name, **labels):
+    """The value of one sample in Prometheus text, or None"""
+    wanted = ','.join('%s="%s"' % item for item in labels.items())
+    match = re.search(r'^%s\{%s\} (\S+)$' % (re.escape(name), re.escape(wanted)), text, re.M)
+    return None if match is None else float(match.group(1))
+
+
+def test_metrics_count_requests_per_endpoint(app):
+    instrumentation._reset()
+    client = app.test_client()
+    for _ in range(2):
+        assert client.get('/book/7').status_code == 200
+    assert client.get('/book/999999999').status_code == 404
+    assert client.get('/api/v1/books/7').status_code == 200
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert '# TYPE library_request_duration_seconds histogram' in text
+
+    detail = {'endpoint': 'main.book_detail', 'method': 'GET'}
+    assert sample(text, 'library_request_duration_seconds_count', **detail) == 3
+    assert sample(text, 'library_request_duration_seconds_bucket', **detail, le='+Inf') == 3
+    assert sample(text, 'library_request_queries_count', **detail) == 3
+    assert sample(text, 'library_responses_total', **detail, status=200) == 2
+    assert sample(text, 'library_responses_total', **detail, status=404) == 1
+    assert sample(text, 'library_responses_total', endpoint='api.book', method='GET', status=200) == 1
+    # Buckets are cumulative
+    buckets = [float(value) for value in re.findall(
+        r'^library_request_queries_bucket\{endpoint="main.book_detail",method="GET",le="[^"]+"\} (\S+)$', text, re.M)]
+    assert buckets == sorted(buckets) and buckets[-1] == 3
+    # The other extensions' gauges are collected too
+    assert 'library_cache_entries' in text and 'library_hasher_queue_depth' in text
+
+
+def test_repeated_statements_are_reported_as_n_plus_one(app, monkeypatch):
+    instrumentation._reset()
+    assert instrumentation.n_plus_one_threshold == 5
+
+    def titles(count):
+        def view():
+            # One query per book, the loop an N+1 is made of
+            return jsonify([db.session.scalar(select(Book.title).where(Book.id == book_id))
+                            for book_id in range(1, count + 1)])
+        return view
+
+    client = app.test_client()
+    monkeypatch.setitem(app.view_functions, 'main.search_page', titles(4))
+    assert client.get('/search').status_code == 200
+    monkeypatch.setitem(app.view_functions, 'main.search_json', titles(6))
+    assert client.get('/search/json').status_code == 200
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert sample(text, 'library_n_plus_one_requests_total', endpoint='main.search_json', method='GET') == 1
+    assert sample(text, 'library_n_plus_one_requests_total', endpoint='main.search_page', method='GET') is None
+
+    # Only librarians see the patterns
+    assert client.get('/admin/queries').status_code == 302
+    login(client, is_admin=True)
+    report = client.get('/admin/queries').get_json()
+    assert report['endpoints']['GET main.search_json']['n_plus_one_requests'] == 1
+    assert report['endpoints']['GET main.search_page']['n_plus_one_requests'] == 0
+    [pattern] = report['n_plus_one']
+    assert (pattern['endpoint'], pattern['requests'], pattern['max_repeats']) == ('main.search_json', 1, 6)
+    assert pattern['statement'].upper().startswith('SELECT')
+    assert 'books' in pattern['statement']
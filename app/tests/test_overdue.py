@@ -0,0 +1,63 @@
+"""The overdue job: one notice per loan and fines that reruns leave alone"""
+from collections import Counter
+from datetime import date, timedelta
+from decimal import Decimal
+
+from sqlalchemy import func, select
+
+from app import db
+from app.models import BookLoan, Log
+from app.overdue import fine_for, process_overdue
+
+
+class RecordingSink:
+    def __init__(self):
+        self.notifications = []
+
+    def send_many(self, notifications):
+        self.notifications.extend(notifications)
+
+
+def fines():
+    return dict(db.session.execute(select(BookLoan.id, BookLoan.fine)
+                                   .where(BookLoan.returned == False, BookLoan.return_date < date.today())).all())
+
+
+def overdue_logs():
+    return db.session.scalar(select(func.count(Log.id)).where(Log.action.like('Loan #% overdue by %')))
+
+
+def test_reruns_neither_renotify_nor_refine(app):
+    overdue = db.session.execute(select(BookLoan.id, BookLoan.return_date)
+                                 .where(BookLoan.returned == False, BookLoan.return_date < date.today())).all()
+    assert len(overdue) > 500
+
+    sink = RecordingSink()
+    seen, sent = process_overdue(sink, batch_size=97)
+    assert seen == sent == len(overdue)
+    keys = Counter(notification['key'] for notification in sink.notifications)
+    assert keys == Counter('overdue-loan-%d' % loan.id for loan in overdue)
+    first = fines()
+    assert first == {loan.id: fine_for((date.today() - loan.return_date).days, Decimal('0.25'), Decimal('10.00'))
+                     for loan in overdue}
+    logged = overdue_logs()
+    assert logged == len(overdue)
+
+    # Run again: every loan is seen, none notified, logged or fined twice
+    rerun = RecordingSink()
+    assert process_overdue(rerun, batch_size=50) == (len(overdue), 0)
+    assert rerun.notifications == []
+    assert fines() == first
+    assert overdue_logs() == logged
+
+    # Days later the fines grow to the cap; only loans that fell due since
+    # are notified
+    later = RecordingSink()
+    process_overdue(later, today=date.today() + timedelta(days=3))
+    due_since = db.session.scalars(select(BookLoan.id).where(
+        BookLoan.returned == False, BookLoan.return_date >= date.today(),
+        BookLoan.return_date < date.today() + timedelta(days=3))).all()
+    assert due_since
+    assert sorted(notification['loan_id'] for notification in later.notifications) == sorted(due_since)
+    for loan_id, fine in fines().items():
+        assert fine == min(first[loan_id] + Decimal('0.75'), Decimal('10.00'))
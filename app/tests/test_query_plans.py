@@ -0,0 +1,252 @@
+"""Query-plan regression tests.
+
+Drives every route in app/routes.py (and the batch jobs) through the test
+client against the seeded database (see conftest.py) while recording the
+SELECTs they send, and EXPLAINs each one. A test fails when a query reads a
+whole table or index, unless it is an index-ordered scan that stops at a
+LIMIT (the first page of a keyset walk).
+
+Point QUERY_PLAN_DATABASE_URL at an empty MySQL database to check MySQL
+plans instead:
+
+    QUERY_PLAN_DATABASE_URL=mysql://user:pw@localhost/library_plans \\
+        python -m pytest app/tests/test_query_plans.py
+"""
+import re
+
+import pytest
+from sqlalchemy import event
+
+from app import db
+from app.cache import cache
+from app.models import Book
+from app.sessions import sessions
+from conftest import BOOKS, PASSWORD, login
+
+
+# -- plans ----------------------------------------------------------------------
+
+def sqlite_problems(statement, parameters):
+    rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)
+    details = [row[3] for row in rows]
+    sorts = any(detail.startswith('USE TEMP B-TREE') for detail in details)
+    problems = []
+    for detail in details:
+        if not detail.startswith('SCAN ') or detail.startswith(('SCAN CONSTANT ROW', 'SCAN (')):
+            continue
+        # 'SCAN books' on a rowid table or 'SCAN t USING INDEX' walk in
+        # order, so with a LIMIT and no sort they stop after a page
+        if re.search(r'\bLIMIT\b', statement) and not sorts:
+            continue
+        problems.append(detail)
+    return problems, details
+
+
+def mysql_problems(statement, parameters):
+    result = db.session.connection().exec_driver_sql('EXPLAIN ' + statement, parameters)
+    rows = [row._asdict() for row in result]
+    problems = []
+    for row in rows:
+        extra = row.get('Extra') or ''
+        limited = re.search(r'\bLIMIT\b', statement) and 'filesort' not in extra
+        if row['type'] == 'ALL' or (row['type'] == 'index' and not limited):
+            problems.append('%s: type=%s %s' % (row['table'], row['type'], extra))
+    return problems, rows
+
+
+def assert_no_full_scans(statements):
+    assert statements, 'no queries were captured'
+    explain = mysql_problems if db.engine.dialect.name == 'mysql' else sqlite_problems
+    failures = []
+    for statement, parameters in statements:
+        problems, plan = explain(statement, parameters)
+        if problems:
+            failures.append('%s\n  full scan: %s\n  plan: %s' % (statement, problems, plan))
+    db.session.rollback()
+    assert not failures, '\n\n'.join(failures)
+
+
+# -- routes -----------------------------------------------------------------------
+
+# (id, method, url, form, signed in as, expected status, expected text).
+# The text is looked for in the body of a 2xx answer and in the Location of
+# a redirect, so each route is known to have taken the path whose queries
+# are checked, not bounced off a login, a 404 or a conflict.
+ROUTES = [
+    ('home', 'GET', '/', None, None, 200, 'Title %d' % (BOOKS - 1)),
+    ('books_page', 'GET', '/books_page', None, None, 200, 'Title 0'),
+    ('books_page_after', 'GET', '/books_page?after=%d' % (BOOKS // 2), None, None, 200, 'Title %d' % (BOOKS // 2)),
+    ('books_page_before', 'GET', '/books_page?before=%d' % (BOOKS // 2), None, None, 200,
+     'Title %d' % (BOOKS // 2 - 2)),
+    ('books_page_json', 'GET', '/books_page/json?limit=200', None, None, 200, '"title":"Title 199"'),
+    ('search', 'GET', '/search?q=title+author&genre=Poetry', None, None, 200, 'Poetry'),
+    ('search_json', 'GET', '/search/json?q=publ&year=1990', None, None, 200, '"year":1990'),
+    ('book_detail', 'GET', '/book/%d' % (BOOKS // 3), None, None, 200, 'Title %d' % (BOOKS // 3 - 1)),
+    ('register', 'POST', '/register_page', {
+        'first_name': 'New', 'last_name': 'Reader', 'email': 'new.reader@example.com', 'password': PASSWORD
+    }, None, 302, '/login_page'),
+    ('login_user', 'POST', '/login_page', {'email': 'user1@example.com', 'password': PASSWORD}, None, 302, '/'),
+    ('login_admin', 'POST', '/login_page', {'email': 'admin@example.com', 'password': PASSWORD}, None, 302, '/'),
+    ('dashboard', 'GET', '/dashboard', None, 'admin', 200, 'Title 0'),
+    ('edit_book', 'GET', '/books/edit/%d' % (BOOKS // 4), None, 'admin', 200, 'Title %d' % (BOOKS // 4 - 1)),
+    ('update_book', 'POST', '/books/edit/%d' % (BOOKS // 4), {
+        'title': 'Renamed', 'author': 'Author 1', 'availability': '3', 'version': '1', 'availability_seen': '3'
+    }, 'admin', 302, '/dashboard'),
+    ('confirm_delete', 'GET', '/books/delete/%d' % (BOOKS // 5), None, 'admin', 200, 'Title %d' % (BOOKS // 5 - 1)),
+    ('reports', 'GET', '/admin/reports', None, 'admin', 200, 'Fantasy'),
+    ('reports_json', 'GET', '/admin/reports/json?months=24', None, 'admin', 200, '"borrows_by_genre_month"'),
+    ('my_loans', 'GET', '/loans', None, 'user', 200, 'Title %d' % (BOOKS - 2000)),
+    ('my_loans_after', 'GET', '/loans?after=%d' % (BOOKS * 2), None, 'user', 200, 'Title %d' % (BOOKS - 4000)),
+    ('loans_board', 'GET', '/admin/loans', None, 'admin', 200, '@example.com'),
+    ('loans_board_before', 'GET', '/admin/loans?before=%d' % BOOKS, None, 'admin', 200, 'Title'),
+    ('return_loan', 'POST', '/loans/1/return', {}, 'admin', 302, '/admin/loans'),
+    ('borrow', 'POST', '/books/borrow/%d' % (BOOKS // 6 * 4 + 4), {}, 'user', 302, '/'),
+    ('api_books', 'GET', '/api/v1/books?limit=200', None, None, 200, '"title": "Title 199"'),
+    ('api_books_after', 'GET', '/api/v1/books?after=%d' % (BOOKS // 2), None, None, 200,
+     '"id": %d' % (BOOKS // 2 + 1)),
+    ('api_book', 'GET', '/api/v1/books/%d' % (BOOKS // 3), None, None, 200, '"id": %d' % (BOOKS // 3)),
+    ('api_loans', 'GET', '/api/v1/loans', None, 'user', 200, '"loans":[{'),
+    ('api_loans_before', 'GET', '/api/v1/loans?before=%d' % (BOOKS * 2), None, 'user', 200, '"loans":[{'),
+    ('api_borrow', 'POST', '/api/v1/books/%d/borrow' % (BOOKS // 6 * 4 + 2), {}, 'user', 201,
+     '"book_id":%d' % (BOOKS // 6 * 4 + 2)),
+    ('api_return', 'POST', '/api/v1/loans/6/return', {}, 'admin', 200, '"returned":true'),
+    ('hold_book', 'POST', '/books/5/hold', {}, 'user', 302, '/holds'),
+    ('my_holds', 'GET', '/holds', None, 'user', 200, 'Title 0'),
+    ('cancel_hold', 'POST', '/holds/7/cancel', {}, 'admin', 302, '/holds'),
+    ('api_place_hold', 'POST', '/api/v1/books/9/holds', {}, 'user', 201, '"status":"waiting"'),
+    ('api_holds', 'GET', '/api/v1/holds', None, 'user', 200, '"holds": [{'),
+    ('api_cancel_hold', 'DELETE', '/api/v1/holds/2', {}, 'admin', 200, '"cancelled":true'),
+]
+
+
+def assert_answered(client, response, status, expected):
+    """The route did what its plan check assumes it did"""
+    assert response.status_code == status, (response.status_code, response.get_data(as_text=True)[:500])
+    if status == 302:
+        assert response.location == expected
+        with client.session_transaction() as session:
+            flashes = session.get('_flashes', [])
+        assert all(category == 'success' for category, _ in flashes), flashes
+    else:
+        assert expected in response.get_data(as_text=True)
+
+
+@pytest.mark.parametrize('method, url, data, who, status, expected', [route[1:] for route in ROUTES],
+                         ids=[route[0] for route in ROUTES])
+def test_route_queries_use_indexes(app, captured, method, url, data, who, status, expected):
+    client = app.test_client()
+    if who:
+        login(client, is_admin=(who == 'admin'))
+    response = client.open(url, method=method, data=data)
+    assert_answered(client, response, status, expected)
+    assert_no_full_scans(captured)
+
+
+def test_delete_book_queries_use_indexes(app, captured):
+    # Every seeded book has loans, which keep it from being deleted
+    book = Book(title='Withdrawn', author='Nobody')
+    db.session.add(book)
+    db.session.commit()
+    del captured[:]
+    client = app.test_client()
+    login(client, is_admin=True)
+    response = client.post('/books/delete/%d' % book.id)
+    assert_answered(client, response, 302, '/dashboard')
+    assert db.session.get(Book, book.id) is None
+    assert_no_full_scans(captured)
+
+
+def test_async_pages_match_wsgi_and_use_indexes(app, captured):
+    import asyncio
+    from app.asgi import AsgiApp
+
+    asgi = AsgiApp(app)
+    if asgi.engines is None:
+        pytest.skip('no async driver for this database')
+    urls = ['/', '/books_page?after=%d' % (BOOKS // 3), '/books_page?before=%d' % (BOOKS // 2), '/book/7']
+
+    async def get(url):
+        path, _, query = url.partition('?')
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+                    'headers': [], 'http_version': '1.1'}, receive, send)
+        return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+    async def get_all():
+        try:
+            return [await get(url) for url in urls]
+        finally:
+            await asgi.engines[0].dispose()
+
+    client = app.test_client()
+    expected = [(response.status_code, response.get_data()) for response in map(client.get, urls)]
+    cache.clear()
+    del captured[:]
+    event.listen(asgi.engines[0].sync_engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, parameters, *rest: captured.append((statement, parameters)))
+    assert asyncio.run(get_all()) == expected
+    assert_no_full_scans(captured)
+
+
+def test_session_lookup_uses_indexes(app, captured):
+    client = app.test_client()
+    login(client, user_id=4)
+    # As another process would, find the session by its key
+    sessions.front.clear()
+    assert client.get('/holds').status_code == 200
+    assert_no_full_scans(captured)
+
+
+# -- batch jobs -------------------------------------------------------------------
+
+def test_import_lookup_uses_indexes(app, captured):
+    from app.cli import upsert_books
+    upsert_books([{'title': 'Title %d' % i, 'author': 'Author %d' % (i % 5000), 'availability': 2}
+                  for i in range(0, BOOKS, BOOKS // 50)])
+    assert_no_full_scans(captured)
+
+
+def test_overdue_job_uses_indexes(app, captured):
+    from app.overdue import LogSink, process_overdue
+    process_overdue(LogSink(), batch_size=500)
+    assert_no_full_scans(captured)
+
+
+def test_hold_expiry_uses_indexes(app, captured):
+    from app.holds import expire_holds
+    expire_holds(batch_size=200)
+    assert_no_full_scans(captured)
+
+
+def test_recommendations_refresh_uses_indexes(app, captured):
+    from app import analytics, recommendations
+    analytics.set_state(recommendations.WATERMARK, BOOKS * 3 - 500)
+    db.session.commit()
+    recommendations.refresh(batch_size=200)
+    assert_no_full_scans(captured)
+
+
+def test_stock_jobs_use_indexes(app, captured):
+    from app import stock
+    stock.restripe(BOOKS // 8 * 5 + 2, 4)
+    stock.reconcile(batch_size=BOOKS // 4)
+    assert_no_full_scans(captured)
+
+
+def test_backfill_walk_uses_indexes(app, captured):
+    from app import backfill
+    backfill.run(db.session, Book.id, lambda after, upto: None, name='plan_walk', batch_size=BOOKS // 5)
+    assert_no_full_scans(captured)
+
+
+def test_analytics_refresh_uses_indexes(app, captured):
+    from app import analytics
+    analytics.refresh()
+    assert_no_full_scans(captured)
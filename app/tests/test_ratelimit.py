@@ -0,0 +1,29 @@
+"""Rate limits: requests over a limit are refused before any query is sent"""
+import pytest
+
+from conftest import BOOKS, login
+
+
+@pytest.mark.parametrize('limit, url, who', [
+    ('login-email', '/login_page', None),
+    ('borrow', '/books/borrow/%d' % (BOOKS // 6 * 4 + 3), 'user'),
+    ('borrow', '/api/v1/books/%d/borrow' % (BOOKS // 6 * 4 + 3), 'user'),
+], ids=['login', 'borrow', 'api_borrow'])
+def test_rate_limited_requests_send_no_queries(app, captured, limit, url, who):
+    from app.ratelimit import limiter
+    client = app.test_client()
+    if who:
+        login(client, user_id=2)
+    form = {'email': 'user2@example.com', 'password': 'wrong'}
+    limiter.reset()
+    limiter.rates[limit] = '1/hour'
+    try:
+        client.post(url, data=form)
+        del captured[:]
+        response = client.post(url, data=form)
+    finally:
+        del limiter.rates[limit]
+        limiter.reset()
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+    assert not captured
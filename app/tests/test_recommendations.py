@@ -0,0 +1,106 @@
+"""Also-borrowed lists: the full rebuild, the incremental refresh and the cache"""
+import hashlib
+from datetime import date
+
+import pytest
+from sqlalchemy import insert, select, update
+
+from app import db, recommendations
+from app.models import BookCoBorrow, BookLoan, BookRecommendation
+from app.recommendations import recommended_books
+from conftest import BOOKS
+
+
+def digest():
+    """Row count and a hash of both tables, read in key order"""
+    summary = []
+    for stmt in (
+        select(BookCoBorrow.book_id, BookCoBorrow.other_id, BookCoBorrow.readers)
+        .order_by(BookCoBorrow.book_id, BookCoBorrow.other_id),
+        select(BookRecommendation.book_id, BookRecommendation.rank, BookRecommendation.recommended_id,
+               BookRecommendation.readers)
+        .order_by(BookRecommendation.book_id, BookRecommendation.rank),
+    ):
+        sha, count = hashlib.sha1(), 0
+        for row in db.session.execute(stmt.execution_options(yield_per=50000)):
+            sha.update(repr(tuple(row)).encode())
+            count += 1
+        summary.append((count, sha.hexdigest()))
+    return summary
+
+
+def borrow(*loans):
+    db.session.execute(insert(BookLoan), [
+        {'book_id': book_id, 'user_id': user_id, 'borrow_date': date.today(), 'returned': False}
+        for user_id, book_id in loans
+    ])
+    db.session.commit()
+
+
+def books_of(user_id):
+    return db.session.scalars(select(BookLoan.book_id).where(BookLoan.user_id == user_id)
+                              .order_by(BookLoan.id)).all()
+
+
+def test_rebuild_matches_without_numpy(app, monkeypatch):
+    pytest.importorskip('numpy')
+    assert recommendations.rebuild() > 0
+    with_numpy = digest()
+
+    # A budget this small makes the NumPy path merge many partial counts
+    recommendations.rebuild(partitions=3, pair_budget=20000)
+    assert digest() == with_numpy
+
+    monkeypatch.setattr(recommendations, '_numpy', lambda: None)
+    recommendations.rebuild(partitions=3)
+    assert digest() == with_numpy
+
+
+def test_refresh_matches_a_fresh_rebuild(app, monkeypatch):
+    # Seeded readers have 10 distinct books; a cap just above that is hit
+    monkeypatch.setitem(app.config, 'RECOMMENDATIONS_MAX_BOOKS_PER_READER', 12)
+    recommendations.rebuild()
+    capped, other = 7, 8
+    assert len(set(books_of(capped))) == 10
+
+    read = set(books_of(capped))
+    fresh = [book_id for book_id in range(BOOKS, 1, -1) if book_id not in read][:4]
+    borrow(
+        # A repeat borrow pairs with nothing new
+        (capped, books_of(capped)[3]),
+        # Only the first two new books fit under the cap
+        *[(capped, book_id) for book_id in fresh],
+        (other, fresh[0]), (other, BOOKS // 2 + 11),
+    )
+    assert recommendations.refresh(batch_size=3) == 7
+    refreshed = digest()
+
+    pairs = dict(db.session.execute(select(BookCoBorrow.other_id, BookCoBorrow.readers)
+                                    .where(BookCoBorrow.book_id == fresh[0])).all())
+    assert fresh[1] in pairs and fresh[2] not in pairs and fresh[3] not in pairs
+
+    recommendations.rebuild()
+    assert digest() == refreshed
+
+
+def test_recommended_books_are_ranked_and_cached(app):
+    recommendations.rebuild()
+    book_id = books_of(9)[0]
+    listed = recommended_books(book_id)
+    assert listed and len(listed) <= recommendations.TOP_K
+    readers = [row['readers'] for row in listed]
+    assert readers == sorted(readers, reverse=True)
+    assert [row['id'] for row in listed] == db.session.scalars(
+        select(BookRecommendation.recommended_id).where(BookRecommendation.book_id == book_id)
+        .order_by(BookRecommendation.rank)).all()
+
+    # Served from the cache until a refresh touches the book
+    last = listed[-1]['id']
+    db.session.execute(update(BookCoBorrow).where(BookCoBorrow.book_id == book_id, BookCoBorrow.other_id == last)
+                       .values(readers=1000))
+    db.session.commit()
+    assert recommended_books(book_id) == listed
+
+    borrow((9, BOOKS - 3))
+    assert recommendations.refresh() == 1
+    assert recommended_books(book_id)[0] == dict(listed[-1], readers=1000)
@@ -0,0 +1,15 @@
+"""Page and fragment caching"""
+from conftest import BOOKS
+
+
+def test_anonymous_pages_are_cached_until_a_book_changes(app, captured):
+    from app.catalog import invalidate_books
+    client = app.test_client()
+    url = '/books_page?after=%d' % (BOOKS // 7)
+    page = client.get(url).get_data()
+    del captured[:]
+    assert client.get(url).get_data() == page
+    assert not captured
+    invalidate_books(BOOKS // 7 + 1)
+    assert client.get(url).get_data() == page
+    assert captured
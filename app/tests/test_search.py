@@ -0,0 +1,74 @@
+"""Full-text catalog search"""
+import time
+
+import pytest
+from sqlalchemy import delete, update
+
+from app import db
+from app.models import Book
+from app.search import SearchIndex, search_index
+
+
+def add_books(*rows):
+    books = [Book(author='Search Author', availability=0, **row) for row in rows]
+    db.session.add_all(books)
+    db.session.commit()
+    return [book.id for book in books]
+
+
+def ids(query, **filters):
+    return [book_id for book_id, _ in search_index.search(query, **filters)]
+
+
+@pytest.fixture(scope='module')
+def books(app):
+    return add_books(
+        {'title': 'Quokka Tales', 'genre': 'Travel', 'year': 2001},
+        {'title': 'Island Notes', 'publisher': 'Quokka Press', 'genre': 'Travel', 'year': 2001},
+        {'title': 'Quokkas at Dusk', 'genre': 'Poetry', 'year': 2010},
+    )
+
+
+def test_title_matches_rank_above_publisher_matches_and_prefixes(books):
+    tales, notes, dusk = books
+    assert ids('quokka') == [tales, dusk, notes]
+    assert set(ids('quok')) == set(books)
+    assert ids('quokka island') == [notes]
+
+
+def test_filters_by_genre_and_year(books):
+    tales, notes, dusk = books
+    assert ids('quokka', genre='poetry') == [dusk]
+    assert set(ids('quokka', year=2001)) == {tales, notes}
+
+
+def test_edits_are_picked_up_wherever_they_were_made(app):
+    ormed, cored, deleted = add_books({'title': 'Wombat Diary'}, {'title': 'Wombat Atlas'},
+                                      {'title': 'Wombat Recipes'})
+
+    # Through the ORM, at commit
+    db.session.get(Book, ormed).title = 'Platypus Diary'
+    db.session.commit()
+    assert ids('platypus') == [ormed] and ormed not in ids('wombat')
+
+    # As an import or another process would, with no mapper events
+    db.session.execute(update(Book).where(Book.id == cored)
+                       .values(title='Echidna Atlas', version=Book.version + 1))
+    db.session.execute(delete(Book).where(Book.id == deleted))
+    db.session.commit()
+    assert ids('echidna') == []
+    search_index.refresh()
+    assert ids('echidna') == [cored] and cored not in ids('wombat')
+
+    # A search that finds a book gone drops it
+    assert app.test_client().get('/search/json?q=wombat').json['books'] == []
+    assert ids('wombat') == []
+
+
+def test_first_search_builds_in_the_background(app, books):
+    index = SearchIndex(app)
+    assert index.search('quokka') == []
+    deadline = time.monotonic() + 30
+    while not index.ready and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert [book_id for book_id, _ in index.search('quokka')][:1] == [books[0]]
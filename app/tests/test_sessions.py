@@ -0,0 +1,27 @@
+"""Server-side sessions: lookup, revocation and password changes"""
+from app import db
+from app.hashing import _hash
+from app.models import User
+from app.sessions import sessions
+from conftest import login
+
+
+def test_sessions_resolve_from_memory_and_revoke(app, captured):
+    client = app.test_client()
+    login(client, user_id=3)
+    del captured[:]
+    assert client.get('/holds').status_code == 200
+    assert not [statement for statement, _ in captured if 'user_sessions' in statement]
+
+    # Another process would find the session by its key
+    sessions.front.clear()
+    assert client.get('/holds').status_code == 200
+    assert [statement for statement, _ in captured if 'user_sessions' in statement]
+
+    assert sessions.revoke_account(3, False) == 1
+    assert client.get('/holds').status_code == 302
+
+    login(client, user_id=3)
+    db.session.get(User, 3).password_hash = _hash('new password', 4)
+    db.session.commit()
+    assert client.get('/holds').status_code == 302
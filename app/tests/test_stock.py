@@ -0,0 +1,36 @@
+"""Per-branch stock: striped allocation and the availability summary"""
+import pytest
+
+from app import db
+from app.models import Book, BranchStock
+from conftest import BOOKS
+
+
+def test_striped_stock_lends_every_copy_once_and_keeps_the_summary(app, captured):
+    from sqlalchemy import func, select, update
+    from app import stock
+    from app.loans import NoCopiesLeft, borrow_copy, return_copy
+    book_id = BOOKS // 8 * 3 + 4
+    db.session.execute(update(BranchStock).where(BranchStock.book_id == book_id).values(copies=5))
+    db.session.commit()
+    assert stock.restripe(book_id, 3) == 10
+
+    loans = [borrow_copy(book_id, user_id) for user_id in range(1, 11)]
+    with pytest.raises(NoCopiesLeft):
+        borrow_copy(book_id, 11)
+    assert {loan.branch_id for loan in loans} == {1, 2}
+    shelved = select(func.sum(BranchStock.copies)).where(BranchStock.book_id == book_id)
+    assert db.session.scalar(shelved) == 0
+    assert db.session.get(Book, book_id).availability == 0
+
+    # The copy goes back to the branch it came from
+    return_copy(loans[0].id)
+    db.session.expire_all()
+    assert db.session.scalar(shelved.where(BranchStock.branch_id == loans[0].branch_id)) == 1
+    assert db.session.get(Book, book_id).availability == 1
+
+    db.session.execute(update(Book).where(Book.id == book_id).values(availability=7))
+    db.session.commit()
+    assert stock.reconcile(batch_size=BOOKS // 4) == 1
+    db.session.expire_all()
+    assert db.session.get(Book, book_id).availability == 1
@@ -0,0 +1,5 @@
+# ASGI entry point for production serving: uvicorn asgi:app --workers 4
+
+from app.asgi import create_asgi_app
+
+app = create_asgi_app()
@@ -0,0 +1,187 @@
+"""Requests/sec of the read paths under many concurrent connections, served
+sync (WSGI) and async (ASGI).
+
+Starts each server in turn on a dataset made by ``datagen.py``:
+
+- ``wsgi``: Werkzeug's threaded server, as ``run.py`` serves the app.
+- ``asgi``: uvicorn with ``app.asgi``. Reads go through the async engine
+  and templates render in the worker threads.
+
+It then opens ``--connections`` keep-alive connections that request the
+home page, catalog pages and book pages (popular books more often) for
+``--duration`` seconds. Both servers run one process. The page cache is
+off unless ``--page-cache`` is given, so every request renders.
+
+    python benchmarks/datagen.py --books 20000
+    python benchmarks/asgi_bench.py --connections 1000 --duration 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select
+
+from app import create_app, db
+from app.models import Book
+from datagen import BenchConfig, skewed
+
+HOST = '127.0.0.1'
+
+
+class ServeConfig(BenchConfig):
+    RATELIMIT_ENABLED = False
+    METRICS_ENABLED = False
+    PAGE_CACHE_ENABLED = os.environ.get('BENCH_PAGE_CACHE') == '1'
+
+
+# -- servers --------------------------------------------------------------------
+
+def serve(mode, port):
+    if mode == 'asgi':
+        import uvicorn
+        from app.asgi import create_asgi_app
+        uvicorn.run(create_asgi_app(ServeConfig), host=HOST, port=port, log_level='warning',
+                    backlog=4096, timeout_keep_alive=60)
+    else:
+        from werkzeug.serving import run_simple
+        run_simple(HOST, port, create_app(ServeConfig), threaded=True)
+
+
+def start_server(mode, port, page_cache):
+    env = dict(os.environ, BENCH_PAGE_CACHE='1' if page_cache else '0')
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(port)],
+                              env=env, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('%s server did not start' % mode)
+
+
+# -- load -----------------------------------------------------------------------
+
+async def fetch(reader, writer, path):
+    """One GET on an open connection. Returns (status, keep the connection)."""
+    writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (path, HOST)).encode())
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    else:
+        await reader.read()
+        return status, False
+    return status, headers.get('connection') != 'close'
+
+
+async def visitor(port, paths, stop, latencies, errors):
+    connection = None
+    while time.perf_counter() < stop:
+        path = paths()
+        started = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(HOST, port)
+            status, keep = await fetch(*connection, path)
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            errors.append('connection')
+            connection = None
+            await asyncio.sleep(0.05)
+            continue
+        latencies.append(time.perf_counter() - started)
+        if status >= 500:
+            errors.append('5xx')
+        if not keep:
+            connection[1].close()
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+async def load(port, connections, duration, books, seed):
+    rng = random.Random(seed)
+    per_page = ServeConfig.__dict__.get('BOOKS_PER_PAGE', 50)
+
+    def paths():
+        roll = rng.random()
+        if roll < 0.2:
+            return '/'
+        if roll < 0.5:
+            return '/books_page?after=%d' % (rng.randrange(books // per_page) * per_page)
+        return '/book/%d' % skewed(rng, books, 2)
+
+    latencies, errors = [], []
+    started = time.perf_counter()
+    stop = started + duration
+    await asyncio.gather(*[visitor(port, paths, stop, latencies, errors) for _ in range(connections)])
+    return latencies, errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--modes', default='wsgi,asgi')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--page-cache', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--serve', choices=('wsgi', 'asgi'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return 0
+
+    app = create_app(BenchConfig, minimal=True)
+    with app.app_context():
+        books = db.session.scalar(select(func.max(Book.id))) or 0
+    if not books:
+        print('No books in the benchmark database; run benchmarks/datagen.py first')
+        return 1
+
+    print('%d connections for %.0fs, %d books, page cache %s'
+          % (args.connections, args.duration, books, 'on' if args.page_cache else 'off'))
+    for mode in args.modes.split(','):
+        server = start_server(mode, args.port, args.page_cache)
+        try:
+            latencies, errors, elapsed = asyncio.run(load(args.port, args.connections, args.duration,
+                                                          books, args.seed))
+        finally:
+            server.terminate()
+            server.wait()
+        latencies.sort()
+        # 5xx are mostly DB_POOL_TIMEOUT: requests shed while waiting for a
+        # connection. Only the pages served count as throughput.
+        print('%-5s %8.1f ok/s   p50 %7.1f ms   p99 %7.1f ms   %d 5xx, %d connection errors' % (
+            mode, (len(latencies) - errors.count('5xx')) / elapsed,
+            statistics.median(latencies) * 1000 if latencies else 0,
+            latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+            errors.count('5xx'), errors.count('connection')))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
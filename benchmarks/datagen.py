@@ -0,0 +1,261 @@
+"""Generates a realistic synthetic library for benchmarking.
+
+Recreates the schema in ``BENCH_DATABASE_URL`` (a SQLite file by default)
+and bulk-loads ``--books`` books plus users, loans and log rows scaled from
+it, then rebuilds the loan rollups and recommendations. Each book's copies
+are spread over ``--branches`` branches. Popularity is skewed the way real
+circulation is: a small share of the catalog and of the readers accounts
+for most loans. Runs are reproducible for a given ``--seed``.
+
+    python benchmarks/datagen.py --books 10000
+    BENCH_DATABASE_URL=mysql://user:pw@localhost/library_bench python benchmarks/datagen.py --books 1000000
+
+Every account's password is ``benchpass``; the admin is admin@example.com.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, insert
+
+from app import create_app, db
+from app.config import Config
+from app.hashing import _hash
+from app.models import AdminUser, Book, BookLoan, Branch, BranchStock, Log, User
+
+PASSWORD = 'benchpass'
+ADMIN_EMAIL = 'admin@example.com'
+
+WORDS = (
+    'after all ancient angel autumn between black blood bone broken city cold crown dark dawn daughter dead '
+    'deep desert dream dust earth echo edge empire end fall fire first flight forest forgotten garden ghost '
+    'glass gold good great green heart hidden history home hour house hunger ice iron island journey king '
+    'last late light little long lost love machine memory midnight mind moon mountain night north ocean old '
+    'other paper past queen quiet rain red river road rose salt sea secret shadow silent silver sky small '
+    'song spring star stone storm summer sun sword thousand time tower truth under war water white wild '
+    'wind winter wolf woman world year young'
+).split()
+FIRST_NAMES = (
+    'Ada Alan Alice Amara Anna Ben Carlos Chen Clara Daniel Elena Emma Farah Grace Hannah Hugo Ivan Jack '
+    'James Julia Kenji Lara Leo Lucas Maria Marta Mei Nadia Nina Omar Paul Priya Rosa Sam Sara Sofia Tom '
+    'Vera Yusuf Zoe'
+).split()
+LAST_NAMES = (
+    'Adams Ali Baker Bauer Becker Brown Costa Cruz Dimitrov Evans Fischer Garcia Georgiev Gomez Green Hall '
+    'Hansen Ivanov Jensen Johnson Kim Kowalski Lee Lopez Martin Meyer Miller Moreau Muller Nakov Nguyen '
+    'Novak Oliveira Park Patel Petrov Reyes Rossi Santos Schmidt Silva Singh Smith Sato Taylor Tanaka '
+    'Thomas Torres Walker Wang Weber White Wilson Wright Young Zhang'
+).split()
+# (genre, weight)
+GENRES = (('Fiction', 30), ('Mystery', 12), ('Fantasy', 10), ('Science Fiction', 9), ('Romance', 9),
+          ('History', 7), ('Biography', 6), ('Science', 5), ('Self-help', 4), ('Poetry', 3),
+          ('Travel', 3), ('Cooking', 2))
+PUBLISHER_SUFFIXES = ('Press', 'Books', 'House', 'Publishing', 'Editions')
+LOAN_DAYS = 7
+HISTORY_DAYS = 3 * 365
+
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL', 'sqlite:///bench.db')
+
+
+def scale(books):
+    """Row counts for a catalog of ``books`` titles"""
+    return {
+        'books': books,
+        'users': max(100, books // 10),
+        'loans': books * 3,
+        'logs': books * 3
+    }
+
+
+def skewed(rng, n, power):
+    """1..n with low numbers far more likely (power > 1 sharpens the skew)"""
+    return int(n * rng.random() ** power) + 1
+
+
+def book_rows(rng, count):
+    genres = [genre for genre, _ in GENRES]
+    weights = [weight for _, weight in GENRES]
+    authors = max(50, count // 8)
+    publishers = max(20, count // 200)
+    for _ in range(count):
+        words = rng.sample(WORDS, rng.randint(1, 4))
+        if rng.random() < 0.4:
+            words.insert(0, 'the')
+        author = rng.randrange(authors)
+        yield {
+            'title': ' '.join(words).title(),
+            'author': '%s %s. %s' % (FIRST_NAMES[author % len(FIRST_NAMES)],
+                                     chr(65 + author // len(FIRST_NAMES) % 26),
+                                     LAST_NAMES[author // (len(FIRST_NAMES) * 26) % len(LAST_NAMES)]),
+            'genre': rng.choices(genres, weights)[0],
+            'publisher': '%s %s' % (LAST_NAMES[rng.randrange(publishers) % len(LAST_NAMES)],
+                                    PUBLISHER_SUFFIXES[rng.randrange(publishers) % len(PUBLISHER_SUFFIXES)]),
+            'year': max(1900, 2025 - int(rng.expovariate(1 / 15.0))),
+            'availability': rng.choices((0, 1, 2, 3, 5), (10, 40, 25, 15, 10))[0]
+        }
+
+
+def stock_rows(rng, availabilities, branches):
+    """Puts each book's copies on the shelves of random branches"""
+    for book_id, copies in enumerate(availabilities, 1):
+        at = {}
+        for _ in range(copies):
+            branch_id = rng.randint(1, branches)
+            at[branch_id] = at.get(branch_id, 0) + 1
+        for branch_id, count in at.items():
+            yield {'book_id': book_id, 'branch_id': branch_id, 'stripe': 0, 'copies': count}
+
+
+def user_rows(rng, count, password_hash):
+    for i in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield {
+            'first_name': first,
+            'last_name': last,
+            'email': 'user%d@example.com' % (i + 1),
+            'phone': '08%08d' % rng.randrange(10 ** 8),
+            'password_hash': password_hash
+        }
+
+
+def loan_and_log_rows(rng, count, books, users):
+    today = date.today()
+    for _ in range(count):
+        book_id = skewed(rng, books, 3)
+        user_id = skewed(rng, users, 2)
+        age = int(HISTORY_DAYS * rng.random() ** 1.5)
+        borrow_date = today - timedelta(days=age)
+        # Recent loans are mostly still out; some older ones never came back
+        returned = rng.random() < (0.3 if age < LOAN_DAYS * 2 else 0.97)
+        yield (
+            {'book_id': book_id, 'user_id': user_id, 'borrow_date': borrow_date,
+             'return_date': borrow_date + timedelta(days=LOAN_DAYS), 'returned': returned},
+            {'user_id': user_id, 'action': 'Borrowed book #%d' % book_id,
+             'timestamp': datetime.combine(borrow_date, datetime.min.time()) + timedelta(seconds=rng.randrange(86400))}
+        )
+
+
+def bulk_insert(model, rows, chunk_size):
+    """Inserts rows in executemany chunks, one transaction per chunk"""
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            db.session.execute(insert(model), chunk)
+            db.session.commit()
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(insert(model), chunk)
+        db.session.commit()
+        count += len(chunk)
+    return count
+
+
+def fast_load_settings(engine):
+    """Trades durability for load speed until the returned callback runs"""
+    def configure(dbapi_connection, _record):
+        cursor = dbapi_connection.cursor()
+        if engine.dialect.name == 'sqlite':
+            cursor.execute('PRAGMA synchronous=OFF')
+            cursor.execute('PRAGMA journal_mode=MEMORY')
+        elif engine.dialect.name == 'mysql':
+            cursor.execute('SET unique_checks=0, foreign_key_checks=0')
+        cursor.close()
+
+    def restore():
+        event.remove(engine, 'connect', configure)
+        engine.dispose()
+
+    event.listen(engine, 'connect', configure)
+    engine.dispose()
+    return restore
+
+
+def generate(app, books, seed=1, chunk_size=10000, branches=40, log=print):
+    """Recreates the schema and loads a catalog of ``books`` titles"""
+    rng = random.Random(seed)
+    counts = scale(books)
+    with app.app_context():
+        restore_settings = fast_load_settings(db.engine)
+        db.drop_all()
+        db.create_all()
+        password_hash = _hash(PASSWORD, app.config.get('BCRYPT_LOG_ROUNDS', 12))
+        db.session.add(AdminUser(username='admin', email=ADMIN_EMAIL, password_hash=password_hash))
+        db.session.execute(insert(Branch), [{'id': i, 'code': 'b%02d' % i, 'name': 'Branch %d' % i}
+                                            for i in range(1, branches + 1)])
+        db.session.commit()
+
+        def timed(name, model, rows):
+            started = time.perf_counter()
+            n = bulk_insert(model, rows, chunk_size)
+            elapsed = time.perf_counter() - started
+            log('%-6s %10d rows  %8.0f rows/sec' % (name, n, n / elapsed if elapsed else 0))
+
+        availabilities = []
+
+        def books_noting_copies():
+            for row in book_rows(rng, counts['books']):
+                availabilities.append(row['availability'])
+                yield row
+
+        timed('books', Book, books_noting_copies())
+        # Its own generator, so the rest of the data is the same for a seed
+        timed('stock', BranchStock, stock_rows(random.Random(seed + 1), availabilities, branches))
+        timed('users', User, user_rows(rng, counts['users'], password_hash))
+
+        # Each loan and its log line come from the same draw
+        started = time.perf_counter()
+        loans, logs = [], []
+        for loan, entry in loan_and_log_rows(rng, counts['loans'], counts['books'], counts['users']):
+            loans.append(loan)
+            logs.append(entry)
+            if len(loans) == chunk_size:
+                bulk_insert(BookLoan, loans, chunk_size)
+                bulk_insert(Log, logs, chunk_size)
+                loans, logs = [], []
+        bulk_insert(BookLoan, loans, chunk_size)
+        bulk_insert(Log, logs, chunk_size)
+        elapsed = time.perf_counter() - started
+        n = counts['loans'] + counts['logs']
+        log('%-6s %10d rows  %8.0f rows/sec  (loans and logs)' % ('loans', n, n / elapsed if elapsed else 0))
+        db.session.remove()
+        restore_settings()
+
+        from app import analytics, recommendations
+        started = time.perf_counter()
+        analytics.rebuild()
+        log('rollups rebuilt in %.1fs' % (time.perf_counter() - started))
+        started = time.perf_counter()
+        recommendations.rebuild()
+        log('recommendations rebuilt in %.1fs' % (time.perf_counter() - started))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=10000,
+                        help='catalog size; users, loans and logs scale with it')
+    parser.add_argument('--branches', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    app = create_app(BenchConfig, minimal=True)
+    print('database: %s' % app.config['SQLALCHEMY_DATABASE_URI'])
+    started = time.perf_counter()
+    counts = generate(app, args.books, seed=args.seed, chunk_size=args.chunk_size, branches=args.branches)
+    print('%d rows in %.1fs' % (sum(counts.values()), time.perf_counter() - started))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
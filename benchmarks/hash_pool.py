@@ -0,0 +1,73 @@
+"""Logins/sec of the password hashing service versus process pool size.
+
+Simulates a login burst: ``--clients`` threads each verify a password
+until ``--logins`` checks are done, once per pool size. Pool size 0 hashes
+inline on the calling threads, which is what the routes used to do.
+
+    python benchmarks/hash_pool.py --rounds 12 --pool-sizes 0,1,2,4,8
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.hashing import PasswordHasher, _hash
+
+
+def run(hasher, password_hash, clients, logins):
+    remaining = [logins]
+    lock = threading.Lock()
+    latencies = []
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            assert hasher.check_password(password_hash, 'correct horse')
+            latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'logins_per_sec': logins / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--pool-sizes', default='0,1,2,4,%d' % (os.cpu_count() or 1))
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--logins', type=int, default=64)
+    args = parser.parse_args()
+
+    password_hash = _hash('correct horse', args.rounds)
+    print('rounds=%d clients=%d logins=%d cpus=%d'
+          % (args.rounds, args.clients, args.logins, os.cpu_count() or 1))
+    for pool_size in [int(size) for size in args.pool_sizes.split(',')]:
+        hasher = PasswordHasher(rounds=args.rounds, pool_size=pool_size, max_queue=args.clients)
+        # Start the worker processes before timing
+        run(hasher, password_hash, pool_size or 1, pool_size or 1)
+        result = run(hasher, password_hash, args.clients, args.logins)
+        hasher.shutdown()
+        print('pool_size=%-3d %7.1f logins/sec  p50 %7.1f ms  p95 %7.1f ms'
+              % (pool_size, result['logins_per_sec'], result['p50_ms'], result['p95_ms']))
+
+
+if __name__ == '__main__':
+    main()
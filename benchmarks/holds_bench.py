@@ -0,0 +1,196 @@
+"""Allocation throughput of the holds queue on titles with long lines.
+
+Every title starts with no copy on the shelf, ``--copies`` copies out on
+loan and ``--holds`` readers in line. Each cycle returns a copy, which sets
+it aside for the head of the line, and that reader then borrows it. The run
+fails unless every title's holds were served strictly in arrival order. It
+reports allocations/sec and return latency near the front and the back of
+the line. Cost should not grow with queue depth. ``--naive`` finds the next
+holder by loading and sorting the whole line instead, for comparison.
+
+    python benchmarks/holds_bench.py --titles 5 --holds 2000
+    BENCH_DATABASE_URL=mysql://user:pw@localhost/library_bench python benchmarks/holds_bench.py --holds 10000
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, select, update
+
+from app import create_app, db
+from app import loans
+from app.config import Config
+from app.holds import allocate
+from app.loans import borrow_copy, return_copy
+from app.models import Book, BookLoan, Branch, Hold, User
+from app.stock import claim_copy
+
+
+class HoldsConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL', 'sqlite:///holds_bench.db')
+    if SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30, 'check_same_thread': False}}
+
+
+def naive_allocate(book_id):
+    # Loads the whole line and sorts it by arrival on every allocation
+    line = db.session.execute(
+        select(Hold.id, Hold.created_at).where(Hold.book_id == book_id, Hold.status == 'waiting')
+    ).all()
+    if not line:
+        return 0
+    head = sorted(line, key=lambda hold: (hold.created_at, hold.id))[0]
+    if claim_copy(book_id) is None:
+        return 0
+    now = datetime.now()
+    db.session.execute(
+        update(Hold).where(Hold.id == head.id)
+        .values(status='ready', ready_at=now, expires_at=now + timedelta(days=3))
+        .execution_options(synchronize_session=False)
+    )
+    return 1
+
+
+def setup(app, titles, holds, copies):
+    """Creates the readers, titles, open loans and lines; returns
+    {book_id: [open loan ids]}"""
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(Branch(id=1, code='main', name='Main library'))
+        readers = holds + copies
+        db.session.execute(insert(User), [
+            {'first_name': 'Bench', 'last_name': str(i), 'email': 'holds%d@example.com' % i, 'password_hash': 'x'}
+            for i in range(readers)
+        ])
+        db.session.execute(insert(Book), [
+            {'title': 'Hot Title %d' % i, 'author': 'Bench', 'availability': 0} for i in range(titles)
+        ])
+        db.session.commit()
+        book_ids = db.session.scalars(select(Book.id).order_by(Book.id)).all()
+        user_ids = db.session.scalars(select(User.id).order_by(User.id)).all()
+
+        started = datetime.now()
+        open_loans = {}
+        for book_id in book_ids:
+            # The first `copies` readers hold the copies, the rest queue up
+            db.session.execute(insert(BookLoan), [
+                {'book_id': book_id, 'user_id': user_id, 'borrow_date': date.today(),
+                 'return_date': date.today() + timedelta(days=7), 'returned': False}
+                for user_id in user_ids[:copies]
+            ])
+            for start in range(copies, readers, 5000):
+                db.session.execute(insert(Hold), [
+                    {'book_id': book_id, 'user_id': user_id, 'status': 'waiting',
+                     'created_at': started + timedelta(microseconds=i)}
+                    for i, user_id in enumerate(user_ids[start:start + 5000], start)
+                ])
+            db.session.commit()
+            open_loans[book_id] = db.session.scalars(
+                select(BookLoan.id).where(BookLoan.book_id == book_id).order_by(BookLoan.id)
+            ).all()
+        return open_loans
+
+
+def serve_line(app, book_id, loan_ids, latencies, errors):
+    """Return, allocate, borrow by the holder; until the line is empty"""
+    with app.app_context():
+        pending = list(loan_ids)
+        while pending:
+            loan_id = pending.pop(0)
+            started = time.perf_counter()
+            try:
+                return_copy(loan_id)
+            except Exception as e:
+                db.session.rollback()
+                errors.append(repr(e))
+                return
+            latencies.append(time.perf_counter() - started)
+
+            holder = db.session.scalar(
+                select(Hold.user_id).where(Hold.book_id == book_id, Hold.status == 'ready')
+                .order_by(Hold.id).limit(1)
+            )
+            db.session.rollback()
+            if holder is None:
+                continue
+            loan = borrow_copy(book_id, holder)
+            pending.append(loan.id)
+
+
+def served_in_order(app, book_ids):
+    with app.app_context():
+        for book_id in book_ids:
+            served = db.session.scalars(
+                select(Hold.id).where(Hold.book_id == book_id, Hold.status == 'fulfilled')
+                .order_by(Hold.ready_at, Hold.id)
+            ).all()
+            if served != sorted(served):
+                return False
+            waiting = db.session.scalar(
+                select(Hold.id).where(Hold.book_id == book_id, Hold.status != 'fulfilled').limit(1)
+            )
+            if waiting is not None:
+                return False
+    return True
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--titles', type=int, default=5)
+    parser.add_argument('--holds', type=int, default=2000, help='readers in line per title')
+    parser.add_argument('--copies', type=int, default=3, help='copies of each title')
+    parser.add_argument('--threads', type=int, default=1, help='titles served concurrently')
+    parser.add_argument('--naive', action='store_true', help='sort the whole line on every allocation')
+    args = parser.parse_args()
+
+    app = create_app(HoldsConfig, minimal=True)
+    open_loans = setup(app, args.titles, args.holds, args.copies)
+    if args.naive:
+        loans.allocate = naive_allocate
+
+    latencies = {book_id: [] for book_id in open_loans}
+    errors = []
+    titles = list(open_loans.items())
+    started = time.perf_counter()
+    for start in range(0, len(titles), args.threads):
+        threads = [
+            threading.Thread(target=serve_line, args=(app, book_id, loan_ids, latencies[book_id], errors))
+            for book_id, loan_ids in titles[start:start + args.threads]
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - started
+    loans.allocate = allocate
+
+    allocations = args.titles * args.holds
+    head = [latency for per_title in latencies.values() for latency in per_title[:len(per_title) // 10]]
+    tail = [latency for per_title in latencies.values() for latency in per_title[-(len(per_title) // 10):]]
+    print('titles=%d holds/title=%d copies=%d threads=%d%s errors=%d'
+          % (args.titles, args.holds, args.copies, args.threads, ' naive' if args.naive else '', len(errors)))
+    print('%.0f allocations/sec (%.2fs, each a return plus the holder\'s borrow)' % (allocations / elapsed, elapsed))
+    print('return+allocate p50 %.2f ms p99 %.2f ms; deep line p50 %.2f ms, short line p50 %.2f ms'
+          % (percentile(head + tail, 0.5), percentile(head + tail, 0.99),
+             percentile(head, 0.5), percentile(tail, 0.5)))
+    if errors:
+        print('first error: ' + errors[0])
+    if errors or not served_in_order(app, open_loans):
+        print('FAIL: holds were skipped or served out of order')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,446 @@
+"""Per-endpoint latency, throughput and memory of the main and API blueprints.
+
+Load a dataset first with benchmarks/datagen.py. Then run one of two modes:
+
+- ``client`` (the default) drives every route in-process through the Flask
+  test client. This measures the application code alone.
+- ``http`` runs ``--concurrency`` load generator processes against a running
+  server. That server must use the same ``BENCH_DATABASE_URL`` database.
+  Pass ``--server-pid`` so peak server RSS can be read.
+
+Both modes print one JSON report: p50/p95/p99 latency, requests/sec, peak
+RSS and errors for each endpoint. Pass ``--output`` to save the report and
+``--compare`` to diff it against a saved one.
+
+    python benchmarks/datagen.py --books 100000
+    python benchmarks/http_bench.py --requests 500 --output before.json
+    python benchmarks/http_bench.py --requests 500 --compare before.json
+    python benchmarks/http_bench.py --mode http --url http://127.0.0.1:8000 \\
+        --concurrency 8 --server-pid $(pgrep -d, -f gunicorn)
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select
+
+from app import create_app, db
+from app.models import AdminUser, Book, BookLoan, Hold, User
+from app.sessions import sessions
+from datagen import ADMIN_EMAIL, PASSWORD, WORDS, BenchConfig, skewed
+
+# -- scenarios ----------------------------------------------------------------
+#
+# One per (endpoint, method). A builder takes (rng, dataset) and returns the
+# path and form data of the next request; 'who' is the account it runs as.
+# The form can also be a function of ``fetch(path)``, the text of a GET made
+# as the same account before the timed request, for forms that must echo
+# what the page showed.
+
+def _book(rng, data):
+    return skewed(rng, data['books'], 3)
+
+
+def _query(rng, data):
+    return '+'.join(rng.sample(WORDS, rng.randint(1, 2)))
+
+
+def _hidden(page, name):
+    match = re.search(r'name="%s" value="(-?\d+)"' % name, page)
+    return match.group(1) if match else ''
+
+
+def _edit_book(rng, data):
+    path = '/books/edit/%d' % (data['books'] - rng.randrange(min(1000, data['books'])))
+    fields = {'title': 'Edited ' + _query(rng, data).replace('+', ' '), 'author': 'Bench Author',
+              'genre': 'Fiction', 'availability': '3', 'year': '2020', 'publisher': 'Bench Press'}
+
+    def form(fetch):
+        # Posts back the version and availability of the form as loaded, as
+        # a browser does; without them every save is an edit conflict (409)
+        page = fetch(path)
+        return dict(fields, version=_hidden(page, 'version'), availability_seen=_hidden(page, 'availability_seen'))
+    return path, form
+
+
+SCENARIOS = [
+    ('home', 'main.home', 'GET', None, lambda rng, data: ('/', None)),
+    ('books_page', 'main.books_page', 'GET', None,
+     lambda rng, data: ('/books_page?after=%d' % rng.randrange(data['books']), None)),
+    ('books_page_json', 'main.books_page_json', 'GET', None,
+     lambda rng, data: ('/books_page/json?limit=100&after=%d' % rng.randrange(data['books']), None)),
+    ('search', 'main.search_page', 'GET', None, lambda rng, data: ('/search?q=' + _query(rng, data), None)),
+    ('search_json', 'main.search_json', 'GET', None,
+     lambda rng, data: ('/search/json?q=%s' % rng.choice(WORDS)[:3], None)),
+    ('book_detail', 'main.book_detail', 'GET', None, lambda rng, data: ('/book/%d' % _book(rng, data), None)),
+    ('register_form', 'main.register_page', 'GET', None, lambda rng, data: ('/register_page', None)),
+    ('register', 'main.register_page', 'POST', None, lambda rng, data: ('/register_page', {
+        'first_name': 'Bench', 'last_name': 'Reader', 'phone': '0800000000',
+        'email': 'bench-%s@example.com' % uuid.UUID(int=rng.getrandbits(128)).hex, 'password': PASSWORD
+    })),
+    ('login_form', 'main.login_page', 'GET', None, lambda rng, data: ('/login_page', None)),
+    ('login', 'main.login', 'POST', None, lambda rng, data: ('/login_page', {
+        'email': 'user%d@example.com' % skewed(rng, data['users'], 2), 'password': PASSWORD
+    })),
+    ('dashboard', 'main.dashboard', 'GET', 'admin',
+     lambda rng, data: ('/dashboard?after=%d' % rng.randrange(data['books']), None)),
+    ('add_book_form', 'main.add_book_page', 'GET', 'admin', lambda rng, data: ('/books/add', None)),
+    ('add_book', 'main.add_book_page', 'POST', 'admin', lambda rng, data: ('/books/add', {
+        'title': 'Bench ' + _query(rng, data).replace('+', ' '), 'author': 'Bench Author',
+        'genre': 'Fiction', 'availability': '2', 'year': '2024', 'publisher': 'Bench Press'
+    })),
+    ('edit_book_form', 'main.edit_book_page', 'GET', 'admin',
+     lambda rng, data: ('/books/edit/%d' % _book(rng, data), None)),
+    ('edit_book', 'main.edit_book_page', 'POST', 'admin', _edit_book),
+    # Confirmation page only: deleting seeded books would skew later runs
+    ('delete_book_form', 'main.delete_book', 'GET', 'admin',
+     lambda rng, data: ('/books/delete/%d' % _book(rng, data), None)),
+    ('cache_stats', 'main.cache_stats', 'GET', 'admin', lambda rng, data: ('/admin/cache', None)),
+    ('reports', 'main.reports_page', 'GET', 'admin', lambda rng, data: ('/admin/reports', None)),
+    ('reports_json', 'main.reports_json', 'GET', 'admin', lambda rng, data: ('/admin/reports/json', None)),
+    ('hasher_stats', 'main.hasher_stats', 'GET', 'admin', lambda rng, data: ('/admin/hasher', None)),
+    ('my_loans', 'main.my_loans', 'GET', 'user', lambda rng, data: ('/loans', None)),
+    ('loans_board', 'main.loans_board', 'GET', 'admin', lambda rng, data: ('/admin/loans', None)),
+    # Most picks are already returned loans, which exercises the no-op path too
+    ('return_loan', 'main.return_book', 'POST', 'admin',
+     lambda rng, data: ('/loans/%d/return' % rng.randint(1, data['loans']), {})),
+    ('borrow', 'main.borrow_book', 'POST', 'user', lambda rng, data: ('/books/borrow/%d' % _book(rng, data), {})),
+    ('hold_book', 'main.hold_book', 'POST', 'user', lambda rng, data: ('/books/%d/hold' % _book(rng, data), {})),
+    ('my_holds', 'main.my_holds', 'GET', 'user', lambda rng, data: ('/holds', None)),
+    # Picks are mostly someone else's or closed holds, the refused path
+    ('cancel_hold', 'main.cancel_hold', 'POST', 'user',
+     lambda rng, data: ('/holds/%d/cancel' % rng.randint(1, max(1, data['holds'])), {})),
+    ('logout', 'main.logout', 'GET', 'user', lambda rng, data: ('/logout', None)),
+    ('api_books', 'api.books', 'GET', None,
+     lambda rng, data: ('/api/v1/books?limit=100&after=%d' % rng.randrange(data['books']), None)),
+    ('api_book', 'api.book', 'GET', None, lambda rng, data: ('/api/v1/books/%d' % _book(rng, data), None)),
+    ('api_loans', 'api.loans', 'GET', 'user', lambda rng, data: ('/api/v1/loans', None)),
+    ('api_borrow', 'api.borrow', 'POST', 'user',
+     lambda rng, data: ('/api/v1/books/%d/borrow' % _book(rng, data), {})),
+    ('api_return', 'api.return_loan', 'POST', 'admin',
+     lambda rng, data: ('/api/v1/loans/%d/return' % rng.randint(1, data['loans']), {})),
+    ('api_place_hold', 'api.place_hold', 'POST', 'user',
+     lambda rng, data: ('/api/v1/books/%d/holds' % _book(rng, data), {})),
+    ('api_holds', 'api.my_holds', 'GET', 'user', lambda rng, data: ('/api/v1/holds', None)),
+    ('api_cancel_hold', 'api.cancel_hold', 'DELETE', 'user',
+     lambda rng, data: ('/api/v1/holds/%d' % rng.randint(1, max(1, data['holds'])), None)),
+]
+SCENARIOS_BY_NAME = {scenario[0]: scenario for scenario in SCENARIOS}
+
+
+def coverage(app):
+    """Adds a plain GET scenario for any argument-free main or API route not
+    listed above, and returns the (endpoint, methods) still not exercised"""
+    covered = {(endpoint, method) for _, endpoint, method, _, _ in SCENARIOS}
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if not rule.endpoint.startswith(('main.', 'api.')):
+            continue
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            if (rule.endpoint, method) in covered:
+                continue
+            if method == 'GET' and not rule.arguments:
+                path = rule.rule
+                scenario = (rule.endpoint.split('.', 1)[1], rule.endpoint, 'GET', 'admin',
+                            lambda rng, data, path=path: (path, None))
+                SCENARIOS.append(scenario)
+                SCENARIOS_BY_NAME[scenario[0]] = scenario
+            else:
+                missing.append('%s %s' % (method, rule.rule))
+    return missing
+
+
+def dataset(app):
+    with app.app_context():
+        return {
+            'dialect': db.engine.dialect.name,
+            'books': db.session.scalar(select(func.max(Book.id))) or 0,
+            'users': db.session.scalar(select(func.max(User.id))) or 0,
+            'loans': db.session.scalar(select(func.max(BookLoan.id))) or 0,
+            'holds': db.session.scalar(select(func.max(Hold.id))) or 0,
+            'admin_id': db.session.scalar(select(AdminUser.id).where(AdminUser.email == ADMIN_EMAIL))
+        }
+
+
+# -- measurements -------------------------------------------------------------
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+
+def summarize(latencies, errors, elapsed, peak_rss_kb):
+    ordered = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput_rps': round(len(ordered) / elapsed, 1) if elapsed else None,
+        'p50_ms': ms(percentile(ordered, 50)),
+        'p95_ms': ms(percentile(ordered, 95)),
+        'p99_ms': ms(percentile(ordered, 99)),
+        'max_ms': ms(ordered[-1] if ordered else None),
+        'peak_rss_kb': peak_rss_kb
+    }
+
+
+def own_peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def server_peak_rss_kb(pids):
+    """Sum of the peak RSS (VmHWM) of the server processes"""
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except OSError:
+            return None
+    return total
+
+
+# -- in-process mode ----------------------------------------------------------
+
+def run_client(app, data, scenario, requests, warmup, seed):
+    name, _, method, who, build = scenario
+    rng = random.Random(seed)
+    client = app.test_client()
+    if who:
+        with app.app_context():
+            if who == 'admin':
+                token = sessions.create(data['admin_id'], True)
+            else:
+                token = sessions.create(skewed(rng, data['users'], 2), False)
+        with client.session_transaction() as session:
+            session['sid'] = token
+
+    latencies, errors = [], 0
+    for i in range(warmup + requests):
+        path, form = build(rng, data)
+        if callable(form):
+            form = form(lambda page: client.get(page).get_data(as_text=True))
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=form)
+        elapsed = time.perf_counter() - started
+        if i >= warmup:
+            latencies.append(elapsed)
+            errors += response.status_code >= 500
+    return latencies, errors
+
+
+# -- load generator mode ------------------------------------------------------
+
+class KeepAliveClient:
+    """Minimal HTTP/1.1 client: one persistent connection and a cookie jar"""
+
+    def __init__(self, base_url):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.cookies = SimpleCookie()
+        self.connection = None
+
+    def request(self, method, path, form=None):
+        """Returns the status and the text of the response"""
+        body = urlencode(form) if form is not None else None
+        headers = {'Connection': 'keep-alive'}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % (key, morsel.value) for key, morsel in self.cookies.items())
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                text = response.read().decode('utf-8', 'replace')
+                break
+            except (http.client.HTTPException, OSError):
+                # The server closed an idle keep-alive connection; retry once
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+        for header in response.headers.get_all('Set-Cookie') or ():
+            self.cookies.load(header)
+        if response.headers.get('Connection', '').lower() == 'close':
+            self.connection.close()
+            self.connection = None
+        return response.status, text
+
+
+def _http_worker(task):
+    base_url, name, data, count, warmup, seed = task
+    _, _, method, who, build = SCENARIOS_BY_NAME[name]
+    rng = random.Random(seed)
+    client = KeepAliveClient(base_url)
+    if who:
+        email = ADMIN_EMAIL if who == 'admin' else 'user%d@example.com' % skewed(rng, data['users'], 2)
+        client.request('POST', '/login_page', {'email': email, 'password': PASSWORD})
+
+    latencies, errors = [], 0
+    first = last = None
+    for i in range(warmup + count):
+        path, form = build(rng, data)
+        if callable(form):
+            form = form(lambda page: client.request('GET', page)[1])
+        started = time.perf_counter()
+        try:
+            failed = client.request(method, path, form)[0] >= 500
+        except (http.client.HTTPException, OSError):
+            failed = True
+        finished = time.perf_counter()
+        if i >= warmup:
+            first = started if first is None else first
+            last = finished
+            latencies.append(finished - started)
+            errors += failed
+    return latencies, errors, first, last
+
+
+def run_http(pool, base_url, data, scenario, requests, warmup, concurrency, seed):
+    per_worker = max(1, requests // concurrency)
+    tasks = [(base_url, scenario[0], data, per_worker, warmup, seed * 1000 + i) for i in range(concurrency)]
+    latencies, errors, starts, ends = [], 0, [], []
+    for worker_latencies, worker_errors, first, last in pool.map(_http_worker, tasks):
+        latencies.extend(worker_latencies)
+        errors += worker_errors
+        if first is not None:
+            starts.append(first)
+            ends.append(last)
+    # perf_counter is system-wide on Linux, so workers' clocks line up
+    elapsed = max(ends) - min(starts) if starts else 0
+    return latencies, errors, elapsed
+
+
+# -- reporting ----------------------------------------------------------------
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Prints each endpoint's change against an earlier report"""
+    lines = ['%-18s %22s %22s %22s' % ('endpoint', 'p50 ms', 'p99 ms', 'req/s')]
+    for name, now in report['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(name)
+        if not before:
+            continue
+        cells = []
+        for key in ('p50_ms', 'p99_ms', 'throughput_rps'):
+            old, new = before.get(key), now.get(key)
+            if not old or new is None:
+                cells.append('%22s' % '-')
+            else:
+                cells.append('%10.1f -> %-7.1f%+4.0f%%' % (old, new, (new - old) * 100.0 / old))
+        lines.append('%-18s %s' % (name, ' '.join(cells)))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('client', 'http'), default='client')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='server for --mode http')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per endpoint (per worker)')
+    parser.add_argument('--concurrency', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--server-pid', default='', help='comma separated server pids, for peak RSS')
+    parser.add_argument('--only', default='', help='comma separated scenario names')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--compare', help='earlier JSON report to diff against')
+    args = parser.parse_args()
+
+    app = create_app(BenchConfig)
+    data = dataset(app)
+    if not data['books'] or not data['admin_id']:
+        parser.error('no benchmark data in %s; run benchmarks/datagen.py first'
+                     % app.config['SQLALCHEMY_DATABASE_URI'])
+    uncovered = coverage(app)
+    names = [name for name in args.only.split(',') if name] or [scenario[0] for scenario in SCENARIOS]
+    if args.mode == 'client' and any(name.startswith('search') for name in names):
+        # The first search only starts building the index in the background
+        from app.search import search_index
+        with app.app_context():
+            search_index.build()
+    server_pids = [int(pid) for pid in args.server_pid.split(',') if pid]
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'mode': args.mode,
+            'database': data.pop('dialect'),
+            'dataset': data,
+            'requests': args.requests,
+            'concurrency': args.concurrency if args.mode == 'http' else 1,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'uncovered': uncovered
+        },
+        'endpoints': {}
+    }
+
+    # Forked workers inherit the scenario list, including coverage() additions
+    pool = multiprocessing.get_context('fork').Pool(args.concurrency) if args.mode == 'http' else None
+    try:
+        for i, name in enumerate(names):
+            scenario = SCENARIOS_BY_NAME[name]
+            started = time.perf_counter()
+            if pool is None:
+                latencies, errors = run_client(app, data, scenario, args.requests, args.warmup, args.seed + i)
+                elapsed = sum(latencies)
+                peak = own_peak_rss_kb()
+            else:
+                latencies, errors, elapsed = run_http(pool, args.url, data, scenario, args.requests,
+                                                      args.warmup, args.concurrency, args.seed + i)
+                peak = server_peak_rss_kb(server_pids) if server_pids else None
+            result = summarize(latencies, errors, elapsed, peak)
+            report['endpoints'][name] = result
+            print('%-18s %6.1f req/s  p50 %7.2f ms  p99 %7.2f ms  errors %d  (%.1fs)'
+                  % (name, result['throughput_rps'] or 0, result['p50_ms'] or 0, result['p99_ms'] or 0,
+                     errors, time.perf_counter() - started), file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""Overhead of the rate limiter and what it saves under a login flood.
+
+It runs three measurements:
+
+1. ``check``: the time one limit check adds to a request, for an existing
+   bucket and for a new client. Measured inside a request context, so the
+   key functions run too.
+2. ``store``: bucket updates per second from ``--threads`` threads, with
+   one lock (``--shards 1``) and with the configured number of shards.
+3. ``flood``: one client posting wrong passwords to /login_page. The
+   report has how many were refused and the latency of requests that ran
+   bcrypt against those refused before any query or hash.
+
+    python benchmarks/ratelimit_bench.py
+    python benchmarks/ratelimit_bench.py --threads 16 --flood 500 --rounds 12
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert
+
+from app import create_app, db
+from app.config import Config
+from app.hashing import _hash
+from app.models import User
+from app.ratelimit import MemoryStore, by_email, by_ip, limiter
+
+PASSWORD = 'correct horse'
+
+
+class RateLimitConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL', 'sqlite:///ratelimit_bench.db')
+    HASHER_POOL_SIZE = 0
+    CACHE_BACKEND = 'simple'
+
+
+def per_call_us(fn, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def bench_check(app, calls):
+    with app.test_request_context('/login_page', method='POST', data={'email': 'a@example.com'},
+                                  environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        limiter.reset()
+        noop = per_call_us(lambda: None, calls)
+        existing = per_call_us(lambda: (limiter.check('bench-ip', '1000000/second', by_ip),
+                                        limiter.check('bench-email', '1000000/second', by_email)), calls) - noop
+        # A new client every call: creates buckets and prunes full shards
+        addresses = iter(range(calls * 2))
+        new_ip = lambda: 'ip:%d' % next(addresses)
+        new = per_call_us(lambda: limiter.check('bench-ip', '10/minute', new_ip), calls) - noop
+    limiter.reset()
+    return existing, new
+
+
+def bench_store(shards, threads, seconds, keys):
+    store = MemoryStore(shards=shards)
+    names = ['ip:10.0.%d.%d' % (i // 256, i % 256) for i in range(keys)]
+    counts = [0] * threads
+    stop = time.perf_counter() + seconds
+
+    def worker(index):
+        rng = random.Random(index)
+        done = 0
+        while time.perf_counter() < stop:
+            for _ in range(1000):
+                store.hit(rng.choice(names), 1000000, 1000000.0)
+            done += 1000
+        counts[index] = done
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(counts) / seconds
+
+
+def bench_flood(app, requests, rounds):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(insert(User), [{'first_name': 'Flood', 'last_name': 'Target',
+                                           'email': 'target@example.com', 'password_hash': _hash(PASSWORD, rounds)}])
+        db.session.commit()
+    limiter.reset()
+    client = app.test_client()
+    latencies = {200: [], 302: [], 429: []}
+    started = time.perf_counter()
+    for _ in range(requests):
+        sent = time.perf_counter()
+        response = client.post('/login_page', data={'email': 'target@example.com', 'password': 'guess'})
+        latencies.setdefault(response.status_code, []).append(time.perf_counter() - sent)
+    elapsed = time.perf_counter() - started
+    limiter.reset()
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200000, help='checks timed per case')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--shards', type=int, default=64)
+    parser.add_argument('--keys', type=int, default=10000, help='distinct clients in the store benchmark')
+    parser.add_argument('--seconds', type=float, default=2.0, help='length of each store run')
+    parser.add_argument('--flood', type=int, default=200, help='login attempts in the flood')
+    parser.add_argument('--rounds', type=int, default=10, help='bcrypt work factor of the flooded account')
+    args = parser.parse_args()
+
+    app = create_app(RateLimitConfig)
+
+    existing, new = bench_check(app, args.calls)
+    print('check: %.2f us for an ip+email pair of existing buckets, %.2f us for a new client'
+          % (existing, new))
+
+    for shards in sorted({1, args.shards}):
+        rate = bench_store(shards, args.threads, args.seconds, args.keys)
+        print('store: %d threads, %d shard(s): %.0f hits/sec' % (args.threads, shards, rate))
+
+    latencies, elapsed = bench_flood(app, args.flood, args.rounds)
+    ran = latencies[200] + latencies[302]
+    refused = latencies[429]
+    print('flood: %d attempts in %.2fs, %d ran bcrypt (median %.2f ms), %d refused (median %.3f ms)'
+          % (args.flood, elapsed, len(ran), statistics.median(ran) * 1000 if ran else 0,
+             len(refused), statistics.median(refused) * 1000 if refused else 0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
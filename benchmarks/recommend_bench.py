@@ -0,0 +1,100 @@
+"""Build time, memory and lookup latency of the co-borrowing recommender.
+
+Load a dataset first with benchmarks/datagen.py. The run has three parts:
+
+1. ``rebuild`` recomputes every pair count and list. The report has
+   loans/sec, pairs stored and the growth of peak RSS.
+2. ``refresh`` adds ``--new-loans`` loans and times the incremental update.
+3. ``lookup`` times recommended_books() for random books, first served
+   from the cache and then read from the table (median and p99).
+
+    python benchmarks/datagen.py --books 100000
+    python benchmarks/recommend_bench.py --partitions 4 --pair-budget 5000000
+"""
+import argparse
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, insert, select
+
+from app import create_app, db
+from app import recommendations
+from app.cache import cache
+from app.models import Book, BookLoan, User
+from datagen import BenchConfig, skewed
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def lookups(book_ids, cached):
+    times = []
+    for book_id in book_ids:
+        if not cached:
+            cache.delete('recs:%d' % book_id)
+        started = time.perf_counter()
+        recommendations.recommended_books(book_id)
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return statistics.median(times) * 1e6, times[int(len(times) * 0.99)] * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--partitions', type=int, default=4)
+    parser.add_argument('--pair-budget', type=int, default=5000000)
+    parser.add_argument('--new-loans', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    app = create_app(BenchConfig, minimal=True)
+    rng = random.Random(args.seed)
+    with app.app_context():
+        loans = db.session.scalar(select(func.count(BookLoan.id)))
+        books = db.session.scalar(select(func.max(Book.id))) or 0
+        users = db.session.scalar(select(func.max(User.id))) or 0
+        if not loans:
+            sys.exit('No loans; load a dataset with benchmarks/datagen.py first')
+
+        rss_before = peak_rss_mb()
+        started = time.perf_counter()
+        pairs = recommendations.rebuild(chunk_size=args.chunk_size, partitions=args.partitions,
+                                        pair_budget=args.pair_budget)
+        elapsed = time.perf_counter() - started
+        print('rebuild: %d loans in %.1fs (%.0f loans/sec), %d pairs, %d partitions, peak RSS +%.0f MB'
+              % (loans, elapsed, loans / elapsed, pairs, args.partitions, peak_rss_mb() - rss_before))
+
+        today = date.today()
+        db.session.execute(insert(BookLoan), [
+            {'book_id': skewed(rng, books, 3), 'user_id': skewed(rng, users, 2), 'borrow_date': today,
+             'return_date': today + timedelta(days=7), 'returned': False}
+            for _ in range(args.new_loans)
+        ])
+        db.session.commit()
+        started = time.perf_counter()
+        counted = recommendations.refresh()
+        elapsed = time.perf_counter() - started
+        print('refresh: %d new loans in %.2fs (%.0f loans/sec)' % (counted, elapsed, counted / elapsed))
+
+        sample = [skewed(rng, books, 2) for _ in range(args.lookups)]
+        for book_id in sample:
+            recommendations.recommended_books(book_id)
+        print('lookup: cached median %.1f us p99 %.1f us; from the table median %.1f us p99 %.1f us'
+              % (lookups(sample, True) + lookups(sample, False)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
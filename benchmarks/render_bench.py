@@ -0,0 +1,110 @@
+"""Template rendering cost of the catalog pages with and without caching.
+
+Loads ``--books`` books into a throwaway database and requests /books_page
+and /dashboard with ``--per-page`` rows. Each case is run as the visitor
+it applies to:
+
+- ``no cache``: a signed-in reader, fragment caching off.
+- ``fragments cold``: a signed-in reader, every row rendered and stored.
+- ``fragments warm``: a signed-in reader, every row served from the cache.
+- ``page cache``: an anonymous visitor served the stored page.
+- ``dashboard``: an admin. Time to first byte is reported against the full
+  response, as the page is streamed.
+
+    python benchmarks/render_bench.py --books 5000 --per-page 500
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert
+
+from app import create_app, db
+from app.cache import cache
+from app.config import Config
+from app.models import Book
+from app.render_cache import fragments
+from app.sessions import sessions
+
+
+class RenderConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL', 'sqlite:///render_bench.db')
+    CACHE_BACKEND = 'simple'
+    RATELIMIT_ENABLED = False
+
+
+def setup(app, books):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(insert(Book), [
+            {'title': 'Title %d' % i, 'author': 'Author %d' % (i % 500), 'genre': 'Fiction',
+             'publisher': 'Press %d' % (i % 50), 'year': 1950 + i % 70, 'availability': i % 4}
+            for i in range(books)
+        ])
+        db.session.commit()
+
+
+def client_as(app, user_id=None, is_admin=False):
+    client = app.test_client()
+    if user_id:
+        with app.app_context():
+            token = sessions.create(user_id, is_admin)
+        with client.session_transaction() as session:
+            session['sid'] = token
+    return client
+
+
+def timed(client, url, runs, before=None):
+    """Median time to the first byte and to the whole response, in ms"""
+    first_bytes, totals = [], []
+    for _ in range(runs):
+        if before:
+            before()
+        started = time.perf_counter()
+        response = client.get(url, buffered=False)
+        body = iter(response.response)
+        size = len(next(body, b''))
+        first_bytes.append(time.perf_counter() - started)
+        size += sum(len(chunk) for chunk in body)
+        response.close()
+        totals.append(time.perf_counter() - started)
+        assert response.status_code == 200 and size, response.status_code
+    return statistics.median(first_bytes) * 1000, statistics.median(totals) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=5000)
+    parser.add_argument('--per-page', type=int, default=500)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    RenderConfig.BOOKS_PER_PAGE = args.per_page
+    app = create_app(RenderConfig)
+    setup(app, args.books)
+    reader, anonymous, admin = client_as(app, 1), client_as(app), client_as(app, 1, is_admin=True)
+    url = '/books_page?after=%d' % (args.books // 2)
+
+    app.jinja_env.fragment_cache_enabled = False
+    cases = [('no cache', timed(reader, url, args.runs))]
+    app.jinja_env.fragment_cache_enabled = True
+    cases.append(('fragments cold', timed(reader, url, args.runs, before=fragments.clear)))
+    cases.append(('fragments warm', timed(reader, url, args.runs)))
+    anonymous.get(url)
+    cases.append(('page cache', timed(anonymous, url, args.runs)))
+    cache.clear()
+    cases.append(('dashboard', timed(admin, '/dashboard?after=%d' % (args.books // 2), args.runs)))
+
+    print('%d rows per page, median of %d runs' % (args.per_page, args.runs))
+    for name, (first_byte, total) in cases:
+        print('%-16s first byte %8.2f ms   total %8.2f ms' % (name, first_byte, total))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
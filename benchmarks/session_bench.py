@@ -0,0 +1,97 @@
+"""Cost of resolving the signed-in account with many live sessions.
+
+Stores ``--sessions`` sessions in a throwaway database, then times:
+
+- ``resolve``: looking one random session up in the store, with it in the
+  in-process LRU (``hit``) and read from ``user_sessions`` (``miss``).
+- ``request``: an admin request to /admin/hasher, a view with nothing to do
+  but the admin check, with the session in the LRU and without.
+
+    python benchmarks/session_bench.py --sessions 300000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert
+
+from app import create_app, db
+from app.config import Config
+from app.models import UserSession
+from app.sessions import _digest, sessions
+
+
+class SessionConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL', 'sqlite:///session_bench.db')
+    CACHE_BACKEND = 'simple'
+    RATELIMIT_ENABLED = False
+    HASHER_POOL_SIZE = 0
+
+
+def setup(app, count, chunk=50000):
+    """Stores count sessions and returns their tokens"""
+    tokens = ['bench-%d' % i for i in range(count)]
+    expires = datetime.now() + timedelta(days=30)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for start in range(0, count, chunk):
+            db.session.execute(insert(UserSession), [
+                {'id': _digest(token), 'account_id': i % 50000 + 1, 'is_admin': i % 1000 == 0,
+                 'created_at': datetime.now(), 'expires_at': expires}
+                for i, token in enumerate(tokens[start:start + chunk], start)
+            ])
+        db.session.commit()
+    return tokens
+
+
+def timed(fn, runs, before=None):
+    """Median time of fn() in microseconds"""
+    samples = []
+    for _ in range(runs):
+        if before:
+            before()
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=300000)
+    parser.add_argument('--runs', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = create_app(SessionConfig)
+    started = time.perf_counter()
+    tokens = setup(app, args.sessions)
+    print('stored %d sessions in %.1fs' % (args.sessions, time.perf_counter() - started))
+    rng = random.Random(1)
+
+    with app.app_context():
+        token = rng.choice(tokens)
+        sessions.front.clear()
+        hit = timed(lambda: sessions.resolve(token), args.runs)
+        miss = timed(lambda: sessions.resolve(rng.choice(tokens)), args.runs, before=sessions.front.clear)
+        print('resolve: %.1f us from the LRU, %.1f us from the table' % (hit, miss))
+
+        admin = sessions.create(1, True)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['sid'] = admin
+    client.get('/admin/hasher')
+    warm = timed(lambda: client.get('/admin/hasher'), args.runs // 4)
+    cold = timed(lambda: client.get('/admin/hasher'), args.runs // 4, before=sessions.front.clear)
+    print('request: %.0f us with the session in the LRU, %.0f us without' % (warm, cold))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""Cold-start time, import breakdown and memory of the app factory.
+
+Each run starts a fresh interpreter that imports the app and calls
+create_app(), the work a scaled-to-zero worker does before its first request.
+The report has the median wall time (interpreter start included), the time
+spent importing and in create_app(), and peak RSS. It also has the packages
+that cost the most import time, measured in one extra run under
+``python -X importtime``. No database connection is made.
+
+    python benchmarks/startup.py --runs 10 --output before.json
+    python benchmarks/startup.py --runs 10 --compare before.json
+    python benchmarks/startup.py --minimal --top 30
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, resource, sys, time
+started = time.perf_counter()
+sys.path.insert(0, %(root)r)
+from app import create_app
+from app.config import Config
+imported = time.perf_counter()
+create_app(Config, minimal=%(minimal)r)
+created = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(sys.modules)
+}))
+'''
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def run_child(minimal, importtime=False):
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', CHILD % {'root': ROOT, 'minimal': minimal}]
+    started = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True, cwd=ROOT)
+    wall_ms = (time.perf_counter() - started) * 1000
+    if result.returncode:
+        sys.exit(result.stderr)
+    return wall_ms, json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def interpreter_ms(runs):
+    """Median start-up time of a bare interpreter, the floor under every run"""
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def import_breakdown(stderr, top):
+    """Self import time summed per top-level package, and the slowest
+    modules by cumulative time, from -X importtime output"""
+    packages = defaultdict(int)
+    modules = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, _, name = match.groups()
+        packages[name.split('.')[0]] += int(self_us)
+        modules.append((name, int(cumulative_us)))
+    by_package = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    by_module = sorted(modules, key=lambda item: -item[1])[:top]
+    return ({name: round(us / 1000, 2) for name, us in by_package},
+            {name: round(us / 1000, 2) for name, us in by_module})
+
+
+def compare(report, baseline):
+    """Prints the change of the headline numbers and per-package import time"""
+    lines = []
+    for key in ('wall_ms', 'import_ms', 'create_app_ms', 'rss_kb', 'modules'):
+        old, new = baseline.get(key), report.get(key)
+        if old:
+            lines.append('%-16s %10.1f -> %-10.1f%+5.0f%%' % (key, old, new, (new - old) * 100.0 / old))
+    lines.append('')
+    old_packages = baseline.get('packages_ms', {})
+    for name in sorted(set(old_packages) | set(report['packages_ms']),
+                       key=lambda name: -max(old_packages.get(name, 0), report['packages_ms'].get(name, 0))):
+        lines.append('%-16s %10.1f -> %-10.1f ms' % (name, old_packages.get(name, 0),
+                                                     report['packages_ms'].get(name, 0)))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--minimal', action='store_true', help='time create_app(minimal=True)')
+    parser.add_argument('--top', type=int, default=15, help='packages and modules to list')
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--compare', help='earlier JSON report to diff against')
+    args = parser.parse_args()
+
+    # The first run warms the OS file cache and writes the .pyc files
+    run_child(args.minimal)
+    runs = [run_child(args.minimal) for _ in range(args.runs)]
+    _, _, stderr = run_child(args.minimal, importtime=True)
+    packages, modules = import_breakdown(stderr, args.top)
+
+    report = {
+        'meta': {
+            'minimal': args.minimal,
+            'runs': args.runs,
+            'python': platform.python_version(),
+            'started_at': datetime.now().isoformat(timespec='seconds')
+        },
+        'interpreter_ms': round(interpreter_ms(args.runs), 1),
+        'wall_ms': round(statistics.median(wall for wall, _, _ in runs), 1),
+        'import_ms': round(statistics.median(child['import_ms'] for _, child, _ in runs), 1),
+        'create_app_ms': round(statistics.median(child['create_app_ms'] for _, child, _ in runs), 1),
+        'rss_kb': max(child['rss_kb'] for _, child, _ in runs),
+        'modules': runs[-1][1]['modules'],
+        'packages_ms': packages,
+        'slowest_imports_ms': modules
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
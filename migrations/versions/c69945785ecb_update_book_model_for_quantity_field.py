@@ -5,6 +5,8 @@ Revises: ac360b6a5b6c
 Create Date: 2025-02-19 21:43:19.824696
 
 """
+import logging
+
 from alembic import op
 import sqlalchemy as sa
 from sqlalchemy.dialects import mysql
@@ -15,8 +17,17 @@ down_revision = 'ac360b6a5b6c'
 branch_labels = None
 depends_on = None
 
+logger = logging.getLogger('alembic.runtime.migration')
+
+# Rows filled per statement
+BATCH_SIZE = 10000
+
 
 def upgrade():
+    if op.get_bind().dialect.name == 'mysql':
+        _upgrade_online()
+        return
+
     # ### commands auto generated by Alembic - please adjust! ###
     with op.batch_alter_table('books', schema=None) as batch_op:
         batch_op.alter_column('availability',
@@ -27,6 +38,80 @@ def upgrade():
     # ### end Alembic commands ###
 
 
+def _upgrade_online():
+    # MODIFY COLUMN copies the whole table under a write lock. Instead add
+    # the new column, keep it in step with triggers while it is filled in
+    # batches, then swap the names, so books stays writable throughout.
+    # Every step is safe to rerun if the migration stops part way.
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        columns = {column['name'] for column in sa.inspect(bind).get_columns('books')}
+
+        if 'availability_old' not in columns:
+            if 'availability_new' not in columns:
+                op.add_column('books', sa.Column('availability_new', sa.Integer(), nullable=True))
+            _drop_triggers()
+            op.execute('CREATE TRIGGER books_availability_new_insert BEFORE INSERT ON books '
+                       'FOR EACH ROW SET NEW.availability_new = NEW.availability')
+            op.execute('CREATE TRIGGER books_availability_new_update BEFORE UPDATE ON books '
+                       'FOR EACH ROW SET NEW.availability_new = NEW.availability')
+
+            _fill_availability_new(bind)
+
+            # Renames only change metadata; the lock keeps writes out for
+            # the moment between dropping the triggers and the swap
+            op.execute('LOCK TABLES books WRITE')
+            try:
+                _drop_triggers()
+                op.execute('ALTER TABLE books RENAME COLUMN availability TO availability_old, '
+                           'RENAME COLUMN availability_new TO availability')
+            finally:
+                op.execute('UNLOCK TABLES')
+
+        op.execute('ALTER TABLE books DROP COLUMN availability_old, ALGORITHM=INPLACE, LOCK=NONE')
+
+
+def _fill_availability_new(bind):
+    # One UPDATE per range of ids, each committed on its own (the block is
+    # in autocommit), so locks are held for one batch at a time. Rows done
+    # already are skipped, so a rerun only fills what is left.
+    books = sa.table('books', sa.column('id', sa.Integer()),
+                     sa.column('availability', sa.Integer()),
+                     sa.column('availability_new', sa.Integer()))
+    filled = 0
+    for after, upto in _id_ranges(bind, books.c.id):
+        filled += bind.execute(
+            books.update()
+            .where(books.c.id > after, books.c.id <= upto,
+                   books.c.availability_new.is_(None), books.c.availability.isnot(None))
+            .values(availability_new=books.c.availability)
+        ).rowcount
+        logger.info('books.availability_new: rows up to id %d done', upto)
+    logger.info('books.availability_new: %d rows filled', filled)
+
+
+def _id_ranges(bind, column):
+    """(after, upto] bounds of BATCH_SIZE keys each, lowest first; each is
+    one seek along the key's index"""
+    after = 0
+    while True:
+        upto = bind.scalar(sa.select(column).where(column > after).order_by(column)
+                           .offset(BATCH_SIZE - 1).limit(1))
+        if upto is None:
+            # Fewer than BATCH_SIZE keys left
+            upto = bind.scalar(sa.select(sa.func.max(column)).where(column > after))
+            if upto is not None:
+                yield after, upto
+            return
+        yield after, upto
+        after = upto
+
+
+def _drop_triggers():
+    op.execute('DROP TRIGGER IF EXISTS books_availability_new_insert')
+    op.execute('DROP TRIGGER IF EXISTS books_availability_new_update')
+
+
 def downgrade():
     # ### commands auto generated by Alembic - please adjust! ###
     with op.batch_alter_table('books', schema=None) as batch_op:
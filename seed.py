@@ -1,16 +1,42 @@
-from app import create_app, db
+from app import create_app, db, init_migrate
+from app.hashing import _hash
 from app.models import Book, User, BookLoan, AdminUser, Log
-from flask_bcrypt import generate_password_hash
+from app.stock import stock_new_books
 from flask_migrate import upgrade
 from datetime import date
+from itertools import islice
+
+# Rows added and committed at a time, so the session never holds more
+CHUNK_SIZE = 1000
+
+app = create_app(minimal=True)
+init_migrate(app)
+rounds = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+
+
+def add_in_chunks(objects, after_flush=None):
+    """Adds objects from an iterable, committing every CHUNK_SIZE of them.
+    ``after_flush`` gets each chunk once it has ids."""
+    objects = iter(objects)
+    while True:
+        chunk = list(islice(objects, CHUNK_SIZE))
+        if not chunk:
+            return
+        db.session.add_all(chunk)
+        if after_flush:
+            db.session.flush()
+            after_flush(chunk)
+        db.session.commit()
 
-app = create_app()
 
 with app.app_context():
 
+    # The tables below may not exist yet
+    upgrade()
+
     admin = AdminUser.query.filter_by(email=app.config['ADMIN_EMAIL']).first()
     if not admin:
-        hashed_password = generate_password_hash(app.config['ADMIN_PASSWORD']).decode('utf-8')
+        hashed_password = _hash(app.config['ADMIN_PASSWORD'], rounds)
         admin = AdminUser(
             username=app.config['ADMIN_USERNAME'],
             email=app.config['ADMIN_EMAIL'],
@@ -21,29 +47,24 @@ with app.app_context():
         print("Hard-coded admin created successfully!")
     else:
         print("Hard-coded admin already exists.")
-    
-
-
-    upgrade()
 
     # Seed Books
     if not Book.query.first():
-        books = [
-           Book(title="The Subtle Art of Not Giving a F*ck", author="Mark Manson",
+        books = (
+            Book(title="The Subtle Art of Not Giving a F*ck", author="Mark Manson",
                  genre="Self-help", availability=3, publisher="Harper", year=2016),
             Book(title="a", author="a", genre="a", availability=2, publisher="Test", year=2020)
-        ]
-        db.session.add_all(books)
+        )
+        # Their copies go on the default branch's shelf
+        add_in_chunks(books, lambda chunk: stock_new_books({book.id: book.availability for book in chunk}))
 
     # Seed Users
     if not User.query.first():
-        users = [
-            User(first_name="John", last_name="Doe", email="john@example.com", phone="1234567890", password_hash=generate_password_hash("password123").decode('utf-8')),
-            User(first_name="Jane", last_name="Smith", email="jane@example.com", phone="0987654321", password_hash=generate_password_hash("securepass").decode('utf-8'))
-        ]
-        db.session.add_all(users)
-
-    
+        users = (
+            User(first_name="John", last_name="Doe", email="john@example.com", phone="1234567890", password_hash=_hash("password123", rounds)),
+            User(first_name="Jane", last_name="Smith", email="jane@example.com", phone="0987654321", password_hash=_hash("securepass", rounds))
+        )
+        add_in_chunks(users)
 
     # Seed Book Loans
     user1 = User.query.filter_by(email="john@example.com").first()
@@ -52,22 +73,19 @@ with app.app_context():
     book2 = Book.query.filter_by(title="1984").first()
 
     if user1 and book1 and not BookLoan.query.first():
-        book_loans = [
+        book_loans = (
             BookLoan(user_id=user1.id, book_id=book1.id, borrow_date=date(2024, 1, 1), return_date=date(2024, 1, 15), returned=True),
             BookLoan(user_id=user2.id, book_id=book2.id, borrow_date=date(2024, 2, 1), return_date=None, returned=False)
-        ]
-        db.session.add_all(book_loans)
+        )
+        add_in_chunks(book_loans)
 
     # Seed Logs
     if not Log.query.first():
-        logs = [
+        logs = (
             Log(user_id=user1.id, action="Checked out 'The Great Gatsby'"),
             Log(user_id=user2.id, action="Checked out '1984'"),
             Log(admin_id=1, action="Created a new admin account")
-        ]
-        db.session.add_all(logs)
+        )
+        add_in_chunks(logs)
 
-    db.session.commit()
     print("Database seeded successfully!")
-
-